@@ -894,6 +894,7 @@ Function New-SectionGroupConversionConfig {
                         }else {
                             [io.path]::combine( $cfg['notesDocxDirectory'], "$( $pageCfg['pathFromRootCompat'] ).docx" )
                         }
+                        $pageCfg['wrapCodeBlocksCacheFilePath'] = [io.path]::combine( $cfg['notesDocxDirectory'], 'wrap_code_blocks_cache.sqlite' )
                         $pageCfg['insertedAttachments'] = @(
                             & {
                                 $pagexml = Get-OneNotePageContent -OneNoteConnection $OneNoteConnection -PageId $pageCfg['object'].ID
@@ -1207,11 +1208,21 @@ Function Convert-OneNotePage {
                 try {
                     $argumentList = @(
                         '.\wrap_code_blocks.py'
+                        '--quiet' # Start-Process does not capture stdout, so don't print the result to the console
                         if ($pageCfg['docxExportFilePath'] -match ' ') {
                             "`"$( $pageCfg['docxExportFilePath'] )`"" # Add double-quotes to path containing spaces
                         }else {
                             $pageCfg['docxExportFilePath']
                         }
+                        if ($config['usedocx']['value'] -eq 2) {
+                            # Skip reused docx files that have already been wrapped
+                            '--cache'
+                            if ($pageCfg['wrapCodeBlocksCacheFilePath'] -match ' ') {
+                                "`"$( $pageCfg['wrapCodeBlocksCacheFilePath'] )`"" # Add double-quotes to path containing spaces
+                            }else {
+                                $pageCfg['wrapCodeBlocksCacheFilePath']
+                            }
+                        }
                     )
                     $process = Start-Process -ErrorAction Stop -RedirectStandardError $stderrFile -PassThru -NoNewWindow -Wait -FilePath python.exe -ArgumentList $argumentList
                     if ($process.ExitCode -ne 0) {
@@ -1499,6 +1510,39 @@ Function Convert-OneNote2MarkDown {
         foreach ($notebook in $notebooks) {
             "`nConverting notebook '$( $notebook.name )'... (Ignoring deleted notes)" | Write-Host -ForegroundColor Cyan
             New-SectionGroupConversionConfig -OneNoteConnection $OneNote -NotesDestination $config['notesdestpath']['value'] -Config $config -SectionGroups $notebook -LevelsFromRoot 0 -ErrorVariable +totalerr | Tee-Object -Variable pageConversionConfigs | Convert-OneNotePage -OneNoteConnection $OneNote -Config $config -ErrorVariable +totalerr
+            # Remove the reused docx files which no longer exist from the wrap_code_blocks.py cache, once per notebook
+            if ($config['wrapCodeBlocks']['value'] -eq 1 -and $config['usedocx']['value'] -eq 2) {
+                $cacheFilePaths = @( $pageConversionConfigs | ForEach-Object { $_['wrapCodeBlocksCacheFilePath'] } | Select-Object -Unique )
+                foreach ($cacheFilePath in $cacheFilePaths) {
+                    if (! (Test-Path -LiteralPath $cacheFilePath) ) {
+                        continue
+                    }
+                    $stderrFile = [io.path]::combine( [io.path]::GetTempPath(), 'wrap-code-blocks-stderr.txt' )
+                    try {
+                        $argumentList = @(
+                            '.\wrap_code_blocks.py'
+                            '--cache'
+                            if ($cacheFilePath -match ' ') {
+                                "`"$( $cacheFilePath )`"" # Add double-quotes to path containing spaces
+                            }else {
+                                $cacheFilePath
+                            }
+                            '--prune-cache'
+                        )
+                        $process = Start-Process -ErrorAction Stop -RedirectStandardError $stderrFile -PassThru -NoNewWindow -Wait -FilePath python.exe -ArgumentList $argumentList
+                        if ($process.ExitCode -ne 0) {
+                            $stderr = Get-Content $stderrFile -Raw
+                            throw "wrap_code_blocks.py error: $stderr"
+                        }
+                    }catch {
+                        Write-Warning "Failed to prune the wrap code blocks cache $cacheFilePath"
+                    }finally {
+                        if (Test-Path $stderrFile) {
+                            Remove-Item $stderrFile -Force
+                        }
+                    }
+                }
+            }
             "`nDone converting notebook '$( $notebook.name )' with $( ($pageConversionConfigs | Measure-object).Count ) notes." | Write-Host -ForegroundColor Cyan
             $pageConversionConfigsAll += $pageConversionConfigs
         }
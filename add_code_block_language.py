@@ -2,16 +2,684 @@
 """Recursively processes Markdown files in a directory and adds the programming
 language to Markdown code blocks."""
 import argparse
+import hashlib
+import json
+import multiprocessing
 import os
+import re
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Union,
+)
 
-from guesslang import Guess
+from code_fences import has_fences
+from language_daemon import (
+    DAEMON_ADDRESS_ENVIRONMENT_VARIABLE,
+    DEFAULT_DAEMON_ADDRESS,
+    DaemonClient,
+    DaemonError,
+    LanguageDaemon,
+    serve_stream,
+)
+import markdown_pipeline
+from markdown_pipeline import (
+    DEFAULT_IO_THREADS,
+    NOTE_ENCODING,
+    NOTE_ENCODING_ERRORS,
+    NoteCodeBlock,
+    NoteTransform,
+    NoteTransformer,
+    RunState,
+    add_scan_arguments,
+    find_notes,
+    process_files,
+    transform_note,
+)
 
-guess = Guess()
+DEFAULT_BATCH_SIZE: int = 256
+DEFAULT_CACHE_SIZE: int = 100000
+# Code blocks longer than this are classified from a sample of their lines
+DEFAULT_SAMPLE_LINES: int = 200
+DEFAULT_TFLITE_MODEL: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "guesslang.tflite"
+)
+# Workers are replaced after this many notes to release the memory Tensorflow
+# accumulates
+DEFAULT_MAX_TASKS_PER_WORKER: int = 100
+TRAILING_WHITESPACE_REGEX = re.compile(r"[ \t]+$", re.MULTILINE)
 
-CODE_BLOCK_BACKTICK_COUNT: int = 3
+# Interpreters in shebang lines and the languages of their scripts
+SHEBANG_LANGUAGES: Dict[str, str] = {
+    "bash": "shell",
+    "node": "javascript",
+    "perl": "perl",
+    "php": "php",
+    "pwsh": "powershell",
+    "python": "python",
+    "ruby": "ruby",
+    "sh": "shell",
+    "zsh": "shell",
+}
+SHEBANG_REGEX = re.compile(r"#!(?:\S*/)?([\w.]+)(?:[ \t]+([\w.]+))?")
 
+# Rules matched against the start of code blocks which are unambiguous enough to
+# skip the model, in order of precedence. Code blocks which merely look like
+# code, such as prose starting with "Select" or an HTTP header, are left to the
+# model.
+HEURISTIC_RULES: List[Tuple[str, Pattern]] = [
+    ("xml", re.compile(r"<\?xml\b")),
+    ("html", re.compile(r"<!doctype\s+html\b|<html\b", re.IGNORECASE)),
+    # Standard C++ headers have no extension, unlike the C headers, and quoted
+    # includes of project headers are used by both languages
+    (
+        "c++",
+        re.compile(r"#include\s*<(?:iostream|string|vector|map|memory|algorithm)>"),
+    ),
+    (
+        "c",
+        re.compile(
+            r"#include\s*<(?:assert|ctype|errno|float|limits|math|stdarg|stdbool|"
+            r"stddef|stdint|stdio|stdlib|string|time|unistd)\.h>"
+            # C++ code includes C headers too
+            r"(?![\s\S]*(?:\b(?:class|namespace|template|using)\b|::))"
+        ),
+    ),
+    (
+        "sql",
+        re.compile(
+            r"(?:select\s+(?:distinct\s+)?(?:\*|[\w.]+(?:\s*,\s*[\w.]+)*)\s+"
+            r"from\s+[\w.]+\s*(?:$|;|where\b|join\b|order\b|group\b)|"
+            r"select\b[^;]*\bfrom\b[^;]*;\s*$|"
+            r"insert\s+into\s+[\w.]+\s*(?:\(|values\b|select\b)|"
+            r"delete\s+from\s+[\w.]+\s*(?:;|where\b)|"
+            r"create\s+(?:table|view)\s+[\w.]+\s*(?:\(|as\b)|"
+            r"create\s+(?:unique\s+)?index\s+\w+\s+on\b|"
+            r"alter\s+table\s+[\w.]+\s+(?:add|drop|alter|rename)\b|"
+            r"update\s+[\w.]+\s+set\s+[\w.]+\s*=)",
+            re.IGNORECASE | re.MULTILINE,
+        ),
+    ),
+    # A cmdlet followed by the end of the line, a pipe, a parameter, a string
+    # or a variable, but not by a colon as in "Set-Cookie: id=1"
+    (
+        "powershell",
+        re.compile(
+            r"(?:\$\w+\s*=\s*)?(?:Get|Set|New|Remove|Add|Write|Invoke|Import|"
+            r"Export|Start|Stop|Test|Select|Where|ForEach)-[A-Z][A-Za-z]+"
+            r"(?=[ \t]*(?:$|[|;]|-[A-Za-z]|[\"'$]))",
+            re.MULTILINE,
+        ),
+    ),
+]
+# The languages which can be detected without the model
+HEURISTIC_LANGUAGES: List[str] = sorted(
+    set(SHEBANG_LANGUAGES.values())
+    | {"json"}
+    | {language for language, _ in HEURISTIC_RULES}
+)
 
-def process_note(text: str) -> str:
+# The guesslang model is loaded on first use since importing Tensorflow and
+# loading the model takes several seconds
+_guess = None
+# Whether to use a running language detection daemon instead of loading the
+# model, see `get_daemon`
+use_daemon = True
+_daemon: Optional[DaemonClient] = None
+_daemon_checked = False
+
+
+def get_daemon() -> Optional[DaemonClient]:
+    """Returns a connection to the language detection daemon, if it is running.
+
+    The daemon keeps the guesslang model loaded between runs, avoiding the cost
+    of loading it every time. It is only used when its address is set in the
+    ``CODE_BLOCK_LANGUAGE_DAEMON`` environment variable.
+
+    Returns
+    -------
+    Optional[DaemonClient]
+        The shared connection, or None if no daemon address is set, the daemon
+        is not running or `use_daemon` is False.
+    """
+    global _daemon, _daemon_checked
+
+    if not _daemon_checked and use_daemon:
+        _daemon_checked = True
+        address = os.environ.get(DAEMON_ADDRESS_ENVIRONMENT_VARIABLE)
+        if not address:
+            return None
+
+        try:
+            daemon = DaemonClient(address)
+        except (OSError, ValueError, DaemonError):
+            return None
+
+        # Daemons running another backend of the guesslang model, such as
+        # tflite, add a suffix to its version
+        name, _, model = daemon.backend_version.partition(" ")
+        if name == GuesslangBackend.name and model and " " not in model:
+            _daemon = daemon
+        else:
+            daemon.close()
+
+    return _daemon
+
+
+def _drop_daemon() -> None:
+    """Stops using a daemon which failed, falling back to loading the model."""
+    global _daemon
+
+    _daemon = None
+
+
+def reset_daemon() -> None:
+    """Forgets the connection to the daemon, e.g. after it failed, or in a
+    worker process which must not share the connection of its parent."""
+    global _daemon, _daemon_checked
+
+    _daemon = None
+    _daemon_checked = False
+
+
+def get_guess():
+    """Returns the guesslang model, loading it on first use.
+
+    Returns
+    -------
+    guesslang.Guess
+        The shared guesslang instance.
+    """
+    global _guess
+
+    if _guess is None:
+        from guesslang import Guess
+
+        _guess = Guess()
+
+    return _guess
+
+
+def model_version() -> str:
+    """Returns a tag identifying the installed language detection model.
+
+    The version is read from the package metadata so that the model does not
+    need to be loaded.
+
+    Returns
+    -------
+    str
+        The model version tag, e.g. ``guesslang 2.2.1``.
+    """
+    try:
+        from importlib.metadata import version
+    except ImportError:  # Python 3.7
+        import pkg_resources
+
+        return f"guesslang {pkg_resources.get_distribution('guesslang').version}"
+
+    return f"guesslang {version('guesslang')}"
+
+
+def heuristic_language(
+    code_block_text: str, languages: Optional[Collection[str]] = None
+) -> Optional[str]:
+    """Detects the language of obvious code blocks without the model.
+
+    Parameters
+    ----------
+    code_block_text : str
+        The text inside the code block.
+    languages : Optional[Collection[str]]
+        The languages in `HEURISTIC_LANGUAGES` to detect, all of them by
+        default. Code blocks detected as another language are passed to the
+        model.
+
+    Returns
+    -------
+    Optional[str]
+        The lowercase name of the language, or None if the code block is not
+        obvious enough and should be passed to the model.
+    """
+    language = _heuristic_language(code_block_text.strip())
+    if languages is not None and language not in languages:
+        return None
+
+    return language
+
+
+def parse_heuristic_languages(value: str) -> List[str]:
+    """Parses a comma-separated list of languages in `HEURISTIC_LANGUAGES`."""
+    languages = value.split(",") if value else []
+    for language in languages:
+        if language not in HEURISTIC_LANGUAGES:
+            raise argparse.ArgumentTypeError(
+                f"invalid language: {language!r} "
+                f"(choose from {', '.join(HEURISTIC_LANGUAGES)})"
+            )
+    return languages
+
+
+def _heuristic_language(text: str) -> Optional[str]:
+
+    match = SHEBANG_REGEX.match(text)
+    if match is not None:
+        interpreter = match.group(1)
+        if interpreter == "env" and match.group(2) is not None:
+            interpreter = match.group(2)
+        # Ignore versions such as python3.9
+        return SHEBANG_LANGUAGES.get(interpreter.rstrip("0123456789."))
+
+    if text[:1] in ("{", "["):
+        try:
+            json.loads(text)
+        except ValueError:
+            pass
+        else:
+            return "json"
+
+    for language, regex in HEURISTIC_RULES:
+        if regex.match(text):
+            return language
+
+    return None
+
+
+def detect_language(code_block_text: str) -> str:
+    """Detects the programming language of the text of a code block.
+
+    Parameters
+    ----------
+    code_block_text : str
+        The text inside the code block.
+
+    Returns
+    -------
+    str
+        The lowercase name of the language, or an empty string if it could not
+        be detected reliably.
+    """
+    daemon = get_daemon()
+    if daemon is not None:
+        try:
+            return daemon.detect(code_block_text)
+        except (OSError, ValueError, DaemonError):
+            _drop_daemon()
+
+    language = get_guess().language_name(code_block_text)
+    if language is None:
+        return ""
+
+    return language.lower()
+
+
+def detect_languages(code_block_texts: Sequence[str]) -> List[str]:
+    """Detects the programming languages of many code blocks at once.
+
+    All of the code blocks are classified with a single call to the model,
+    avoiding the overhead of running the model once per code block.
+
+    Parameters
+    ----------
+    code_block_texts : Sequence[str]
+        The texts inside the code blocks.
+
+    Returns
+    -------
+    List[str]
+        The lowercase name of the language of each code block, or an empty
+        string if it could not be detected reliably.
+    """
+    daemon = get_daemon()
+    if daemon is not None:
+        try:
+            return daemon.detect_many(code_block_texts)
+        except (OSError, ValueError, DaemonError):
+            _drop_daemon()
+
+    import tensorflow as tf
+
+    guess = get_guess()
+
+    def predict(texts: List[str]) -> List[str]:
+        # guesslang only exposes single predictions, so the saved model is
+        # called directly the same way guesslang.model.predict does
+        predicted = guess._model.signatures["serving_default"](tf.constant(texts))
+        return predicted_languages(
+            predicted["scores"].numpy(),
+            predicted["classes"].numpy(),
+            guess._extension_map,
+        )
+
+    return _detect_non_empty(code_block_texts, predict)
+
+
+def _detect_non_empty(
+    code_block_texts: Sequence[str], predict: Callable[[List[str]], List[str]]
+) -> List[str]:
+    languages = [""] * len(code_block_texts)
+
+    # guesslang does not detect the language of empty code blocks
+    indexes = [i for i, text in enumerate(code_block_texts) if text.strip()]
+    if len(indexes) == 0:
+        return languages
+
+    for i, language in zip(indexes, predict([code_block_texts[i] for i in indexes])):
+        languages[i] = language
+
+    return languages
+
+
+def predicted_languages(
+    scores: Sequence[Sequence[float]],
+    classes: Sequence[Sequence[bytes]],
+    extension_map: Dict[str, str],
+) -> List[str]:
+    """Returns the languages predicted by the guesslang model.
+
+    Parameters
+    ----------
+    scores : Sequence[Sequence[float]]
+        The probability of each class, for each code block.
+    classes : Sequence[Sequence[bytes]]
+        The file extension of each class, for each code block.
+    extension_map : Dict[str, str]
+        The name of the language of each file extension.
+
+    Returns
+    -------
+    List[str]
+        The lowercase name of the language of each code block, or an empty
+        string if the prediction is not reliable.
+    """
+    languages = []
+    for block_scores, block_classes in zip(scores, classes):
+        probabilities = [float(score) for score in block_scores]
+        # The same rule as guesslang: the probability of the predicted language
+        # must be more than 2 standard deviations above the mean
+        threshold = statistics.mean(probabilities) + 2 * statistics.stdev(probabilities)
+        best = max(range(len(probabilities)), key=probabilities.__getitem__)
+        if probabilities[best] <= threshold:
+            languages.append("")
+            continue
+
+        extension = block_classes[best]
+        if isinstance(extension, bytes):
+            extension = extension.decode()
+        languages.append(extension_map[extension].lower())
+
+    return languages
+
+
+def export_tflite_model(filename: str) -> None:
+    """Converts the guesslang model to a quantized TensorFlow Lite model.
+
+    The weights are quantized to 8 bits. guesslang hashes the code block text
+    with TensorFlow operations which TensorFlow Lite does not implement, so the
+    converted model also needs the TensorFlow Select operations. The version of
+    the model and the languages of its classes are written to ``<filename>.json``.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the TensorFlow Lite model to write.
+    """
+    import tensorflow as tf
+
+    guess = get_guess()
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [guess._model.signatures["serving_default"]]
+    )
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS,
+        tf.lite.OpsSet.SELECT_TF_OPS,
+    ]
+    model = converter.convert()
+
+    with open(filename, "wb") as file:
+        file.write(model)
+    with open(f"{filename}.json", "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "version": f"{model_version()} tflite",
+                "extensions": guess._extension_map,
+            },
+            file,
+        )
+
+
+class LanguageBackend:
+    """Detects the languages of code blocks.
+
+    Subclasses implement `detect`, and may override `detect_many` to classify
+    many code blocks more efficiently than one at a time.
+    """
+
+    #: The name used to select the backend on the command line
+    name: str = ""
+
+    def load(self) -> None:
+        """Loads the model, if any, so that it is not loaded by the first
+        detection."""
+
+    def version(self) -> str:
+        """Returns a tag identifying the backend and its model, used to
+        invalidate cached languages when it changes."""
+        return self.name
+
+    def detect(self, code_block_text: str) -> str:
+        """Returns the lowercase name of the language of a code block, or an
+        empty string if it could not be detected."""
+        raise NotImplementedError
+
+    def detect_many(self, code_block_texts: Sequence[str]) -> List[str]:
+        """Returns the languages of many code blocks, see `detect`."""
+        return [self.detect(code_block_text) for code_block_text in code_block_texts]
+
+
+class GuesslangBackend(LanguageBackend):
+    """Detects languages with the guesslang deep learning model.
+
+    It is the most accurate backend, but the slowest one.
+    """
+
+    name = "guesslang"
+
+    def load(self) -> None:
+        if get_daemon() is None:
+            get_guess()
+
+    def version(self) -> str:
+        daemon = get_daemon()
+        if daemon is not None:
+            try:
+                return daemon.version()
+            except (OSError, ValueError, DaemonError):
+                _drop_daemon()
+
+        return model_version()
+
+    def detect(self, code_block_text: str) -> str:
+        return detect_language(code_block_text)
+
+    def detect_many(self, code_block_texts: Sequence[str]) -> List[str]:
+        return detect_languages(code_block_texts)
+
+
+class TFLiteBackend(LanguageBackend):
+    """Detects languages with a quantized TensorFlow Lite version of the
+    guesslang model, see `export_tflite_model`.
+
+    The quantized model is smaller than the guesslang one. It does the text
+    preprocessing of guesslang with TensorFlow operations, which
+    ``tflite_runtime`` cannot run, so it is run with the interpreter included in
+    TensorFlow and still needs TensorFlow to be imported.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the TensorFlow Lite model.
+    """
+
+    name = "tflite"
+
+    def __init__(self, filename: str = DEFAULT_TFLITE_MODEL) -> None:
+        self.filename = filename
+        self._runner = None
+        with open(f"{filename}.json", "r", encoding="utf-8") as file:
+            metadata = json.load(file)
+        self._version = metadata["version"]
+        self._extension_map = metadata["extensions"]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The interpreter cannot be sent to worker processes, which load their
+        # own
+        state = self.__dict__.copy()
+        state["_runner"] = None
+        return state
+
+    def load(self) -> None:
+        if self._runner is not None:
+            return
+
+        # Only import TensorFlow when the model is needed
+        import tensorflow as tf
+
+        interpreter = tf.lite.Interpreter(model_path=self.filename)
+        self._runner = interpreter.get_signature_runner("serving_default")
+        (self._input_name,) = self._runner.get_input_details()
+
+    def version(self) -> str:
+        return self._version
+
+    def detect(self, code_block_text: str) -> str:
+        return self.detect_many([code_block_text])[0]
+
+    def detect_many(self, code_block_texts: Sequence[str]) -> List[str]:
+        import numpy as np
+
+        self.load()
+
+        def predict(texts: List[str]) -> List[str]:
+            predicted = self._runner(
+                **{self._input_name: np.array(texts, dtype=object)}
+            )
+            return predicted_languages(
+                predicted["scores"], predicted["classes"], self._extension_map
+            )
+
+        return _detect_non_empty(code_block_texts, predict)
+
+
+class PygmentsBackend(LanguageBackend):
+    """Detects languages with the lexer guessing of Pygments.
+
+    It is much faster than guesslang but less accurate, and names languages
+    with the Pygments lexer aliases, e.g. ``cpp`` rather than ``c++``.
+    """
+
+    name = "pygments"
+
+    def version(self) -> str:
+        import pygments
+
+        return f"pygments {pygments.__version__}"
+
+    def detect(self, code_block_text: str) -> str:
+        from pygments.lexers import guess_lexer
+        from pygments.util import ClassNotFound
+
+        if not code_block_text.strip():
+            return ""
+
+        try:
+            lexer = guess_lexer(code_block_text)
+        except ClassNotFound:
+            return ""
+
+        # Pygments falls back to plain text when no lexer matches
+        if len(lexer.aliases) == 0 or lexer.aliases[0] == "text":
+            return ""
+
+        return lexer.aliases[0]
+
+
+class HeuristicBackend(LanguageBackend):
+    """Detects only obvious languages with the rules in `heuristic_language`."""
+
+    name = "heuristic"
+
+    def detect(self, code_block_text: str) -> str:
+        return heuristic_language(code_block_text) or ""
+
+
+class NoneBackend(LanguageBackend):
+    """Does not detect any languages, leaving the code blocks unchanged."""
+
+    name = "none"
+
+    def detect(self, code_block_text: str) -> str:
+        return ""
+
+
+BACKENDS: Dict[str, type] = {
+    backend.name: backend
+    for backend in [
+        GuesslangBackend,
+        TFLiteBackend,
+        PygmentsBackend,
+        HeuristicBackend,
+        NoneBackend,
+    ]
+}
+DEFAULT_BACKEND: str = GuesslangBackend.name
+DEFAULT_FALLBACK_BACKEND: str = HeuristicBackend.name
+
+
+def sample_code_block(code_block_text: str, max_lines: int) -> str:
+    """Returns a representative sample of the lines of a large code block.
+
+    The sample is made of the first lines of the code block, followed by a slice
+    from its middle, so that the time and memory needed to classify it do not
+    depend on its size.
+
+    Parameters
+    ----------
+    code_block_text : str
+        The text inside the code block.
+    max_lines : int
+        The maximum number of lines in the sample.
+
+    Returns
+    -------
+    str
+        The sample, or the text itself if it has at most ``max_lines`` lines.
+    """
+    if code_block_text.count("\n") < max_lines:
+        return code_block_text
+
+    lines = code_block_text.split("\n")
+    head = max_lines - max_lines // 4
+    middle = max(head, (len(lines) - (max_lines - head)) // 2)
+    return "\n".join(lines[:head] + lines[middle : middle + max_lines - head])
+
+
+def process_note(text: str, detect: Callable[[str], str] = detect_language) -> str:
     """Appends the language to the start of a code block.
 
     If an existing language is already specified, it will skip the addition.
@@ -20,95 +688,1012 @@ def process_note(text: str) -> str:
     ----------
     text : str
         The text to process.
+    detect : Callable[[str], str]
+        Returns the language of the text inside a code block.
 
     Returns
     -------
     str
         The modified text.
     """
-    modified_text = ""
-    code_block_text = ""
-    code_block_start_idx = 0
-    consecutive_backticks = 0
-    in_code_block = False
-    skip_addition = False
-
-    text_idx = 0
-    modified_text_idx = 0
-
-    for c in text:
-        if c == "`":
-            consecutive_backticks += 1
-
-            if consecutive_backticks == CODE_BLOCK_BACKTICK_COUNT and not in_code_block:
-                i = 1
-                while ((text_idx + i) < len(text) - 1) and text[text_idx + i] == " ":
-                    i += 1
-
-                # Only append the language to the code block if a language
-                # hasn't already been specified
-                if ((text_idx + i) < len(text) - 1) and text[text_idx + i] != "\n":
-                    skip_addition = True
+    return transform_note(text, [AddLanguageTransform(detect)])
+
+
+class AddLanguageTransform(NoteTransform):
+    """Appends the language to the start of code blocks, see `process_note`.
+
+    Parameters
+    ----------
+    detect : Callable[[str], str]
+        Returns the language of the text inside a code block.
+    """
+
+    name = "add-language"
+
+    def __init__(self, detect: Callable[[str], str] = detect_language) -> None:
+        self.detect = detect
+
+    def version(self) -> str:
+        # Code blocks left without a language may be detected by another backend
+        if isinstance(self.detect, LanguageDetector):
+            return f"{self.name} {self.detect.backend.version()}"
+
+        return self.name
+
+    def degraded(self) -> int:
+        if isinstance(self.detect, LanguageDetector):
+            return self.detect.counts["degraded"]
+
+        return 0
+
+    def apply(self, code_blocks: List[NoteCodeBlock]) -> None:
+        for code_block in code_blocks:
+            # Only append the language to the code block if a language hasn't
+            # already been specified, and once the code block is complete
+            if code_block.info or not code_block.closed:
+                continue
+
+            code_block.opening = (
+                self.detect(code_block.opening + code_block.content)
+                + code_block.opening
+            )
+
+
+class LanguageCache:
+    """An SQLite database mapping code block texts to their detected languages.
+
+    The same code blocks often appear in many notes and across repeated runs, so
+    detected languages are cached by a hash of the normalized code block text.
+    Entries are invalidated when the model version changes, and the least
+    recently used entries are evicted when the cache grows beyond its size.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SQLite database. It is created if it does not exist.
+    model_version : str
+        Tag identifying the model used to detect the languages.
+    max_entries : int
+        The maximum number of entries kept when the cache is saved.
+    readonly : bool
+        Whether to only look up languages without updating the cache, e.g. from
+        worker processes. The cache must already have been opened for writing
+        with the same model version.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        model_version: str,
+        max_entries: int = DEFAULT_CACHE_SIZE,
+        readonly: bool = False,
+    ) -> None:
+        self.filename = filename
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(filename)
+        if readonly:
+            return
+
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS languages (
+                key TEXT PRIMARY KEY,
+                language TEXT NOT NULL,
+                last_used INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS languages_last_used
+                ON languages (last_used);
+            """)
+
+        row = self.connection.execute(
+            "SELECT value FROM metadata WHERE name = 'model_version'"
+        ).fetchone()
+        if row is None or row[0] != model_version:
+            self.connection.execute("DELETE FROM languages")
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES ('model_version', ?)",
+                (model_version,),
+            )
+            self.connection.commit()
+
+        # A counter rather than a timestamp orders the entries by use, since
+        # many entries are used within the same clock tick
+        (self.clock,) = self.connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM languages"
+        ).fetchone()
+
+    @staticmethod
+    def _key(code_block_text: str) -> str:
+        normalized = TRAILING_WHITESPACE_REGEX.sub(
+            "", code_block_text.replace("\r\n", "\n")
+        ).strip("\n")
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, code_block_text: str) -> Optional[str]:
+        """Returns the cached language of a code block, if any."""
+        key = self._key(code_block_text)
+        row = self.connection.execute(
+            "SELECT language FROM languages WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if self.readonly:
+            return row[0]
+
+        self.clock += 1
+        self.connection.execute(
+            "UPDATE languages SET last_used = ? WHERE key = ?", (self.clock, key)
+        )
+        return row[0]
+
+    def set(self, code_block_text: str, language: str) -> None:
+        """Records the detected language of a code block.
+
+        Read only caches are left unchanged.
+        """
+        if self.readonly:
+            return
+
+        self.clock += 1
+        self.connection.execute(
+            "INSERT OR REPLACE INTO languages VALUES (?, ?, ?)",
+            (self._key(code_block_text), language, self.clock),
+        )
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups which were found in the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def save(self) -> None:
+        """Evicts the least recently used entries and writes the cache to disk."""
+        self.connection.execute(
+            """
+            DELETE FROM languages WHERE last_used <= (
+                SELECT last_used FROM languages
+                ORDER BY last_used DESC LIMIT 1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class LanguageDetector:
+    """Detects the languages of code blocks by the cheapest path available.
+
+    Obvious code blocks are detected with heuristics, then previously detected
+    code blocks are looked up in the cache, and only the remaining ones are
+    passed to the backend. The number of code blocks handled by each path is
+    counted in ``counts``, and the time spent in the backend in
+    ``backend_time``.
+
+    When a time budget is set, code blocks are detected with the fallback
+    backend instead once the deadline has passed, or when the backend takes
+    longer than the budget of a code block. These code blocks are counted as
+    ``degraded`` and are not cached.
+
+    Parameters
+    ----------
+    cache : Optional[LanguageCache]
+        The cache of detected languages, if any.
+    heuristics : Union[bool, Collection[str]]
+        Whether to detect obvious code blocks with heuristics, or the languages
+        to detect with them, see `heuristic_language`.
+    backend : Optional[LanguageBackend]
+        Detects the languages of the remaining code blocks, guesslang by
+        default.
+    deadline : Optional[float]
+        The time, as returned by `time.time`, after which the backend is no
+        longer used.
+    block_time_budget : Optional[float]
+        The maximum number of seconds to wait for the backend per code block.
+    fallback : Optional[LanguageBackend]
+        Detects the languages of code blocks once the time budget has run out,
+        the heuristic rules by default.
+    sample_lines : Optional[int]
+        Code blocks with more lines are classified from a sample of this many
+        lines, see `sample_code_block`.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[LanguageCache] = None,
+        heuristics: Union[bool, Collection[str]] = True,
+        backend: Optional[LanguageBackend] = None,
+        deadline: Optional[float] = None,
+        block_time_budget: Optional[float] = None,
+        fallback: Optional[LanguageBackend] = None,
+        sample_lines: Optional[int] = DEFAULT_SAMPLE_LINES,
+    ) -> None:
+        self.cache = cache
+        self.heuristics = heuristics
+        self.backend = backend if backend is not None else GuesslangBackend()
+        self.deadline = deadline
+        self.block_time_budget = block_time_budget
+        self.fallback = fallback if fallback is not None else HeuristicBackend()
+        self.sample_lines = sample_lines
+        self.counts: Counter = Counter()
+        self.backend_time = 0.0
+        # When set, every detected (path, code block text, language) is appended
+        # so that worker processes can report them back, see `merge`
+        self.log: Optional[List[Tuple[str, str, str]]] = None
+        # A backend call which ran over its time budget and is still running
+        self._pending: Optional[threading.Thread] = None
+        self._loaded = False
+
+    def __call__(self, code_block_text: str) -> str:
+        language = self.resolve(code_block_text)
+        if language is None:
+            sample = self._sample(code_block_text)
+            language = self._call_backend(self.backend.detect, sample, 1)
+            if language is None:
+                language = self.fallback.detect(sample)
+                self._count("degraded", code_block_text, language)
+            else:
+                self._record(code_block_text, language)
+
+        return language
+
+    def resolve(self, code_block_text: str) -> Optional[str]:
+        """Returns the language of a code block if it does not need the backend."""
+        if self.heuristics:
+            language = heuristic_language(
+                code_block_text, None if self.heuristics is True else self.heuristics
+            )
+            if language is not None:
+                self._count("heuristic", code_block_text, language)
+                return language
+
+        if self.cache is not None:
+            language = self.cache.get(code_block_text)
+            if language is not None:
+                self._count("cache", code_block_text, language)
+                return language
+
+        return None
+
+    def classify(self, code_block_texts: Sequence[str]) -> List[str]:
+        """Detects the languages of code blocks with one backend call.
+
+        The code blocks should already have been passed to `resolve`.
+        """
+        samples = [
+            self._sample(code_block_text) for code_block_text in code_block_texts
+        ]
+        languages = self._call_backend(self.backend.detect_many, samples, len(samples))
+        if languages is None:
+            languages = self.fallback.detect_many(samples)
+            for code_block_text, language in zip(code_block_texts, languages):
+                self._count("degraded", code_block_text, language)
         else:
-            if consecutive_backticks == CODE_BLOCK_BACKTICK_COUNT:
-                in_code_block = not in_code_block
+            for code_block_text, language in zip(code_block_texts, languages):
+                self._record(code_block_text, language)
+
+        return languages
+
+    def settings(self) -> Dict[str, Any]:
+        """Returns the arguments creating a detector with the same settings,
+        except for the cache."""
+        return {
+            "heuristics": self.heuristics,
+            "backend": self.backend,
+            "deadline": self.deadline,
+            "block_time_budget": self.block_time_budget,
+            "fallback": self.fallback,
+            "sample_lines": self.sample_lines,
+        }
+
+    def _sample(self, code_block_text: str) -> str:
+        if self.sample_lines is None:
+            return code_block_text
 
-                if in_code_block:
-                    code_block_start_idx = modified_text_idx
-                else:
-                    if not skip_addition:
-                        # Remove the closing backticks
-                        code_block_text = code_block_text[
-                            : len(code_block_text) - CODE_BLOCK_BACKTICK_COUNT
-                        ]
+        return sample_code_block(code_block_text, self.sample_lines)
 
-                        lang = guess.language_name(code_block_text).lower()
-                        modified_text = (
-                            modified_text[:code_block_start_idx]
-                            + lang
-                            + modified_text[code_block_start_idx:]
-                        )
-                        # Need to update the position since we are inserting new characters
-                        modified_text_idx += len(lang)
+    def _call_backend(self, method: Callable, argument: Any, blocks: int) -> Any:
+        """Calls a backend method within the time budget.
 
-                    skip_addition = False
-                    code_block_text = ""
+        Returns None if the time budget has run out.
+        """
+        if self.deadline is not None and time.time() >= self.deadline:
+            return None
+        # The backend cannot be interrupted, so wait for a call that ran over its
+        # budget to finish before starting another one
+        if self._pending is not None and self._pending.is_alive():
+            return None
 
-            consecutive_backticks = 0
+        # The model is loaded outside of the budget of the first code block
+        if not self._loaded:
+            self.backend.load()
+            self._loaded = True
 
-        if in_code_block:
-            code_block_text += c
+        timeout = None
+        if self.block_time_budget is not None:
+            timeout = self.block_time_budget * blocks
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            timeout = remaining if timeout is None else min(timeout, remaining)
 
-        modified_text += c
-        text_idx += 1
-        modified_text_idx += 1
+        start = time.perf_counter()
+        try:
+            if timeout is None:
+                return method(argument)
+            if timeout <= 0:
+                return None
 
-    return modified_text
+            result = []
+
+            def run() -> None:
+                try:
+                    result.append((True, method(argument)))
+                except BaseException as e:
+                    result.append((False, e))
+
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(timeout)
+            if thread.is_alive():
+                self._pending = thread
+                return None
+
+            success, value = result[0]
+            if not success:
+                raise value
+            return value
+        finally:
+            self.backend_time += time.perf_counter() - start
+
+    def merge(
+        self, log: Sequence[Tuple[str, str, str]], backend_time: float = 0.0
+    ) -> None:
+        """Adds the code blocks detected by another detector.
+
+        Languages detected by the backend are recorded in the cache, and cached
+        languages are marked as recently used.
+
+        Parameters
+        ----------
+        log : Sequence[Tuple[str, str, str]]
+            The ``log`` of the other detector.
+        backend_time : float
+            The time the other detector spent in its backend, in seconds.
+        """
+        self.backend_time += backend_time
+        for path, code_block_text, language in log:
+            self._count(path, code_block_text, language)
+            if path in ("backend", "cache") and self.cache is not None:
+                if self.cache.get(code_block_text) is None:
+                    self.cache.set(code_block_text, language)
+
+    def _count(self, path: str, code_block_text: str, language: str) -> None:
+        self.counts[path] += 1
+        if self.log is not None:
+            self.log.append((path, code_block_text, language))
+
+    def _record(self, code_block_text: str, language: str) -> None:
+        self._count("backend", code_block_text, language)
+        if self.cache is not None:
+            self.cache.set(code_block_text, language)
+
+    def summary(self) -> str:
+        """Describes how many code blocks were handled by each path, and how
+        fast the backend was."""
+        summary = (
+            f"{self.counts['heuristic']} by heuristics, "
+            f"{self.counts['cache']} from the cache, "
+            f"{self.counts['backend']} by {self.backend.name}"
+        )
+        if self.counts["backend"] > 0 and self.backend_time > 0:
+            summary += (
+                f" in {self.backend_time:.2f}s "
+                f"({self.backend_time / self.counts['backend'] * 1000:.1f}ms per "
+                f"code block, {self.counts['backend'] / self.backend_time:.1f} "
+                "code blocks/s)"
+            )
+        if self.counts["degraded"] > 0:
+            summary += (
+                f", {self.counts['degraded']} degraded to {self.fallback.name} "
+                "after running out of time"
+            )
+
+        return summary
+
+
+def find_untagged_code_blocks(text: str) -> List[str]:
+    """Returns the text inside every code block without a language.
+
+    Parameters
+    ----------
+    text : str
+        The text to search.
+
+    Returns
+    -------
+    List[str]
+        The texts of the code blocks, in the order they appear.
+    """
+    code_block_texts = []
+
+    def record(code_block_text: str) -> str:
+        code_block_texts.append(code_block_text)
+        return ""
+
+    process_note(text, record)
+    return code_block_texts
+
+
+def process_note_file(
+    filepath: str,
+    detector: Callable[[str], str],
+    state: Optional[RunState] = None,
+) -> bool:
+    """Adds the language to the code blocks of a note.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the Markdown file.
+    detector : Callable[[str], str]
+        Returns the language of the text inside a code block.
+    state : Optional[RunState]
+        Records the processed notes. Notes which it already recorded with the
+        same transform are skipped.
+
+    Returns
+    -------
+    bool
+        Whether a language was added. The note is only written in that case.
+    """
+    return markdown_pipeline.process_note_file(
+        filepath, [AddLanguageTransform(detector)], state
+    )
+
+
+# The detector of each worker process, which loads its own model
+_worker_detector: Optional[LanguageDetector] = None
+
+
+def _init_worker(
+    cache_filename: Optional[str],
+    model_version: Optional[str],
+    settings: Dict[str, Any],
+    daemon: bool,
+) -> None:
+    global _worker_detector, use_daemon
+
+    # Spawned workers do not inherit the setting of the command line
+    use_daemon = daemon
+
+    # Forked workers would otherwise share the connection of the parent
+    reset_daemon()
+
+    cache = None
+    if cache_filename is not None:
+        cache = LanguageCache(cache_filename, model_version, readonly=True)
+
+    _worker_detector = LanguageDetector(cache, **settings)
+
+
+def _process_note_task(
+    filepath: str,
+) -> Tuple[str, bool, List[Tuple[str, str, str]], float]:
+    _worker_detector.log = []
+    _worker_detector.backend_time = 0.0
+    modified = process_note_file(filepath, _worker_detector)
+    return filepath, modified, _worker_detector.log, _worker_detector.backend_time
+
+
+def process_notes(
+    directory: str,
+    detector: LanguageDetector,
+    jobs: int = 1,
+    max_tasks_per_worker: int = DEFAULT_MAX_TASKS_PER_WORKER,
+    include: Optional[Sequence[str]] = None,
+    exclude: Sequence[str] = (),
+    state: Optional[RunState] = None,
+    io_threads: int = DEFAULT_IO_THREADS,
+) -> None:
+    """Adds the language to the code blocks of every note, one block at a time.
+
+    The notes are processed in the same order, with the same results, regardless
+    of the number of jobs. With a single job, the notes are read and written by
+    I/O threads while others are processed, see `markdown_pipeline.process_files`.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory containing Markdown files.
+    detector : LanguageDetector
+        Detects the languages of the code blocks. With more than one job, the
+        workers use their own detectors with the same cache and settings, and
+        their detections are merged into it.
+    jobs : int
+        The number of worker processes to use. 1 processes the notes in the
+        current process and 0 uses one worker per CPU.
+    max_tasks_per_worker : int
+        The number of notes processed by a worker before it is replaced.
+    include : Optional[Sequence[str]]
+        Glob patterns of the notes to process, see `markdown_pipeline.find_notes`.
+    exclude : Sequence[str]
+        Glob patterns of the files and directories to skip.
+    state : Optional[RunState]
+        Records the processed notes so that later runs skip them. It is only
+        used by this process, the workers do not open it.
+    io_threads : int
+        The number of threads reading and writing notes with a single job.
+    """
+    filepaths = find_notes(directory, include, exclude)
+
+    if jobs == 1:
+        for filepath, modified in process_files(
+            filepaths,
+            NoteTransformer([AddLanguageTransform(detector)]),
+            state,
+            io_threads=io_threads,
+        ):
+            if modified:
+                print(f"Processed: {filepath}")
+        return
+
+    if state is not None:
+        # The pool consumes the paths in another thread, which cannot use the
+        # SQLite connection of the state
+        filepaths = [filepath for filepath in filepaths if state.pending(filepath)]
+
+    cache = detector.cache
+    pool = multiprocessing.Pool(
+        jobs or None,
+        _init_worker,
+        (
+            cache.filename if cache is not None else None,
+            cache.model_version if cache is not None else None,
+            detector.settings(),
+            use_daemon,
+        ),
+        max_tasks_per_worker,
+    )
+    try:
+        for filepath, modified, log, backend_time in pool.imap(
+            _process_note_task, filepaths
+        ):
+            detector.merge(log, backend_time)
+            if state is not None:
+                degraded = any(path == "degraded" for path, _, _ in log)
+                incomplete = [AddLanguageTransform.name] if degraded else []
+                with open(filepath, "rb") as file:
+                    state.record(filepath, file.read(), modified, None, incomplete)
+                if modified:
+                    state.written(filepath)
+            if modified:
+                print(f"Processed: {filepath}")
+    finally:
+        pool.terminate()
+
+
+def process_notes_batched(
+    directory: str,
+    detector: LanguageDetector,
+    batch_size: int,
+    include: Optional[Sequence[str]] = None,
+    exclude: Sequence[str] = (),
+    io_threads: int = DEFAULT_IO_THREADS,
+) -> None:
+    """Adds the language to the code blocks of every note in two phases.
+
+    The code blocks without a language are first collected from every note, and
+    then classified in batches with one model call per batch. Identical code
+    blocks are only classified once. Finally the languages are written back to
+    the notes. The notes are read and written by I/O threads, see
+    `markdown_pipeline.process_files`.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory containing Markdown files.
+    detector : LanguageDetector
+        Detects the languages of the code blocks. Only the code blocks which
+        cannot be resolved without the model are classified in batches.
+    batch_size : int
+        The maximum number of code blocks classified with one model call.
+    include : Optional[Sequence[str]]
+        Glob patterns of the notes to process, see `markdown_pipeline.find_notes`.
+    exclude : Sequence[str]
+        Glob patterns of the files and directories to skip.
+    io_threads : int
+        The number of threads reading and writing notes.
+    """
+    filepaths = []
+    # Dictionaries preserve insertion order, so the code blocks are classified
+    # in a deterministic order
+    languages: Dict[str, str] = {}
+    # Whether each note read has code blocks without a language, in the order
+    # the notes are yielded
+    untagged: Deque[bool] = deque()
+
+    def collect(data: bytes) -> bytes:
+        text = data.decode(NOTE_ENCODING, NOTE_ENCODING_ERRORS)
+        code_block_texts = find_untagged_code_blocks(text) if has_fences(text) else []
+        untagged.append(len(code_block_texts) > 0)
+        languages.update(dict.fromkeys(code_block_texts, ""))
+        # Nothing is written while collecting
+        return data
+
+    for filepath, _ in process_files(
+        find_notes(directory, include, exclude), collect, io_threads=io_threads
+    ):
+        if untagged.popleft():
+            filepaths.append(filepath)
+
+    print(
+        f"Found {len(languages)} unique code blocks without a language in "
+        f"{len(filepaths)} notes"
+    )
+
+    unresolved_texts = []
+    for code_block_text in languages:
+        language = detector.resolve(code_block_text)
+        if language is None:
+            unresolved_texts.append(code_block_text)
+        else:
+            languages[code_block_text] = language
+
+    for start in range(0, len(unresolved_texts), batch_size):
+        batch = unresolved_texts[start : start + batch_size]
+        languages.update(zip(batch, detector.classify(batch)))
+        print(f"Classified: {start + len(batch)}/{len(unresolved_texts)} code blocks")
+
+    for filepath, modified in process_files(
+        filepaths,
+        # Code blocks added to a note after it was collected are left as is
+        NoteTransformer([AddLanguageTransform(lambda text: languages.get(text, ""))]),
+        io_threads=io_threads,
+    ):
+        if modified:
+            print(f"Processed: {filepath}")
+
+
+def create_backend(name: str, tflite_model: str) -> LanguageBackend:
+    """Creates the backend with a name in `BACKENDS`."""
+    if name == TFLiteBackend.name:
+        return TFLiteBackend(tflite_model)
+
+    return BACKENDS[name]()
+
+
+def _create_backend(
+    parser: argparse.ArgumentParser, name: str, tflite_model: str
+) -> LanguageBackend:
+    try:
+        return create_backend(name, tflite_model)
+    except FileNotFoundError as e:
+        parser.error(
+            f"{e.filename} not found, export the model first with "
+            "add_code_block_language.py --export-tflite"
+        )
+
+
+def add_detector_arguments(parser: argparse.ArgumentParser) -> None:
+    """Adds the options configuring the detector created by `create_detector`."""
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help="Backend used to detect the languages: guesslang is the most "
+        "accurate, tflite runs a quantized guesslang model, pygments is much "
+        "faster but less accurate, heuristic only detects obvious code blocks, "
+        "and none detects nothing (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--tflite-model",
+        metavar="FILE",
+        default=DEFAULT_TFLITE_MODEL,
+        help="TensorFlow Lite model used by the tflite backend "
+        "(default: guesslang.tflite next to add_code_block_language.py)",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="SQLite file caching the detected languages across runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="Maximum number of code blocks kept in the cache, evicting the "
+        "least recently used (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        metavar="SECONDS",
+        help="Maximum time for the whole run, after which the remaining code "
+        "blocks are detected with the fallback backend",
+    )
+    parser.add_argument(
+        "--block-time-budget",
+        type=float,
+        metavar="SECONDS",
+        help="Maximum time to wait for the backend per code block, after which "
+        "the code block is detected with the fallback backend",
+    )
+    parser.add_argument(
+        "--fallback",
+        choices=BACKENDS,
+        default=DEFAULT_FALLBACK_BACKEND,
+        help="Backend used once the time budget has run out, none leaves the "
+        "code blocks without a language (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--sample-lines",
+        type=int,
+        default=DEFAULT_SAMPLE_LINES,
+        help="Code blocks with more lines, such as pasted logs, are classified "
+        "from their first lines and a slice from their middle, 0 classifies "
+        "whole code blocks (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        dest="use_daemon",
+        action="store_false",
+        help="Always load the model instead of using a running daemon",
+    )
+    parser.add_argument(
+        "--no-heuristics",
+        dest="heuristics",
+        action="store_false",
+        help="Detect every code block with the model, including obvious ones "
+        "such as scripts with a shebang line or JSON",
+    )
+    parser.add_argument(
+        "--heuristic-languages",
+        dest="heuristics",
+        type=parse_heuristic_languages,
+        metavar="LANGUAGE[,LANGUAGE]",
+        help="Comma-separated languages detected without the model when the "
+        f"code block is obvious, among {', '.join(HEURISTIC_LANGUAGES)} "
+        "(default: all of them)",
+    )
+
+
+def create_detector(
+    parser: argparse.ArgumentParser, args: argparse.Namespace
+) -> LanguageDetector:
+    """Creates the detector configured by the options of `add_detector_arguments`.
+
+    Invalid options are reported with ``parser.error``. The time budget starts
+    now, and `use_daemon` is set for the whole module.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        The parser the options were added to.
+    args : argparse.Namespace
+        The parsed options.
+
+    Returns
+    -------
+    LanguageDetector
+        The detector, with its cache if one was given. The caller saves and
+        closes the cache.
+    """
+    global use_daemon
+
+    if args.cache_size < 0:
+        parser.error("--cache-size must not be negative")
+    if args.time_budget is not None and args.time_budget < 0:
+        parser.error("--time-budget must not be negative")
+    if args.block_time_budget is not None and args.block_time_budget <= 0:
+        parser.error("--block-time-budget must be positive")
+    if args.sample_lines < 0:
+        parser.error("--sample-lines must not be negative")
+
+    use_daemon = args.use_daemon
+    backend = _create_backend(parser, args.backend, args.tflite_model)
+    fallback = _create_backend(parser, args.fallback, args.tflite_model)
+
+    cache = None
+    if args.cache is not None:
+        cache = LanguageCache(args.cache, backend.version(), args.cache_size)
+
+    deadline = None
+    if args.time_budget is not None:
+        deadline = time.time() + args.time_budget
+
+    return LanguageDetector(
+        cache,
+        args.heuristics,
+        backend,
+        deadline,
+        args.block_time_budget,
+        fallback,
+        args.sample_lines or None,
+    )
+
+
+def serve(backend: LanguageBackend, address: str) -> None:
+    """Runs a language detection daemon until it is interrupted.
+
+    Parameters
+    ----------
+    backend : LanguageBackend
+        Detects the languages of the code blocks. It is loaded before the
+        daemon starts listening.
+    address : str
+        The ``host:port`` address to listen on, or ``-`` to answer requests from
+        stdin on stdout.
+    """
+    # The daemon must not forward requests to another daemon
+    global use_daemon
+    use_daemon = False
+
+    backend.load()
+    if address == "-":
+        serve_stream(backend, sys.stdin.buffer, sys.stdout.buffer)
+        return
+
+    with LanguageDaemon(address, backend) as daemon:
+        print(f"Serving {backend.version()} on {address}", flush=True)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "directory", help="Path to the directory containing Markdown files"
+        "directory",
+        nargs="?",
+        help="Path to the directory containing Markdown files",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Collect the code blocks of every note first and classify them in "
+        "batches, which is much faster for large numbers of code blocks",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of code blocks classified at once with --batch "
+        "(default: %(default)s)",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used to process notes in parallel, 0 "
+        "uses one per CPU (default: 1). Each worker loads its own model",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=DEFAULT_IO_THREADS,
+        help="Number of threads reading and writing notes while others are "
+        "processed, without --jobs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-tasks-per-worker",
+        type=int,
+        default=DEFAULT_MAX_TASKS_PER_WORKER,
+        help="Number of notes processed by a worker before it is replaced to "
+        "release memory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--export-tflite",
+        metavar="FILE",
+        help="Convert the guesslang model to a quantized TensorFlow Lite model "
+        "for the tflite backend and exit",
+    )
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        const=os.environ.get(
+            DAEMON_ADDRESS_ENVIRONMENT_VARIABLE, DEFAULT_DAEMON_ADDRESS
+        ),
+        metavar="ADDRESS",
+        help="Run a daemon keeping the backend loaded, which later runs use for "
+        "guesslang detection when the "
+        f"{DAEMON_ADDRESS_ENVIRONMENT_VARIABLE} environment variable is set to "
+        "its address. Listens on host:port (default: the "
+        f"{DAEMON_ADDRESS_ENVIRONMENT_VARIABLE} environment variable or "
+        f"{DEFAULT_DAEMON_ADDRESS}), or on stdin/stdout with -",
+    )
+    parser.add_argument(
+        "--state",
+        metavar="FILE",
+        help="SQLite file recording the processed notes, so that later runs "
+        "only process new or modified notes, or every note when the backend "
+        "changes. It can be shared with fix_code_block_backslashes.py and "
+        "postprocess_notes.py",
+    )
+    add_detector_arguments(parser)
+    add_scan_arguments(parser)
     args = parser.parse_args()
 
-    for root, dirs, files in os.walk(args.directory):
-        for filename in files:
-            if filename.endswith(".md"):
-                filepath = os.path.join(root, filename)
-                with open(filepath, "r", encoding="utf-8", errors="ignore") as file:
-                    text = file.read()
+    if args.export_tflite is not None:
+        export_tflite_model(args.export_tflite)
+        print(f"Exported: {args.export_tflite}")
+        return
 
-                modified_text = process_note(text)
+    if args.serve is not None:
+        serve(_create_backend(parser, args.backend, args.tflite_model), args.serve)
+        return
+    if args.directory is None:
+        parser.error("the following arguments are required: directory")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.jobs < 0:
+        parser.error("--jobs must not be negative")
+    if args.io_threads < 1:
+        parser.error("--io-threads must be at least 1")
+    if args.max_tasks_per_worker < 1:
+        parser.error("--max-tasks-per-worker must be at least 1")
+    if args.batch and args.jobs != 1:
+        parser.error("--batch cannot be combined with --jobs")
+    if args.batch and args.state is not None:
+        parser.error("--batch cannot be combined with --state")
 
-                with open(
-                    filepath, "w", encoding="utf-8", newline="\n", errors="ignore"
-                ) as file:
-                    file.write(modified_text)
+    detector = create_detector(parser, args)
+    cache = detector.cache
+    state = None
+    if args.state is not None:
+        state = RunState(args.state, [AddLanguageTransform(detector)])
 
-                print(f"Processed: {filepath}")
+    try:
+        if args.batch:
+            process_notes_batched(
+                args.directory,
+                detector,
+                args.batch_size,
+                args.include,
+                args.exclude,
+                args.io_threads,
+            )
+        else:
+            process_notes(
+                args.directory,
+                detector,
+                args.jobs,
+                args.max_tasks_per_worker,
+                args.include,
+                args.exclude,
+                state,
+                args.io_threads,
+            )
+    finally:
+        if cache is not None:
+            cache.save()
+            cache.close()
+        if state is not None:
+            state.save()
+            state.close()
 
+    if state is not None:
+        print(f"Skipped {state.skipped} notes which were already processed")
+    print(f"Detected languages: {detector.summary()}")
+    if cache is not None:
+        print(
+            f"Language cache: {cache.hits} hits, {cache.misses} misses "
+            f"({cache.hit_rate:.0%} hit rate)"
+        )
     print("Done!")
 
 
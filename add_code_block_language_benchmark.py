@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Benchmarks adding the language to notes with increasing numbers of code
+blocks to check that processing time grows linearly with the size of the note."""
+import argparse
+import time
+
+from add_code_block_language import process_note
+
+CODE_BLOCK: str = """Some text describing the code block below.
+```
+def main():
+    for i in range(10):
+        print(f"Hello, {i}!")
+```
+"""
+
+
+def detect_language(code_block_text: str) -> str:
+    """Stands in for the model so that only the rewriting is timed."""
+    return "python"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--blocks",
+        type=int,
+        default=250,
+        help="Number of code blocks in the smallest note (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=5,
+        help="Number of times the note size is doubled (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of timed runs per note size"
+    )
+    args = parser.parse_args()
+
+    for step in range(args.steps):
+        blocks = args.blocks * 2**step
+        text = CODE_BLOCK * blocks
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            process_note(text, detect_language)
+            timings.append(time.perf_counter() - start)
+
+        best = min(timings)
+        print(
+            f"{blocks} code blocks ({len(text)} characters) processed in "
+            f"{best:.4f}s, {best / blocks * 1e6:.2f}us per code block "
+            f"(best of {args.repeat})"
+        )
+
+
+if __name__ == "__main__":
+    main()
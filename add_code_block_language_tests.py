@@ -1,11 +1,76 @@
 #!/usr/bin/env python
 """Unit tests to exercise adding the language to code blocks."""
-import unittest
 
-from add_code_block_language import process_note
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import add_code_block_language
+from add_code_block_language import (
+    DEFAULT_TFLITE_MODEL,
+    AddLanguageTransform,
+    GuesslangBackend,
+    HeuristicBackend,
+    LanguageBackend,
+    LanguageCache,
+    LanguageDetector,
+    NoneBackend,
+    PygmentsBackend,
+    TFLiteBackend,
+    find_untagged_code_blocks,
+    export_tflite_model,
+    heuristic_language,
+    parse_heuristic_languages,
+    predicted_languages,
+    process_note,
+    process_notes,
+    process_notes_batched,
+    reset_daemon,
+    sample_code_block,
+)
+from language_daemon import DAEMON_ADDRESS_ENVIRONMENT_VARIABLE
+from language_daemon_tests import start_daemon
+from markdown_pipeline import RunState
+
+try:
+    import numpy as np
+except ImportError:  # Installed with TensorFlow
+    np = None
+
+
+class FakeBackend(LanguageBackend):
+    name = "fake"
+
+    def __init__(self):
+        self.detected = []
+
+    def detect(self, code_block_text):
+        self.detected.append(code_block_text)
+        return "python"
+
+
+class SlowBackend(FakeBackend):
+    name = "slow"
+
+    def detect(self, code_block_text):
+        time.sleep(0.2)
+        return super().detect(code_block_text)
 
 
 class TestProcessNote(unittest.TestCase):
+    def test_no_code_block(self):
+        input = """
+        text outside of code block
+        `inline code`
+        """
+
+        self.assertEqual(process_note(input), input)
+
     def test_single_code_block(self):
         input = """
         ```
@@ -541,5 +606,609 @@ class TestProcessNote(unittest.TestCase):
         self.assertEqual(process_note(input), output)
 
 
+@unittest.skipUnless(
+    os.path.exists(f"{DEFAULT_TFLITE_MODEL}.json"),
+    "export the model with add_code_block_language.py --export-tflite",
+)
+class TestProcessNoteTFLite(TestProcessNote):
+    """Checks that the TensorFlow Lite model detects the same languages."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = TFLiteBackend()
+
+    def setUp(self):
+        patcher = mock.patch(
+            f"{__name__}.process_note",
+            lambda text: add_code_block_language.process_note(
+                text, self.backend.detect
+            ),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestFindUntaggedCodeBlocks(unittest.TestCase):
+    def test_code_blocks(self):
+        input = """
+```
+x = 5
+```
+```rust
+let x = 5;
+```
+```
+y = 6
+```
+"""
+
+        self.assertEqual(find_untagged_code_blocks(input), ["\nx = 5\n", "\ny = 6\n"])
+
+    def test_tilde_and_longer_fences(self):
+        input = """
+~~~
+x = 5
+~~~
+````
+```
+y = 6
+```
+````
+"""
+
+        self.assertEqual(
+            find_untagged_code_blocks(input), ["\nx = 5\n", "\n```\ny = 6\n```\n"]
+        )
+
+    def test_detected_languages(self):
+        input = """
+```
+x = 5
+```
+"""
+        languages = {text: "python" for text in find_untagged_code_blocks(input)}
+
+        self.assertEqual(
+            process_note(input, languages.__getitem__),
+            input.replace("```\nx", "```python\nx"),
+        )
+
+
+class TestLanguageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filename = os.path.join(self.tmp.name, "languages.sqlite")
+
+    def open(self, model_version="model 1", max_entries=100):
+        cache = LanguageCache(self.filename, model_version, max_entries)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_persists_languages(self):
+        cache = self.open()
+        cache.set("x = 5\n", "python")
+        cache.save()
+        cache.close()
+
+        cache = self.open()
+
+        self.assertEqual(cache.get("x = 5\n"), "python")
+        self.assertIsNone(cache.get("y = 6\n"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+    def test_ignores_trailing_whitespace(self):
+        cache = self.open()
+        cache.set("\nx = 5\n", "python")
+
+        self.assertEqual(cache.get("x = 5  \r\n"), "python")
+
+    def test_model_version_change_invalidates_entries(self):
+        cache = self.open()
+        cache.set("x = 5", "python")
+        cache.save()
+        cache.close()
+
+        self.assertIsNone(self.open("model 2").get("x = 5"))
+
+    def test_evicts_least_recently_used(self):
+        cache = self.open(max_entries=2)
+        cache.set("a", "python")
+        cache.set("b", "rust")
+        cache.set("c", "html")
+        cache.get("a")
+        cache.save()
+
+        self.assertEqual(cache.get("a"), "python")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "html")
+
+
+class TestHeuristicLanguage(unittest.TestCase):
+    def test_obvious_code_blocks(self):
+        code_blocks = {
+            "\n#!/usr/bin/env python3\nprint(1)\n": "python",
+            "#!/bin/bash\necho hi": "shell",
+            '<?xml version="1.0"?>\n<a/>': "xml",
+            "<!DOCTYPE html>\n<html></html>": "html",
+            "#include <iostream>\nint main() {}": "c++",
+            "#include <stdio.h>\nint main() {}": "c",
+            "select id\nfrom users;": "sql",
+            "SELECT name, age FROM users WHERE age > 18": "sql",
+            "select count(*) from users;": "sql",
+            "delete from users where id = 1": "sql",
+            "Get-ChildItem -Path .": "powershell",
+            "Get-Process | Stop-Process": "powershell",
+            '{"name": "John", "age": 30}': "json",
+        }
+
+        for code_block_text, language in code_blocks.items():
+            with self.subTest(code_block_text=code_block_text):
+                self.assertEqual(heuristic_language(code_block_text), language)
+
+    def test_ambiguous_code_blocks(self):
+        for code_block_text in [
+            "x = 5",
+            "{ x = 5; }",
+            "#!/bin/unknown",
+            "selected",
+            "Select the file from the menu",
+            "Delete from the list",
+            "Create table of contents",
+            "Set-Cookie: id=1",
+            "Test-Driven development",
+            '#include "stdafx.h"\nclass Window {};',
+            "#include <stdio.h>\nclass Window {};",
+        ]:
+            with self.subTest(code_block_text=code_block_text):
+                self.assertIsNone(heuristic_language(code_block_text))
+
+    def test_selected_languages(self):
+        self.assertEqual(heuristic_language("#!/bin/sh\nls", ["shell"]), "shell")
+        self.assertIsNone(heuristic_language("#!/bin/sh\nls", ["python", "json"]))
+
+    def test_parse_heuristic_languages(self):
+        self.assertEqual(parse_heuristic_languages("shell,json"), ["shell", "json"])
+        self.assertEqual(parse_heuristic_languages(""), [])
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_heuristic_languages("shell,rust")
+
+
+class TestLanguageDetector(unittest.TestCase):
+    def test_counts_paths(self):
+        backend = FakeBackend()
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = LanguageCache(os.path.join(tmp, "languages.sqlite"), "model 1")
+            self.addCleanup(cache.close)
+            detector = LanguageDetector(cache, backend=backend)
+
+            self.assertEqual(detector("x = 5"), "python")
+            self.assertEqual(detector("x = 5"), "python")
+            self.assertEqual(detector("#!/bin/sh\nls"), "shell")
+
+        self.assertEqual(backend.detected, ["x = 5"])
+        self.assertEqual(detector.counts, {"heuristic": 1, "cache": 1, "backend": 1})
+        self.assertIn("1 by fake in", detector.summary())
+
+    def test_selected_heuristics(self):
+        detector = LanguageDetector(heuristics=["json"], backend=FakeBackend())
+
+        self.assertIsNone(detector.resolve("#!/bin/sh\nls"))
+        self.assertEqual(detector.resolve("[1, 2]"), "json")
+
+    def test_without_heuristics(self):
+        detector = LanguageDetector(heuristics=False, backend=FakeBackend())
+
+        self.assertIsNone(detector.resolve("#!/bin/sh\nls"))
+        self.assertEqual(detector.classify(["#!/bin/sh\nls"]), ["python"])
+        self.assertEqual(detector.counts, {"backend": 1})
+
+    def test_block_time_budget(self):
+        backend = SlowBackend()
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = LanguageCache(os.path.join(tmp, "languages.sqlite"), "model 1")
+            self.addCleanup(cache.close)
+            detector = LanguageDetector(
+                cache, backend=backend, block_time_budget=0.01, fallback=NoneBackend()
+            )
+
+            self.assertEqual(detector("x = 5"), "")
+            # The backend is still busy with the first code block
+            self.assertEqual(detector("y = 6"), "")
+            self.assertEqual(detector.classify(["z = 7"]), [""])
+            time.sleep(0.3)
+
+            self.assertIsNone(cache.get("x = 5"))
+        self.assertEqual(backend.detected, ["x = 5"])
+        self.assertEqual(detector.counts, {"degraded": 3})
+        self.assertIn("3 degraded to none", detector.summary())
+
+    def test_time_budget(self):
+        backend = FakeBackend()
+        detector = LanguageDetector(backend=backend, deadline=time.time() + 60)
+
+        self.assertEqual(detector("x = 5"), "python")
+        detector.deadline = time.time() - 1
+        self.assertEqual(detector("#!/bin/sh\nls"), "shell")
+        self.assertEqual(detector("y = 6"), "")
+
+        self.assertEqual(backend.detected, ["x = 5"])
+        self.assertEqual(detector.counts, {"backend": 1, "heuristic": 1, "degraded": 1})
+
+    def test_samples_large_code_blocks(self):
+        backend = FakeBackend()
+        detector = LanguageDetector(backend=backend, sample_lines=4)
+        code_block_text = "\n".join(str(i) for i in range(100))
+
+        self.assertEqual(detector(code_block_text), "python")
+        self.assertEqual(detector.classify([code_block_text]), ["python"])
+
+        self.assertEqual(backend.detected, ["0\n1\n2\n49"] * 2)
+
+
+class TestSampleCodeBlock(unittest.TestCase):
+    def test_small_code_block(self):
+        self.assertEqual(sample_code_block("a\nb\nc", 3), "a\nb\nc")
+
+    def test_large_code_block(self):
+        code_block_text = "\n".join(str(i) for i in range(1000))
+
+        self.assertEqual(
+            sample_code_block(code_block_text, 8), "0\n1\n2\n3\n4\n5\n499\n500"
+        )
+
+    def test_slices_do_not_overlap(self):
+        self.assertEqual(sample_code_block("a\nb\nc\nd\ne", 4), "a\nb\nc\nd")
+
+
+class TestPredictedLanguages(unittest.TestCase):
+    def test_reliable_prediction(self):
+        scores = [[0.01] * 9 + [0.91], [0.1] * 10]
+        classes = [[b"c"] * 9 + [b"rs"], [b"rs"] * 10]
+
+        self.assertEqual(
+            predicted_languages(scores, classes, {"c": "C", "rs": "Rust"}),
+            ["rust", ""],
+        )
+
+
+class StubSignatureRunner:
+    """Stands in for the signature runner of the TensorFlow Lite model, which
+    predicts Rust for code blocks containing ``fn`` and is unsure otherwise."""
+
+    def __init__(self):
+        self.inputs = []
+
+    def get_input_details(self):
+        return {"input_1": {"dtype": object, "shape": [-1]}}
+
+    def __call__(self, **inputs):
+        self.inputs.append(inputs)
+        scores = [
+            [0.01] * 9 + [0.91] if "fn" in text else [0.1] * 10
+            for text in inputs["input_1"]
+        ]
+        return {
+            "scores": np.array(scores, dtype=np.float32),
+            "classes": np.array([[b"c"] * 9 + [b"rs"]] * len(scores), dtype=object),
+        }
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestTFLiteBackend(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, "guesslang.tflite")
+        with open(f"{self.filename}.json", "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "version": "guesslang 2.2.1 tflite",
+                    "extensions": {"c": "C", "rs": "Rust"},
+                },
+                file,
+            )
+
+        self.runner = StubSignatureRunner()
+        self.interpreter = mock.Mock()
+        self.interpreter.return_value.get_signature_runner.return_value = self.runner
+        tensorflow = mock.Mock()
+        tensorflow.lite.Interpreter = self.interpreter
+        patcher = mock.patch.dict(sys.modules, {"tensorflow": tensorflow})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_version(self):
+        self.assertEqual(
+            TFLiteBackend(self.filename).version(), "guesslang 2.2.1 tflite"
+        )
+
+    def test_load(self):
+        backend = TFLiteBackend(self.filename)
+        backend.load()
+        backend.load()
+
+        self.interpreter.assert_called_once_with(model_path=self.filename)
+        self.interpreter.return_value.get_signature_runner.assert_called_once_with(
+            "serving_default"
+        )
+        self.assertEqual(backend._input_name, "input_1")
+
+    def test_detect_many(self):
+        backend = TFLiteBackend(self.filename)
+
+        self.assertEqual(
+            backend.detect_many(["fn main() {}", " \n", "x = 5"]), ["rust", "", ""]
+        )
+        # Empty code blocks are not passed to the model
+        (inputs,) = self.runner.inputs
+        self.assertEqual(list(inputs), ["input_1"])
+        self.assertEqual(inputs["input_1"].dtype, object)
+        self.assertEqual(inputs["input_1"].tolist(), ["fn main() {}", "x = 5"])
+
+    def test_detect(self):
+        backend = TFLiteBackend(self.filename)
+
+        self.assertEqual(backend.detect("fn main() {}"), "rust")
+        self.assertEqual(backend.detect(""), "")
+        self.assertEqual(len(self.runner.inputs), 1)
+
+    def test_pickled_without_interpreter(self):
+        backend = TFLiteBackend(self.filename)
+        backend.load()
+
+        self.assertIsNone(backend.__getstate__()["_runner"])
+
+
+class TestExportTFLiteModel(unittest.TestCase):
+    def test_export(self):
+        tensorflow = mock.Mock()
+        converter = tensorflow.lite.TFLiteConverter.from_concrete_functions.return_value
+        converter.convert.return_value = b"model"
+        guess = mock.MagicMock(_extension_map={"rs": "Rust"})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "guesslang.tflite")
+            with mock.patch.dict(sys.modules, {"tensorflow": tensorflow}):
+                with mock.patch.multiple(
+                    add_code_block_language,
+                    get_guess=lambda: guess,
+                    model_version=lambda: "guesslang 2.2.1",
+                ):
+                    export_tflite_model(filename)
+
+            with open(filename, "rb") as file:
+                self.assertEqual(file.read(), b"model")
+            with open(f"{filename}.json", encoding="utf-8") as file:
+                self.assertEqual(
+                    json.load(file),
+                    {
+                        "version": "guesslang 2.2.1 tflite",
+                        "extensions": {"rs": "Rust"},
+                    },
+                )
+
+        tensorflow.lite.TFLiteConverter.from_concrete_functions.assert_called_once_with(
+            [guess._model.signatures["serving_default"]]
+        )
+        self.assertEqual(converter.optimizations, [tensorflow.lite.Optimize.DEFAULT])
+        self.assertEqual(
+            converter.target_spec.supported_ops,
+            [
+                tensorflow.lite.OpsSet.TFLITE_BUILTINS,
+                tensorflow.lite.OpsSet.SELECT_TF_OPS,
+            ],
+        )
+
+
+class TestBackends(unittest.TestCase):
+    def test_heuristic(self):
+        backend = HeuristicBackend()
+
+        self.assertEqual(backend.detect_many(["#!/bin/sh\nls", "x = 5"]), ["shell", ""])
+
+    def test_none(self):
+        self.assertEqual(NoneBackend().detect("#!/bin/sh\nls"), "")
+
+    def test_pygments(self):
+        backend = PygmentsBackend()
+
+        self.assertEqual(backend.detect("#include <stdio.h>\nint main() {}\n"), "c")
+        self.assertEqual(backend.detect("hello world"), "")
+        self.assertEqual(backend.detect(" \n"), "")
+
+
+class TestProcessNotes(unittest.TestCase):
+    def test_parallel_and_batched_match_sequential(self):
+        notes = {
+            "a.md": "text\n```\n#!/bin/sh\nls\n```\n",
+            "b.md": "```\nx = 5\n```\n```\n[1, 2]\n```\n```\ny = 6\n```\n",
+            "c.md": "no code blocks\n",
+        }
+
+        with tempfile.TemporaryDirectory() as tmp:
+            outputs = {}
+            counts = {}
+            for jobs in [1, 2, "batch"]:
+                directory = os.path.join(tmp, str(jobs))
+                os.mkdir(directory)
+                for name, text in notes.items():
+                    with open(os.path.join(directory, name), "w") as file:
+                        file.write(text)
+
+                cache = LanguageCache(
+                    os.path.join(directory, "languages.sqlite"), "model 1"
+                )
+                self.addCleanup(cache.close)
+                cache.set("x = 5", "python")
+                cache.save()
+                detector = LanguageDetector(cache, backend=NoneBackend())
+
+                if jobs == "batch":
+                    process_notes_batched(directory, detector, 2, io_threads=2)
+                else:
+                    process_notes(
+                        directory, detector, jobs, max_tasks_per_worker=1, io_threads=2
+                    )
+
+                outputs[jobs] = {}
+                for name in notes:
+                    with open(os.path.join(directory, name)) as file:
+                        outputs[jobs][name] = file.read()
+                counts[jobs] = detector.counts
+
+        self.assertEqual(outputs[1]["a.md"], "text\n```shell\n#!/bin/sh\nls\n```\n")
+        self.assertEqual(outputs[2], outputs[1])
+        self.assertEqual(outputs["batch"], outputs[1])
+        self.assertEqual(counts[1], {"heuristic": 2, "cache": 1, "backend": 1})
+        self.assertEqual(counts[2], counts[1])
+        self.assertEqual(counts["batch"], counts[1])
+
+    def test_batched_note_modified_after_collecting(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filepath = os.path.join(tmp, "page.md")
+            with open(filepath, "w") as file:
+                file.write("```\n#!/bin/sh\nls\n```\n")
+            detector = LanguageDetector(backend=NoneBackend())
+            resolve = detector.resolve
+
+            def resolve_and_modify(code_block_text):
+                with open(filepath, "a") as file:
+                    file.write("```\n[1, 2]\n```\n")
+                return resolve(code_block_text)
+
+            with mock.patch.object(detector, "resolve", resolve_and_modify):
+                process_notes_batched(tmp, detector, 2, io_threads=2)
+
+            with open(filepath) as file:
+                self.assertEqual(
+                    file.read(), "```shell\n#!/bin/sh\nls\n```\n```\n[1, 2]\n```\n"
+                )
+
+    def test_state(self):
+        for jobs in [1, 2]:
+            with self.subTest(jobs=jobs), tempfile.TemporaryDirectory() as tmp:
+                for name in ["a.md", "b.md"]:
+                    with open(os.path.join(tmp, name), "w") as file:
+                        file.write("```\n#!/bin/sh\nls\n```\n")
+                detector = LanguageDetector(backend=NoneBackend())
+                state = RunState(
+                    os.path.join(tmp, "state.sqlite"), [AddLanguageTransform(detector)]
+                )
+                self.addCleanup(state.close)
+                process_notes(tmp, detector, jobs, state=state)
+                with open(os.path.join(tmp, "a.md"), "w") as file:
+                    file.write("```\nx = 5\n```\n")
+
+                process_notes(tmp, detector, jobs, state=state)
+
+                self.assertEqual(state.skipped, 1)
+                self.assertEqual(detector.counts, {"heuristic": 2, "backend": 1})
+
+    def test_state_retries_degraded_notes(self):
+        for jobs in [1, 2]:
+            with self.subTest(jobs=jobs), tempfile.TemporaryDirectory() as tmp:
+                with open(os.path.join(tmp, "a.md"), "w") as file:
+                    file.write("```\nx = 5\n```\n")
+                with open(os.path.join(tmp, "b.md"), "w") as file:
+                    file.write("```\n#!/bin/sh\nls\n```\n")
+                state_filename = os.path.join(tmp, "state.sqlite")
+
+                for deadline in [time.time() - 1, None]:
+                    detector = LanguageDetector(
+                        backend=FakeBackend(), deadline=deadline, fallback=NoneBackend()
+                    )
+                    state = RunState(state_filename, [AddLanguageTransform(detector)])
+                    self.addCleanup(state.close)
+                    process_notes(tmp, detector, jobs, state=state)
+                    state.save()
+
+                # The note degraded by the first run is processed again
+                self.assertEqual(state.skipped, 1)
+                self.assertEqual(detector.counts, {"backend": 1})
+                with open(os.path.join(tmp, "a.md")) as file:
+                    self.assertEqual(file.read(), "```python\nx = 5\n```\n")
+
+
+class TestDaemon(unittest.TestCase):
+    def use_daemon(self, backend):
+        address = start_daemon(self, backend)
+        patcher = mock.patch.dict(
+            os.environ, {DAEMON_ADDRESS_ENVIRONMENT_VARIABLE: address}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        reset_daemon()
+        self.addCleanup(reset_daemon)
+
+    def test_uses_running_daemon(self):
+        backend = FakeBackend()
+        backend.version = lambda: "guesslang test"
+        self.use_daemon(backend)
+
+        self.assertEqual(process_note("```\nx = 5\n```\n"), "```python\nx = 5\n```\n")
+        self.assertEqual(add_code_block_language.detect_languages(["y"]), ["python"])
+        self.assertEqual(GuesslangBackend().version(), "guesslang test")
+        self.assertEqual(backend.detected, ["\nx = 5\n", "y"])
+
+    def test_ignores_daemon_of_other_backend(self):
+        self.use_daemon(HeuristicBackend())
+
+        self.assertIsNone(add_code_block_language.get_daemon())
+
+    def test_ignores_daemon_of_tflite_backend(self):
+        backend = FakeBackend()
+        backend.version = lambda: "guesslang 2.2.1 tflite"
+        self.use_daemon(backend)
+
+        self.assertIsNone(add_code_block_language.get_daemon())
+
+    def test_daemon_not_running(self):
+        with mock.patch.dict(
+            os.environ, {DAEMON_ADDRESS_ENVIRONMENT_VARIABLE: "127.0.0.1:1"}
+        ):
+            reset_daemon()
+            self.addCleanup(reset_daemon)
+
+            self.assertIsNone(add_code_block_language.get_daemon())
+
+    def test_daemon_address_not_set(self):
+        environ = {
+            name: value
+            for name, value in os.environ.items()
+            if name != DAEMON_ADDRESS_ENVIRONMENT_VARIABLE
+        }
+        with mock.patch.dict(os.environ, environ, clear=True):
+            with mock.patch.object(add_code_block_language, "DaemonClient") as client:
+                reset_daemon()
+                self.addCleanup(reset_daemon)
+
+                self.assertIsNone(add_code_block_language.get_daemon())
+        client.assert_not_called()
+
+    def test_daemon_disabled(self):
+        backend = FakeBackend()
+        backend.version = lambda: "guesslang test"
+        self.use_daemon(backend)
+
+        with mock.patch.object(add_code_block_language, "use_daemon", False):
+            self.assertIsNone(add_code_block_language.get_daemon())
+
+    def test_daemon_disabled_in_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch.object(add_code_block_language, "use_daemon", False):
+                with mock.patch("multiprocessing.Pool") as pool:
+                    pool.return_value.imap.return_value = []
+                    process_notes(tmp, LanguageDetector(backend=NoneBackend()), 2)
+
+                    # Spawned workers start with the default of the module
+                    add_code_block_language.use_daemon = True
+                    initializer, initargs = pool.call_args[0][1:3]
+                    initializer(*initargs)
+
+                    self.assertFalse(add_code_block_language.use_daemon)
+
+
 if __name__ == "__main__":
     unittest.main()
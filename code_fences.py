@@ -0,0 +1,138 @@
+"""Finds the fenced code blocks of Markdown notes without scanning them one
+character at a time."""
+import re
+from typing import AnyStr, Iterator, List, Match, NamedTuple, Pattern, Tuple, Union
+
+# A fence is a line made of optional indentation, at least three backticks or
+# tildes and an optional info string. Any indentation is allowed since code
+# blocks nested in lists are indented.
+FENCE_LINE_REGEX = re.compile(r"[ \t]*(`{3,}|~{3,})([^\n]*)")
+# Fences after the first line. Searching for the line break preceding them
+# rather than anchoring the pattern to line starts lets the regex engine skip
+# from one line break to the next, which is several times faster.
+NEXT_FENCE_LINE_REGEX = re.compile("\n" + FENCE_LINE_REGEX.pattern)
+FENCE_MARKERS = ("```", "~~~")
+# The same for UTF-8 encoded notes. Fences are ASCII, and the bytes of ASCII
+# characters never appear inside the encoding of other characters, so encoded
+# notes can be searched without decoding them.
+FENCE_LINE_BYTES_REGEX = re.compile(FENCE_LINE_REGEX.pattern.encode())
+NEXT_FENCE_LINE_BYTES_REGEX = re.compile(NEXT_FENCE_LINE_REGEX.pattern.encode())
+FENCE_BYTES_MARKERS = (b"```", b"~~~")
+
+
+class CodeBlock(NamedTuple):
+    """The position of a fenced code block in a note.
+
+    All positions are indexes into the text of the note, or into its bytes if
+    the note was given as bytes.
+    """
+
+    #: Index of the first character of the opening fence
+    start: int
+    #: Index after the last character of the closing fence, or the end of the
+    #: text if the code block is not closed
+    end: int
+    #: The info string following the opening fence, without surrounding spaces,
+    #: as bytes if the note was given as bytes
+    info: Union[str, bytes]
+    #: Index after the opening fence, where a language can be inserted
+    info_start: int
+    #: Index of the first line inside the code block
+    content_start: int
+    #: Index of the first character of the closing fence, or the end of the text
+    #: if the code block is not closed
+    content_end: int
+    #: Whether the code block has a closing fence
+    closed: bool
+
+
+def has_fences(text: AnyStr) -> bool:
+    """Returns whether a text may contain fenced code blocks.
+
+    It is much faster than `find_code_blocks` for texts without code blocks.
+    """
+    markers = FENCE_BYTES_MARKERS if isinstance(text, bytes) else FENCE_MARKERS
+    return any(marker in text for marker in markers)
+
+
+def find_code_blocks(text: AnyStr) -> List[CodeBlock]:
+    """Finds the fenced code blocks of a note.
+
+    Code blocks are opened by a line of at least three backticks or tildes,
+    followed by an optional info string, and closed by a line of at least as
+    many of the same character. Backtick fences cannot have backticks in their
+    info string, so a line such as ```` ```code``` ```` is inline code rather
+    than a fence. A code block which is never closed ends with the text.
+
+    Parameters
+    ----------
+    text : str or bytes
+        The text of the note, or its UTF-8 encoded bytes.
+
+    Returns
+    -------
+    List[CodeBlock]
+        The code blocks, in the order they appear.
+    """
+    code_blocks: List[CodeBlock] = []
+    if not has_fences(text):
+        return code_blocks
+
+    backtick = b"`" if isinstance(text, bytes) else "`"
+
+    opening = None
+    for match in _fence_lines(text):
+        fence, info = match.groups()
+
+        if opening is None:
+            if fence.startswith(backtick) and backtick in info:
+                continue
+
+            opening = match
+        elif fence[:1] == opening.group(1)[:1] and len(fence) >= len(opening.group(1)):
+            if info.strip():
+                continue
+
+            code_blocks.append(
+                _code_block(text, opening, match.start(1), match.end(1), True)
+            )
+            opening = None
+
+    if opening is not None:
+        code_blocks.append(_code_block(text, opening, len(text), len(text), False))
+
+    return code_blocks
+
+
+def _fence_lines(text: AnyStr) -> Iterator[Match]:
+    regexes: Tuple[Pattern, Pattern]
+    if isinstance(text, bytes):
+        regexes = FENCE_LINE_BYTES_REGEX, NEXT_FENCE_LINE_BYTES_REGEX
+    else:
+        regexes = FENCE_LINE_REGEX, NEXT_FENCE_LINE_REGEX
+    fence_line_regex, next_fence_line_regex = regexes
+
+    first_line = fence_line_regex.match(text)
+    if first_line is not None:
+        yield first_line
+
+    yield from next_fence_line_regex.finditer(text)
+
+
+def _code_block(
+    text: AnyStr, opening, content_end: int, end: int, closed: bool
+) -> CodeBlock:
+    content_start = opening.end()
+    if content_start < len(text):
+        # Skip the line break ending the opening fence
+        content_start += 1
+
+    return CodeBlock(
+        start=opening.start(1),
+        end=end,
+        info=opening.group(2).strip(),
+        info_start=opening.end(1),
+        content_start=min(content_start, content_end),
+        content_end=content_end,
+        closed=closed,
+    )
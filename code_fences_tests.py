@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Unit tests to exercise finding the fenced code blocks of notes."""
+
+import unittest
+
+from code_fences import CodeBlock, find_code_blocks, has_fences
+
+
+class TestFindCodeBlocks(unittest.TestCase):
+    def test_no_code_blocks(self):
+        self.assertFalse(has_fences("text `inline code`"))
+        self.assertEqual(find_code_blocks("text `inline code`"), [])
+
+    def test_code_block(self):
+        text = "text\n```python\nx = 5\n```\ntext"
+
+        self.assertEqual(
+            find_code_blocks(text),
+            [
+                CodeBlock(
+                    start=5,
+                    end=24,
+                    info="python",
+                    info_start=8,
+                    content_start=15,
+                    content_end=21,
+                    closed=True,
+                )
+            ],
+        )
+
+    def test_spans(self):
+        text = "```\na\n```\n~~~ js \nb\n~~~\n"
+
+        self.assertEqual(
+            [(start, end, info) for start, end, info, *_ in find_code_blocks(text)],
+            [(0, 9, ""), (10, 23, "js")],
+        )
+
+    def test_longer_fence(self):
+        text = "````\n```\nnested\n```\n````\n"
+        (code_block,) = find_code_blocks(text)
+
+        self.assertEqual(
+            text[code_block.content_start : code_block.content_end],
+            "```\nnested\n```\n",
+        )
+
+    def test_different_fence_character(self):
+        text = "~~~\n```\n~~~\n"
+        (code_block,) = find_code_blocks(text)
+
+        self.assertEqual(
+            text[code_block.content_start : code_block.content_end], "```\n"
+        )
+
+    def test_indented_fences(self):
+        text = "  - item\n\n    ```\n    x = 5\n    ```\n"
+        (code_block,) = find_code_blocks(text)
+
+        self.assertEqual(
+            text[code_block.content_start : code_block.content_end], "    x = 5\n    "
+        )
+
+    def test_inline_code_is_not_a_fence(self):
+        self.assertEqual(find_code_blocks("```code``` and text\n"), [])
+
+    def test_closing_fence_with_info_string(self):
+        text = "```\n```python\n```\n"
+        (code_block,) = find_code_blocks(text)
+
+        self.assertEqual(code_block.content_end, 14)
+
+    def test_unclosed_code_block(self):
+        (code_block,) = find_code_blocks("text\n```\nx = 5")
+
+        self.assertFalse(code_block.closed)
+        self.assertEqual((code_block.content_start, code_block.end), (9, 14))
+
+    def test_bytes(self):
+        text = "é\n```python\nprint('ü')\n```\n~~~\n```\n"
+        data = text.encode("utf-8")
+        code_blocks = find_code_blocks(data)
+
+        self.assertEqual(len(code_blocks), len(find_code_blocks(text)))
+        self.assertEqual(code_blocks[0].info, b"python")
+        self.assertEqual(
+            [data[cb.content_start : cb.content_end] for cb in code_blocks],
+            [
+                text[cb.content_start : cb.content_end].encode("utf-8")
+                for cb in find_code_blocks(text)
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
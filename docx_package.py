@@ -0,0 +1,324 @@
+"""Reads and replaces individual parts of a docx package without touching the
+rest of the zip archive."""
+import os
+import posixpath
+import shutil
+import struct
+import tempfile
+import zipfile
+import zlib
+from typing import BinaryIO, Optional, Tuple
+from xml.etree import ElementTree
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+LOCAL_HEADER_SIGNATURE: bytes = b"PK\x03\x04"
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+CENTRAL_HEADER_SIGNATURE: bytes = b"PK\x01\x02"
+END_RECORD = struct.Struct("<4s4H2LH")
+END_RECORD_SIGNATURE: bytes = b"PK\x05\x06"
+DATA_DESCRIPTOR_SIGNATURE: bytes = b"PK\x07\x08"
+
+# General purpose flag set when the sizes follow the data in a data descriptor
+DATA_DESCRIPTOR_FLAG: int = 0x08
+DEFLATED: int = 8
+COPY_BUFFER_SIZE: int = 1024 * 1024
+
+RELATIONSHIPS_NAMESPACE: str = (
+    "http://schemas.openxmlformats.org/package/2006/relationships"
+)
+OFFICE_DOCUMENT_RELATIONSHIP_TYPE: str = (
+    "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+)
+STYLES_RELATIONSHIP_TYPE: str = (
+    "http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"
+)
+DEFAULT_DOCUMENT_PARTNAME: str = "word/document.xml"
+
+
+class UnsupportedPackageError(Exception):
+    """Raised for zip archives that cannot be rewritten member by member."""
+
+
+def _read_end_record(file: BinaryIO) -> Tuple[int, int, int, bytes]:
+    """Returns the entry count, central directory size and offset, and comment."""
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    # The end record is followed by a comment of at most 65535 bytes
+    search_size = min(size, END_RECORD.size + 0xFFFF)
+    file.seek(size - search_size)
+    data = file.read()
+
+    idx = data.rfind(END_RECORD_SIGNATURE)
+    if idx < 0 or len(data) - idx < END_RECORD.size:
+        raise UnsupportedPackageError("End of central directory record not found")
+
+    _, disk, cd_disk, disk_entries, entries, cd_size, cd_offset, comment_len = (
+        END_RECORD.unpack_from(data, idx)
+    )
+    if disk != 0 or cd_disk != 0 or disk_entries != entries:
+        raise UnsupportedPackageError("Multi-disk archives are not supported")
+    if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+        raise UnsupportedPackageError("Zip64 archives are not supported")
+
+    comment_start = idx + END_RECORD.size
+    return (
+        entries,
+        cd_size,
+        cd_offset,
+        data[comment_start : comment_start + comment_len],
+    )
+
+
+def _copy(src: BinaryIO, dst: BinaryIO, length: int) -> None:
+    while length > 0:
+        chunk = src.read(min(length, COPY_BUFFER_SIZE))
+        if len(chunk) == 0:
+            raise UnsupportedPackageError("Unexpected end of archive")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def _find_partname(zip_file, partname: str) -> str:
+    """Finds a part name in the archive, ignoring case like OPC readers do."""
+    names = {name.lower(): name for name in zip_file.namelist()}
+    return names.get(partname.lower(), partname)
+
+
+def _related_partname(
+    zip_file: zipfile.ZipFile, source_partname: str, reltype: str
+) -> Optional[str]:
+    """Returns the name of the first part related to a source part by type."""
+    source_dir, source_name = posixpath.split(source_partname)
+    rels_partname = posixpath.join(source_dir, "_rels", f"{source_name}.rels")
+    try:
+        rels = zip_file.read(_find_partname(zip_file, rels_partname))
+    except KeyError:
+        return None
+
+    for rel in ElementTree.fromstring(rels).iter(
+        f"{{{RELATIONSHIPS_NAMESPACE}}}Relationship"
+    ):
+        if rel.get("Type") == reltype and rel.get("TargetMode") != "External":
+            target = rel.get("Target")
+            if not target.startswith("/"):
+                target = posixpath.join("/", source_dir, target)
+            return _find_partname(zip_file, posixpath.normpath(target).lstrip("/"))
+
+    return None
+
+
+def document_partname(filename: str) -> str:
+    """Returns the name of the main document part of a docx file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the docx file.
+
+    Returns
+    -------
+    str
+        The zip member name of the main document part, e.g. word/document.xml.
+    """
+    with zipfile.ZipFile(filename) as zip_file:
+        partname = _related_partname(zip_file, "", OFFICE_DOCUMENT_RELATIONSHIP_TYPE)
+
+    return partname or DEFAULT_DOCUMENT_PARTNAME
+
+
+def styles_partname(filename: str, document_partname: str) -> Optional[str]:
+    """Returns the name of the styles part of a docx file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the docx file.
+    document_partname : str
+        The zip member name of the main document part.
+
+    Returns
+    -------
+    Optional[str]
+        The zip member name of the styles part, e.g. word/styles.xml, or None
+        if the document has no styles.
+    """
+    with zipfile.ZipFile(filename) as zip_file:
+        partname = _related_partname(
+            zip_file, document_partname, STYLES_RELATIONSHIP_TYPE
+        )
+        if partname is None or partname not in zip_file.namelist():
+            return None
+
+    return partname
+
+
+def read_part(filename: str, partname: str) -> bytes:
+    """Reads a single part of a docx file.
+
+    Only the requested member is decompressed.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the docx file.
+    partname : str
+        The zip member name of the part, e.g. word/document.xml.
+
+    Returns
+    -------
+    bytes
+        The uncompressed contents of the part.
+    """
+    with zipfile.ZipFile(filename) as zip_file:
+        return zip_file.read(_find_partname(zip_file, partname))
+
+
+def replace_part(filename: str, partname: str, blob: bytes) -> None:
+    """Replaces a single part of a docx file.
+
+    Every other member of the archive is copied byte for byte without being
+    decompressed, so the cost of the rewrite does not depend on the size of
+    embedded images and attachments. The archive is written to a temporary file
+    which is then renamed over the original.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the docx file to update.
+    partname : str
+        The zip member name of the part to replace, e.g. word/document.xml.
+    blob : bytes
+        The new uncompressed contents of the part.
+    """
+    fd, tmp_filename = tempfile.mkstemp(
+        prefix=".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(filename))
+    )
+    try:
+        with os.fdopen(fd, "wb") as dst, open(filename, "rb") as src:
+            try:
+                _copy_replacing_part(src, dst, partname, blob)
+            except UnsupportedPackageError:
+                # Fall back to recompressing every member for archives that
+                # cannot be copied as is
+                dst.seek(0)
+                dst.truncate()
+                _rewrite_replacing_part(src, dst, partname, blob)
+
+        shutil.copymode(filename, tmp_filename)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def _rewrite_replacing_part(
+    src: BinaryIO, dst: BinaryIO, partname: str, blob: bytes
+) -> None:
+    with zipfile.ZipFile(src) as src_zip, zipfile.ZipFile(dst, "w") as dst_zip:
+        partname = _find_partname(src_zip, partname)
+        if partname not in src_zip.namelist():
+            raise KeyError(f"There is no item named '{partname}' in the archive")
+
+        for info in src_zip.infolist():
+            if info.filename == partname:
+                dst_zip.writestr(info, blob, compress_type=zipfile.ZIP_DEFLATED)
+            else:
+                dst_zip.writestr(info, src_zip.read(info))
+
+
+def _copy_replacing_part(
+    src: BinaryIO, dst: BinaryIO, partname: str, blob: bytes
+) -> None:
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(blob) + compressor.flush()
+    crc = zlib.crc32(blob) & 0xFFFFFFFF
+
+    entries, cd_size, cd_offset, comment = _read_end_record(src)
+    src.seek(cd_offset)
+    central_directory = src.read(cd_size)
+
+    new_central_directory = []
+    replaced = False
+    pos = 0
+    for _ in range(entries):
+        if central_directory[pos : pos + 4] != CENTRAL_HEADER_SIGNATURE:
+            raise UnsupportedPackageError("Corrupt central directory")
+        header = list(CENTRAL_HEADER.unpack_from(central_directory, pos))
+        flags, mod_time, mod_date = header[3], header[5], header[6]
+        compress_size, offset = header[8], header[16]
+        name_len, extra_len, comment_len = header[10:13]
+        if 0xFFFFFFFF in (compress_size, header[9], offset):
+            raise UnsupportedPackageError("Zip64 archives are not supported")
+
+        name_start = pos + CENTRAL_HEADER.size
+        name_bytes = central_directory[name_start : name_start + name_len]
+        pos = name_start + name_len + extra_len + comment_len
+        variable = central_directory[name_start:pos]
+
+        name = name_bytes.decode("utf-8" if flags & 0x800 else "cp437")
+        header[16] = dst.tell()
+
+        if name.lower() == partname.lower():
+            replaced = True
+            flags &= ~DATA_DESCRIPTOR_FLAG
+            # Deflate requires at least version 2.0 to extract
+            header[2] = max(header[2], 20)
+            header[3] = flags
+            header[4] = DEFLATED
+            header[7:10] = [crc, len(compressed), len(blob)]
+            dst.write(
+                LOCAL_HEADER.pack(
+                    LOCAL_HEADER_SIGNATURE,
+                    header[2],
+                    flags,
+                    DEFLATED,
+                    mod_time,
+                    mod_date,
+                    crc,
+                    len(compressed),
+                    len(blob),
+                    name_len,
+                    0,
+                )
+            )
+            dst.write(name_bytes)
+            dst.write(compressed)
+        else:
+            src.seek(offset)
+            local_header = src.read(LOCAL_HEADER.size)
+            if local_header[:4] != LOCAL_HEADER_SIGNATURE:
+                raise UnsupportedPackageError(f"Corrupt local header: {name}")
+            local_name_len, local_extra_len = struct.unpack_from(
+                "<2H", local_header, 26
+            )
+            dst.write(local_header)
+            _copy(src, dst, local_name_len + local_extra_len + compress_size)
+
+            if flags & DATA_DESCRIPTOR_FLAG:
+                # The descriptor signature is optional
+                descriptor = src.read(4)
+                dst.write(descriptor)
+                _copy(src, dst, 12 if descriptor == DATA_DESCRIPTOR_SIGNATURE else 8)
+
+        new_central_directory.append(CENTRAL_HEADER.pack(*header))
+        new_central_directory.append(variable)
+
+    if not replaced:
+        raise KeyError(f"There is no item named '{partname}' in the archive")
+
+    new_cd_offset = dst.tell()
+    new_cd = b"".join(new_central_directory)
+    dst.write(new_cd)
+    dst.write(
+        END_RECORD.pack(
+            END_RECORD_SIGNATURE,
+            0,
+            0,
+            entries,
+            entries,
+            len(new_cd),
+            new_cd_offset,
+            len(comment),
+        )
+    )
+    dst.write(comment)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Unit tests to exercise replacing individual parts of a docx package."""
+import os
+import tempfile
+import unittest
+import zipfile
+
+from docx_package import document_partname, read_part, replace_part
+
+RELS = b"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+
+class TestReplacePart(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, "page.docx")
+
+        with zipfile.ZipFile(self.filename, "w") as zip_file:
+            zip_file.writestr("_rels/.rels", RELS, zipfile.ZIP_DEFLATED)
+            zip_file.writestr("word/document.xml", b"<old/>", zipfile.ZIP_DEFLATED)
+            zip_file.writestr(
+                "word/media/image1.png", os.urandom(4096), zipfile.ZIP_STORED
+            )
+            zip_file.writestr(
+                "word/styles.xml", b"<styles/>" * 100, zipfile.ZIP_DEFLATED
+            )
+            zip_file.comment = b"comment"
+
+    def read_raw_members(self):
+        """Returns the compressed bytes of every member keyed by name."""
+        members = {}
+        with zipfile.ZipFile(self.filename) as zip_file, open(
+            self.filename, "rb"
+        ) as file:
+            for info in zip_file.infolist():
+                file.seek(info.header_offset + 26)
+                name_len, extra_len = int.from_bytes(
+                    file.read(2), "little"
+                ), int.from_bytes(file.read(2), "little")
+                file.seek(name_len + extra_len, os.SEEK_CUR)
+                members[info.filename] = file.read(info.compress_size)
+        return members
+
+    def test_document_partname(self):
+        self.assertEqual(document_partname(self.filename), "word/document.xml")
+
+    def test_replace_part(self):
+        before = self.read_raw_members()
+
+        replace_part(self.filename, "word/document.xml", b"<new/>" * 1000)
+
+        after = self.read_raw_members()
+        with zipfile.ZipFile(self.filename) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.comment, b"comment")
+            self.assertEqual(
+                zip_file.namelist(),
+                [
+                    "_rels/.rels",
+                    "word/document.xml",
+                    "word/media/image1.png",
+                    "word/styles.xml",
+                ],
+            )
+        self.assertEqual(
+            read_part(self.filename, "word/document.xml"), b"<new/>" * 1000
+        )
+        for name in ["_rels/.rels", "word/media/image1.png", "word/styles.xml"]:
+            self.assertEqual(after[name], before[name])
+
+    def test_missing_part(self):
+        with open(self.filename, "rb") as file:
+            original = file.read()
+
+        with self.assertRaises(KeyError):
+            replace_part(self.filename, "word/missing.xml", b"")
+
+        with open(self.filename, "rb") as file:
+            self.assertEqual(file.read(), original)
+        self.assertEqual(os.listdir(os.path.dirname(self.filename)), ["page.docx"])
+
+
+if __name__ == "__main__":
+    unittest.main()
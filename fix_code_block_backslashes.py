@@ -2,12 +2,29 @@
 """Recursively processes Markdown files in a directory and removes backslashes
 preceding opening or closing angle brackets inside code blocks."""
 import argparse
-import os
-
-CODE_BLOCK_BACKTICK_COUNT: int = 3
-
-
-def process_note(text: str) -> str:
+import re
+from typing import AnyStr, List, Optional
+
+from code_fences import find_code_blocks
+from markdown_pipeline import (
+    DEFAULT_IO_THREADS,
+    NoteCodeBlock,
+    NoteTransform,
+    RunState,
+    add_scan_arguments,
+    find_notes,
+    process_file,
+    process_files,
+)
+
+# Backslashes preceding an opening or closing angle bracket
+ESCAPED_ANGLE_BRACKET_REGEX = re.compile(r"\\(?=[<>])")
+# The same for UTF-8 encoded notes, in which backslashes and angle brackets are
+# single bytes
+ESCAPED_ANGLE_BRACKET_BYTES_REGEX = re.compile(rb"\\(?=[<>])")
+
+
+def process_note(text: AnyStr) -> AnyStr:
     """Removes erroneous backslashes inside code blocks.
 
     Any backslashes preceding opening or closing angle brackets inside of a code
@@ -15,39 +32,72 @@ def process_note(text: str) -> str:
 
     Parameters
     ----------
-    text : str
-        The text to process.
+    text : str or bytes
+        The text to process, or its UTF-8 encoded bytes which are processed
+        without decoding them.
 
     Returns
     -------
-    str
-        The modified text.
+    str or bytes
+        The modified text, of the same type as `text`.
     """
-    modified_text = ""
-    consecutive_backticks = 0
-    in_code_block = False
-    char_idx = 0
+    if isinstance(text, bytes):
+        escaped_angle_bracket_regex = ESCAPED_ANGLE_BRACKET_BYTES_REGEX
+    else:
+        escaped_angle_bracket_regex = ESCAPED_ANGLE_BRACKET_REGEX
+
+    # Most notes have no escaped angle brackets at all, which a single search
+    # finds out faster than finding their code blocks
+    if escaped_angle_bracket_regex.search(text) is None:
+        return text
+
+    # Only the code blocks are modified, the text between them is copied as is
+    segments = []
+    segment_start = 0
+
+    for code_block in find_code_blocks(text):
+        segments.append(text[segment_start : code_block.content_start])
+        segments.append(
+            escaped_angle_bracket_regex.sub(
+                text[:0], text[code_block.content_start : code_block.content_end]
+            )
+        )
+        segment_start = code_block.content_end
+
+    segments.append(text[segment_start:])
+    return text[:0].join(segments)
 
-    for c in text:
-        if c == "`":
-            consecutive_backticks += 1
-        else:
-            if consecutive_backticks == CODE_BLOCK_BACKTICK_COUNT:
-                in_code_block = not in_code_block
-            consecutive_backticks = 0
 
-        if in_code_block:
-            if c == "\\" and char_idx < len(text) - 1:
-                # Only perform a backslash replacement when the next character
-                # is an opening or closing angle bracket
-                if text[char_idx + 1] == "<" or text[char_idx + 1] == ">":
-                    char_idx += 1
-                    continue
+def process_note_file(filepath: str, state: Optional[RunState] = None) -> bool:
+    """Removes erroneous backslashes inside the code blocks of a note.
 
-        modified_text += c
-        char_idx += 1
+    Parameters
+    ----------
+    filepath : str
+        Path to the Markdown file.
+    state : Optional[RunState]
+        Records the processed notes. Notes which it already recorded are
+        skipped.
+
+    Returns
+    -------
+    bool
+        Whether the note was modified. Notes are only written when they are
+        modified.
+    """
+    # Notes are processed as bytes, which saves decoding and encoding them and
+    # leaves the text outside of code blocks byte for byte identical
+    return process_file(filepath, process_note, state)
 
-    return modified_text
+
+class FixBackslashesTransform(NoteTransform):
+    """Removes erroneous backslashes inside code blocks, see `process_note`."""
+
+    name = "fix-backslashes"
+
+    def apply(self, code_blocks: List[NoteCodeBlock]) -> None:
+        for code_block in code_blocks:
+            code_block.content = ESCAPED_ANGLE_BRACKET_REGEX.sub("", code_block.content)
 
 
 def main():
@@ -55,24 +105,57 @@ def main():
     parser.add_argument(
         "directory", help="Path to the directory containing Markdown files"
     )
+    parser.add_argument(
+        "--state",
+        metavar="FILE",
+        help="SQLite file recording the processed notes, so that later runs "
+        "only process new or modified notes. It can be shared with "
+        "add_code_block_language.py and postprocess_notes.py",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used to process notes in parallel, 0 "
+        "uses one per CPU (default: 1)",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=DEFAULT_IO_THREADS,
+        help="Number of threads reading and writing notes while others are "
+        "processed (default: %(default)s)",
+    )
+    add_scan_arguments(parser)
     args = parser.parse_args()
 
-    for root, dirs, files in os.walk(args.directory):
-        for filename in files:
-            if filename.endswith(".md"):
-                filepath = os.path.join(root, filename)
-                with open(filepath, "r", encoding="utf-8", errors="ignore") as file:
-                    text = file.read()
-
-                modified_text = process_note(text)
-
-                with open(
-                    filepath, "w", encoding="utf-8", newline="\n", errors="ignore"
-                ) as file:
-                    file.write(modified_text)
-
+    if args.jobs < 0:
+        parser.error("--jobs must not be negative")
+    if args.io_threads < 1:
+        parser.error("--io-threads must be at least 1")
+
+    state = None
+    if args.state is not None:
+        state = RunState(args.state, [FixBackslashesTransform()])
+
+    try:
+        for filepath, modified in process_files(
+            find_notes(args.directory, args.include, args.exclude),
+            process_note,
+            state,
+            args.jobs,
+            args.io_threads,
+        ):
+            if modified:
                 print(f"Processed: {filepath}")
+    finally:
+        if state is not None:
+            state.save()
+            state.close()
 
+    if state is not None:
+        print(f"Skipped {state.skipped} notes which were already processed")
     print("Done!")
 
 
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Benchmarks removing backslashes from multi-megabyte notes, comparing the
+character by character loop the script used to run with processing decoded text
+and UTF-8 encoded bytes."""
+import argparse
+import time
+from typing import Callable
+
+from fix_code_block_backslashes import process_note
+
+SECTION: str = """# A page
+
+Some text with an \\<escaped\\> tag describing the code below. Most of a note
+is text rather than code, which is copied as is, so the text goes on for a few
+lines of Markdown with *emphasis*, `inline code` and [links](https://example.com).
+
+- A list item
+- Another list item
+
+```
+\\<html\\>
+  \\<body class="page"\\>
+    \\<p\\>Hello, wörld!\\</p\\>
+  \\</body\\>
+\\</html\\>
+```
+"""
+
+
+def loop_process_note(text: str) -> str:
+    """The character by character loop the script used before finding code blocks
+    with regular expressions, kept as a baseline."""
+    modified_text = ""
+    consecutive_backticks = 0
+    in_code_block = False
+    char_idx = 0
+
+    for c in text:
+        if c == "`":
+            consecutive_backticks += 1
+        else:
+            if consecutive_backticks == 3:
+                in_code_block = not in_code_block
+            consecutive_backticks = 0
+
+        if in_code_block:
+            if c == "\\" and char_idx < len(text) - 1:
+                if text[char_idx + 1] == "<" or text[char_idx + 1] == ">":
+                    char_idx += 1
+                    continue
+
+        modified_text += c
+        char_idx += 1
+
+    return modified_text
+
+
+def decoding(process_text: Callable[[str], str]) -> Callable[[bytes], bytes]:
+    """Processes the bytes of a note as text, as the script used to."""
+    return lambda data: process_text(data.decode("utf-8")).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--megabytes",
+        type=int,
+        default=1,
+        help="Size of the smallest note in megabytes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=3,
+        help="Number of times the note size is doubled (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of timed runs per note size"
+    )
+    args = parser.parse_args()
+
+    for step in range(args.steps):
+        size = args.megabytes * 2**step * 1024 * 1024
+        data = (SECTION * (size // len(SECTION.encode("utf-8")))).encode("utf-8")
+        # Every engine is given the note as it is read from disk
+        engines = {
+            "loop": decoding(loop_process_note),
+            "text": decoding(process_note),
+            "bytes": process_note,
+        }
+
+        expected = None
+        for name, engine in engines.items():
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                result = engine(data)
+                timings.append(time.perf_counter() - start)
+
+            if expected is None:
+                expected = result
+            elif result != expected:
+                raise AssertionError(f"The {name} engine output differs")
+
+            best = min(timings)
+            print(
+                f"{size / 1024 / 1024:.0f}MB note processed by the {name} engine in "
+                f"{best:.4f}s, {size / best / 1024 / 1024:.1f}MB/s "
+                f"(best of {args.repeat})"
+            )
+
+
+if __name__ == "__main__":
+    main()
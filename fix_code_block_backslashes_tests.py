@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 """Unit tests to exercise removing erroneous backslashes from codeblocks."""
+import os
+import tempfile
 import unittest
 
-from fix_code_block_backslashes import process_note
+from fix_code_block_backslashes import (
+    FixBackslashesTransform,
+    process_note,
+    process_note_file,
+)
+from markdown_pipeline import RunState
 
 
 class TestProcessNote(unittest.TestCase):
@@ -289,6 +296,79 @@ class TestProcessNote(unittest.TestCase):
 
         self.assertEqual(process_note(input), output)
 
+    def test_tilde_and_longer_fences(self):
+        input = """
+        ~~~
+        \\<html\\>
+        ~~~
+        \\<text\\> with ```inline``` code \\<text\\>
+        ````
+        ```
+        \\<html\\>
+        ```
+        ````
+        """
+
+        output = """
+        ~~~
+        <html>
+        ~~~
+        \\<text\\> with ```inline``` code \\<text\\>
+        ````
+        ```
+        <html>
+        ```
+        ````
+        """
+
+        self.assertEqual(process_note(input), output)
+
+    def test_bytes(self):
+        input = "\\<é\\>\r\n```\r\n\\<ü\\>\r\n```\r\n"
+
+        output = process_note(input.encode("utf-8"))
+
+        self.assertEqual(output, "\\<é\\>\r\n```\r\n<ü>\r\n```\r\n".encode("utf-8"))
+        self.assertEqual(output, process_note(input).encode("utf-8"))
+
+
+class TestProcessNoteFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filepath = os.path.join(self.tmp.name, "page.md")
+
+    def test_modified_note(self):
+        with open(self.filepath, "wb") as file:
+            file.write(b"```\r\n\\<html\\>\r\n```\r\n")
+
+        self.assertTrue(process_note_file(self.filepath))
+        with open(self.filepath, "rb") as file:
+            self.assertEqual(file.read(), b"```\r\n<html>\r\n```\r\n")
+
+    def test_unmodified_note_not_written(self):
+        with open(self.filepath, "wb") as file:
+            file.write(b"\\<text\\>\n```\n<html>\n```\n")
+        os.utime(self.filepath, ns=(0, 0))
+
+        self.assertFalse(process_note_file(self.filepath))
+        self.assertEqual(os.stat(self.filepath).st_mtime_ns, 0)
+
+    def test_state(self):
+        with open(self.filepath, "wb") as file:
+            file.write(b"```\n\\\\\\<html\\>\n```\n")
+        state = RunState(
+            os.path.join(self.tmp.name, "state.sqlite"), [FixBackslashesTransform()]
+        )
+        self.addCleanup(state.close)
+
+        self.assertTrue(process_note_file(self.filepath, state))
+        # Processing the note again would remove another backslash
+        self.assertFalse(process_note_file(self.filepath, state))
+        self.assertEqual(state.skipped, 1)
+        with open(self.filepath, "rb") as file:
+            self.assertEqual(file.read(), b"```\n\\\\<html>\n```\n")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,184 @@
+"""Serves language detection from a long running process so that the model only
+has to be loaded once, and connects to it."""
+import json
+import socket
+import socketserver
+import threading
+from typing import Any, BinaryIO, Dict, List, Sequence, Tuple
+
+DEFAULT_DAEMON_ADDRESS: str = "127.0.0.1:48653"
+# Environment variable holding the address of the daemon used by clients, which
+# only connect to a daemon when it is set
+DAEMON_ADDRESS_ENVIRONMENT_VARIABLE: str = "CODE_BLOCK_LANGUAGE_DAEMON"
+# Connecting to a local daemon and getting its version is immediate, so a
+# missing daemon, or another server listening on its port, is detected quickly
+CONNECT_TIMEOUT: float = 1.0
+
+
+class DaemonError(Exception):
+    """Raised when the daemon fails to handle a request."""
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """Splits a ``host:port`` address.
+
+    Parameters
+    ----------
+    address : str
+        The address, e.g. ``127.0.0.1:48653``.
+
+    Returns
+    -------
+    Tuple[str, int]
+        The host and port.
+    """
+    host, separator, port = address.rpartition(":")
+    if not separator or not port.isdigit():
+        raise ValueError(f"Invalid address, expected host:port: {address}")
+
+    return host or "127.0.0.1", int(port)
+
+
+def serve_stream(backend, rfile: BinaryIO, wfile: BinaryIO) -> None:
+    """Answers the requests read from a stream until it is closed.
+
+    Every request and response is a JSON object on its own line:
+
+    * ``{"version": true}`` returns ``{"version": "..."}``
+    * ``{"text": "..."}`` returns ``{"language": "..."}``
+    * ``{"texts": ["..."]}`` returns ``{"languages": ["..."]}``
+
+    Failures return ``{"error": "..."}``.
+
+    Parameters
+    ----------
+    backend : add_code_block_language.LanguageBackend
+        Detects the languages of the code blocks.
+    rfile : BinaryIO
+        The stream the requests are read from.
+    wfile : BinaryIO
+        The stream the responses are written to.
+    """
+    for line in rfile:
+        if not line.strip():
+            continue
+
+        try:
+            request = json.loads(line)
+            if "texts" in request:
+                response: Dict[str, Any] = {
+                    "languages": backend.detect_many(request["texts"])
+                }
+            elif "text" in request:
+                response = {"language": backend.detect(request["text"])}
+            elif "version" in request:
+                response = {"version": backend.version()}
+            else:
+                response = {"error": "Unknown request"}
+        except Exception as e:
+            response = {"error": f"{type(e).__name__}: {e}"}
+
+        wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        wfile.flush()
+
+
+class _LanguageDaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        serve_stream(self.server.backend, self.rfile, self.wfile)
+
+
+class LanguageDaemon(socketserver.ThreadingTCPServer):
+    """A server detecting languages with a loaded backend.
+
+    Every connection is handled in its own thread, and may send any number of
+    requests, see `serve_stream`.
+
+    Parameters
+    ----------
+    address : str
+        The ``host:port`` address to listen on. Port 0 picks a free port.
+    backend : add_code_block_language.LanguageBackend
+        Detects the languages of the code blocks.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address: str, backend) -> None:
+        self.backend = backend
+        super().__init__(parse_address(address), _LanguageDaemonHandler)
+
+
+class DaemonClient:
+    """A connection to a `LanguageDaemon`.
+
+    The version of the backend of the daemon is requested when connecting, with
+    the same timeout as the connection, so that a server which is not a daemon
+    cannot block the client. Later requests wait as long as the detections
+    take.
+
+    Parameters
+    ----------
+    address : str
+        The ``host:port`` address of the daemon.
+
+    Raises
+    ------
+    OSError
+        If the daemon is not running or does not answer in time.
+    DaemonError
+        If the server does not answer like a daemon.
+    """
+
+    def __init__(self, address: str) -> None:
+        self.socket = socket.create_connection(
+            parse_address(address), timeout=CONNECT_TIMEOUT
+        )
+        self.file = self.socket.makefile("rwb")
+        self.lock = threading.Lock()
+        try:
+            #: The version tag of the backend of the daemon
+            self.backend_version = self.version()
+        except BaseException:
+            self.close()
+            raise
+
+        # Detections may take a while, which is bounded by the time budget of
+        # the caller instead
+        self.socket.settimeout(None)
+
+    def _request(self, request: Dict[str, Any], key: str) -> Any:
+        with self.lock:
+            self.file.write(json.dumps(request).encode("utf-8") + b"\n")
+            self.file.flush()
+            line = self.file.readline()
+
+        if not line:
+            raise ConnectionError("The daemon closed the connection")
+
+        try:
+            response = json.loads(line)
+        except ValueError:
+            response = None
+        if isinstance(response, dict) and "error" in response:
+            raise DaemonError(response["error"])
+        if not isinstance(response, dict) or key not in response:
+            raise DaemonError(f"Invalid response: {line[:100]!r}")
+
+        return response[key]
+
+    def version(self) -> str:
+        """Returns the version tag of the backend of the daemon."""
+        return self._request({"version": True}, "version")
+
+    def detect(self, code_block_text: str) -> str:
+        """Returns the language of a code block."""
+        return self._request({"text": code_block_text}, "language")
+
+    def detect_many(self, code_block_texts: Sequence[str]) -> List[str]:
+        """Returns the languages of many code blocks."""
+        return self._request({"texts": list(code_block_texts)}, "languages")
+
+    def close(self) -> None:
+        self.file.close()
+        self.socket.close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Unit tests to exercise serving language detection from a daemon."""
+
+import io
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from add_code_block_language import HeuristicBackend
+from language_daemon import (
+    DaemonClient,
+    DaemonError,
+    LanguageDaemon,
+    parse_address,
+    serve_stream,
+)
+
+
+class FailingBackend(HeuristicBackend):
+    def detect(self, code_block_text):
+        raise RuntimeError("model not loaded")
+
+
+def start_server(test_case, reply):
+    """Starts a server which is not a daemon, sending a reply to every
+    connection, and returns its address."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    test_case.addCleanup(server.close)
+
+    def serve():
+        connections = []
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                break
+            connections.append(connection)
+            connection.sendall(reply)
+        for connection in connections:
+            connection.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return f"127.0.0.1:{server.getsockname()[1]}"
+
+
+def start_daemon(test_case, backend):
+    """Starts a daemon on a free port and returns its address."""
+    daemon = LanguageDaemon("127.0.0.1:0", backend)
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    test_case.addCleanup(daemon.server_close)
+    test_case.addCleanup(daemon.shutdown)
+    return f"127.0.0.1:{daemon.server_address[1]}"
+
+
+class TestLanguageDaemon(unittest.TestCase):
+    def test_requests(self):
+        client = DaemonClient(start_daemon(self, HeuristicBackend()))
+        self.addCleanup(client.close)
+
+        self.assertEqual(client.backend_version, "heuristic")
+        self.assertEqual(client.version(), "heuristic")
+        self.assertEqual(client.detect("#!/bin/sh\nls"), "shell")
+        self.assertEqual(client.detect_many(["<?xml?>", "x = 5"]), ["xml", ""])
+
+    def test_error(self):
+        client = DaemonClient(start_daemon(self, FailingBackend()))
+        self.addCleanup(client.close)
+
+        with self.assertRaisesRegex(DaemonError, "model not loaded"):
+            client.detect("x = 5")
+        # The connection can still be used after a failed request
+        self.assertEqual(client.version(), "heuristic")
+
+    def test_not_running(self):
+        address = start_daemon(self, HeuristicBackend())
+        self.doCleanups()
+
+        with self.assertRaises(OSError):
+            DaemonClient(address)
+
+    def test_silent_server(self):
+        address = start_server(self, b"")
+
+        with mock.patch("language_daemon.CONNECT_TIMEOUT", 0.1):
+            with self.assertRaises(OSError):
+                DaemonClient(address)
+
+    def test_other_server(self):
+        address = start_server(self, b"HTTP/1.0 400 Bad Request\r\n\r\n")
+
+        with self.assertRaisesRegex(DaemonError, "Invalid response"):
+            DaemonClient(address)
+
+    def test_no_timeout_after_handshake(self):
+        client = DaemonClient(start_daemon(self, HeuristicBackend()))
+        self.addCleanup(client.close)
+
+        self.assertIsNone(client.socket.gettimeout())
+
+
+class TestServeStream(unittest.TestCase):
+    def test_requests(self):
+        rfile = io.BytesIO(b'{"text": "#!/bin/sh"}\n\n{"texts": []}\n{"unknown": 1}\n')
+        wfile = io.BytesIO()
+
+        serve_stream(HeuristicBackend(), rfile, wfile)
+
+        self.assertEqual(
+            wfile.getvalue(),
+            b'{"language": "shell"}\n{"languages": []}\n{"error": "Unknown request"}\n',
+        )
+
+
+class TestParseAddress(unittest.TestCase):
+    def test_address(self):
+        self.assertEqual(parse_address("localhost:1234"), ("localhost", 1234))
+        self.assertEqual(parse_address(":1234"), ("127.0.0.1", 1234))
+
+    def test_invalid_address(self):
+        with self.assertRaises(ValueError):
+            parse_address("localhost")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,779 @@
+"""Applies Markdown post-processing steps to notes in a single pass, reading and
+finding the code blocks of every note once however many steps there are."""
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from code_fences import find_code_blocks, has_fences
+
+# Notes are decoded without translating line breaks, and bytes which are not
+# valid UTF-8 are decoded to surrogates, so that encoding an unmodified note
+# gives back the exact bytes it was read from
+NOTE_ENCODING: str = "utf-8"
+NOTE_ENCODING_ERRORS: str = "surrogateescape"
+# Maximum number of seconds between commits of the run state for notes which
+# were not modified
+STATE_COMMIT_INTERVAL: float = 1.0
+DEFAULT_INCLUDE: Tuple[str, ...] = ("*.md",)
+# Reading and writing notes mostly waits for the disk or the network, so more
+# threads than CPUs are useful
+DEFAULT_IO_THREADS: int = 8
+DEFAULT_QUEUE_SIZE: int = 64
+
+T = TypeVar("T")
+# A file with the names of the transforms to apply to it, or None to apply
+# every transform
+PendingFile = Tuple[str, Optional[Tuple[str, ...]]]
+# The contents of a processed file, or None if it is unmodified, with the names
+# of the transforms which degraded its code blocks
+ProcessedData = Tuple[Optional[bytes], Tuple[str, ...]]
+
+
+class NoteCodeBlock:
+    """A fenced code block of a note, which transforms may modify.
+
+    Parameters
+    ----------
+    opening : str
+        The rest of the opening fence line after the backticks or tildes,
+        including its line break. A language is inserted at its start.
+    content : str
+        The lines inside the code block, up to the closing fence.
+    closed : bool
+        Whether the code block has a closing fence.
+    """
+
+    def __init__(self, opening: str, content: str, closed: bool) -> None:
+        self.opening = opening
+        self.content = content
+        self.closed = closed
+
+    @property
+    def info(self) -> str:
+        """The info string of the code block, without surrounding spaces."""
+        return self.opening.strip()
+
+
+class NoteTransform:
+    """A post-processing step modifying the code blocks of notes.
+
+    Subclasses implement `apply`, which is given every code block of a note at
+    once so that they can be processed in batches.
+    """
+
+    #: The name used to select the transform on the command line
+    name: str = ""
+
+    def version(self) -> str:
+        """Returns a tag identifying the transform and its settings, used to
+        apply it again to notes processed with another version.
+
+        Transforms which would modify a note again, such as removing
+        backslashes, must keep the same version.
+        """
+        return self.name
+
+    def degraded(self) -> int:
+        """Returns the number of code blocks the transform could not fully
+        process so far, e.g. because it ran out of time.
+
+        Notes with such code blocks are not recorded as processed by the
+        transform in the run state, so later runs apply it to them again.
+        """
+        return 0
+
+    def apply(self, code_blocks: List[NoteCodeBlock]) -> None:
+        """Modifies the code blocks of a note in place."""
+        raise NotImplementedError
+
+
+class RunState:
+    """An SQLite database recording the notes which have already been processed.
+
+    Every processed note is recorded with its size, modification time, content
+    hash and the version of every transform applied to it. Later runs apply
+    every transform to new or modified notes, but only the transforms which
+    are missing or whose version changed to the other notes, so that no
+    transform is applied twice to the same contents, whichever transforms each
+    run selects. Modified notes are committed before they are written, so a
+    run which crashed can be resumed without processing any note twice.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SQLite database. It is created if it does not exist.
+    transforms : Sequence[NoteTransform]
+        The transforms applied by the run.
+    """
+
+    def __init__(self, filename: str, transforms: Sequence[NoteTransform]) -> None:
+        self.filename = filename
+        self.versions: Dict[str, str] = {
+            transform.name: transform.version() for transform in transforms
+        }
+        self.skipped = 0
+        # The transforms already applied to the notes being processed
+        self.applied: Dict[str, Dict[str, str]] = {}
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS notes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                transforms TEXT NOT NULL
+            );
+            """)
+        self.last_commit = time.monotonic()
+
+    @staticmethod
+    def _key(filepath: str) -> str:
+        return os.path.normcase(os.path.abspath(filepath))
+
+    def pending(self, filepath: str) -> List[str]:
+        """Returns the names of the transforms left to apply to a note.
+
+        These are every transform for new notes and for notes modified since
+        they were processed. The content hash is only computed when the size
+        matches but the modification time does not, so unchanged notes are
+        usually matched with a single stat. Notes without pending transforms are
+        counted as skipped.
+        """
+        key = self._key(filepath)
+        applied = self._applied_transforms(filepath, key)
+        pending = [
+            name
+            for name, version in self.versions.items()
+            if applied.get(name) != version
+        ]
+        if pending:
+            self.applied[key] = applied
+        else:
+            self.skipped += 1
+        return pending
+
+    def _applied_transforms(self, filepath: str, key: str) -> Dict[str, str]:
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, sha256, transforms FROM notes WHERE path = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return {}
+
+        size, mtime_ns, sha256, transforms = row
+        stat = os.stat(filepath)
+        if stat.st_size != size:
+            return {}
+        if stat.st_mtime_ns != mtime_ns:
+            with open(filepath, "rb") as file:
+                if hashlib.sha256(file.read()).hexdigest() != sha256:
+                    return {}
+
+            # The note was touched without being modified
+            self.connection.execute(
+                "UPDATE notes SET mtime_ns = ? WHERE path = ?",
+                (stat.st_mtime_ns, key),
+            )
+
+        return json.loads(transforms)
+
+    def record(
+        self,
+        filepath: str,
+        data: bytes,
+        modified: bool,
+        names: Optional[Sequence[str]] = None,
+        incomplete: Sequence[str] = (),
+    ) -> None:
+        """Records a processed note.
+
+        Parameters
+        ----------
+        filepath : str
+            Path to the note.
+        data : bytes
+            The contents of the note after processing.
+        modified : bool
+            Whether the note is written with `data`. Processing it again could
+            modify it again, so it is committed right away, and before it is
+            written so that a run interrupted while writing it does not process
+            it again. Call `written` once it is written. Other notes are
+            committed in batches, see `STATE_COMMIT_INTERVAL`, and are only
+            processed again if the run crashes before they are committed.
+        names : Optional[Sequence[str]]
+            The names of the transforms applied to the note, returned by
+            `pending`. Every transform of the run by default.
+        incomplete : Sequence[str]
+            The names of the transforms which degraded code blocks of the note,
+            see `NoteTransform.degraded`. They are not recorded as applied, so
+            later runs apply them again.
+        """
+        key = self._key(filepath)
+        applied = self.applied.pop(key, {})
+        for name in self.versions if names is None else names:
+            if name not in incomplete:
+                applied[name] = self.versions[name]
+
+        if modified:
+            # The modification time is not known until the note is written, so
+            # until then the next run compares the content hash
+            size, mtime_ns = len(data), -1
+        else:
+            stat = os.stat(filepath)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?)",
+            (
+                key,
+                size,
+                mtime_ns,
+                hashlib.sha256(data).hexdigest(),
+                json.dumps(applied, sort_keys=True),
+            ),
+        )
+        if modified or time.monotonic() - self.last_commit >= STATE_COMMIT_INTERVAL:
+            self.save()
+
+    def written(self, filepath: str) -> None:
+        """Records the modification time of a note written after `record`."""
+        self.connection.execute(
+            "UPDATE notes SET mtime_ns = ? WHERE path = ?",
+            (os.stat(filepath).st_mtime_ns, self._key(filepath)),
+        )
+        if time.monotonic() - self.last_commit >= STATE_COMMIT_INTERVAL:
+            self.save()
+
+    def save(self) -> None:
+        """Writes the recorded notes to disk."""
+        self.connection.commit()
+        self.last_commit = time.monotonic()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def transform_note(text: str, transforms: Sequence[NoteTransform]) -> str:
+    """Applies transforms to the code blocks of a note.
+
+    The code blocks are found once, and the transforms are applied in order,
+    each one seeing the changes of the previous ones. The text outside of the
+    code blocks, including their fences, is copied as is.
+
+    Parameters
+    ----------
+    text : str
+        The text to process.
+    transforms : Sequence[NoteTransform]
+        The transforms to apply, in order.
+
+    Returns
+    -------
+    str
+        The modified text.
+    """
+    # The text before each code block, up to where its info string starts
+    segments: List[str] = []
+    code_blocks: List[NoteCodeBlock] = []
+    segment_start = 0
+
+    for code_block in find_code_blocks(text):
+        segments.append(text[segment_start : code_block.info_start])
+        code_blocks.append(
+            NoteCodeBlock(
+                text[code_block.info_start : code_block.content_start],
+                text[code_block.content_start : code_block.content_end],
+                code_block.closed,
+            )
+        )
+        segment_start = code_block.content_end
+
+    if not code_blocks:
+        return text
+
+    for transform in transforms:
+        transform.apply(code_blocks)
+
+    parts = []
+    for segment, code_block in zip(segments, code_blocks):
+        parts.extend((segment, code_block.opening, code_block.content))
+    parts.append(text[segment_start:])
+    return "".join(parts)
+
+
+def find_notes(
+    directory: str,
+    include: Optional[Sequence[str]] = None,
+    exclude: Sequence[str] = (),
+) -> Iterator[str]:
+    """Recursively finds the notes in a directory.
+
+    Directories are listed with `os.scandir`, whose entries tell files from
+    directories without another system call for each of them, and their entries
+    are visited in sorted order. Symbolic links to directories are not followed.
+
+    Glob patterns containing a ``/`` are matched against the path relative to
+    the directory, with ``/`` separators, and other patterns against the name.
+    ``*`` also matches ``/``, so ``archive/*`` matches everything inside the
+    ``archive`` directory.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory.
+    include : Optional[Sequence[str]]
+        Glob patterns of the files to find, `DEFAULT_INCLUDE` by default.
+    exclude : Sequence[str]
+        Glob patterns of the files and directories to skip. Excluded
+        directories are not listed at all.
+
+    Yields
+    ------
+    str
+        The paths of the notes, the files of a directory before its
+        subdirectories.
+    """
+    if include is None:
+        include = DEFAULT_INCLUDE
+
+    # Directories waiting to be listed, with their path relative to `directory`
+    directories = [(directory, "")]
+    while directories:
+        current, relative_current = directories.pop()
+        with os.scandir(current) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+
+        subdirectories = []
+        for entry in entries:
+            relative_path = relative_current + entry.name
+            if _matches(entry.name, relative_path, exclude):
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append((entry.path, relative_path + "/"))
+            elif _matches(entry.name, relative_path, include):
+                yield entry.path
+
+        directories.extend(reversed(subdirectories))
+
+
+def add_scan_arguments(parser: argparse.ArgumentParser) -> None:
+    """Adds the options selecting the notes found by `find_notes`."""
+    parser.add_argument(
+        "--include",
+        action="append",
+        metavar="GLOB",
+        help="Only process the files matching a glob pattern, which is matched "
+        "against the path relative to the directory if it contains a / and the "
+        "file name otherwise. May be repeated (default: *.md)",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Skip the files and directories matching a glob pattern, see "
+        "--include. May be repeated",
+    )
+
+
+def _matches(name: str, relative_path: str, patterns: Sequence[str]) -> bool:
+    return any(
+        fnmatch.fnmatch(relative_path if "/" in pattern else name, pattern)
+        for pattern in patterns
+    )
+
+
+def read_note(filepath: str) -> str:
+    """Reads the text of a note, see `NOTE_ENCODING_ERRORS`."""
+    with open(filepath, "rb") as file:
+        return file.read().decode(NOTE_ENCODING, NOTE_ENCODING_ERRORS)
+
+
+def write_note(filepath: str, text: str) -> None:
+    """Writes the text of a note read with `read_note`, see
+    `write_file_atomically`."""
+    write_file_atomically(filepath, text.encode(NOTE_ENCODING, NOTE_ENCODING_ERRORS))
+
+
+def write_file_atomically(filepath: str, data: bytes) -> None:
+    """Replaces the contents of a file.
+
+    The data is written to a temporary file in the same directory which is then
+    renamed over the file, so that an interrupted write leaves either the old or
+    the new contents rather than a truncated file. The temporary file does not
+    end with ``.md``, so it is never mistaken for a note.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the file.
+    data : bytes
+        The new contents of the file.
+    """
+    directory, filename = os.path.split(filepath)
+    fd, temp_filepath = tempfile.mkstemp(
+        prefix=f".{filename}.", suffix=".tmp", dir=directory or "."
+    )
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        # Temporary files are only readable by their owner, unlike the file
+        # they replace
+        try:
+            os.chmod(temp_filepath, os.stat(filepath).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        os.unlink(temp_filepath)
+        raise
+
+
+def transform_note_data(data: bytes, transforms: Sequence[NoteTransform]) -> bytes:
+    """Applies transforms to the bytes of a note, see `transform_note`."""
+    text = data.decode(NOTE_ENCODING, NOTE_ENCODING_ERRORS)
+    if not has_fences(text):
+        return data
+
+    modified_text = transform_note(text, transforms)
+    if modified_text == text:
+        return data
+
+    return modified_text.encode(NOTE_ENCODING, NOTE_ENCODING_ERRORS)
+
+
+def process_file(
+    filepath: str,
+    process_data: Callable[..., bytes],
+    state: Optional[RunState] = None,
+) -> bool:
+    """Processes a file, reading it once and writing it only if it is modified.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the file.
+    process_data : Callable[..., bytes]
+        Returns the processed contents of the file, see `process_files`.
+    state : Optional[RunState]
+        Records the processed files. Files to which it already recorded every
+        transform being applied are skipped.
+
+    Returns
+    -------
+    bool
+        Whether the file was modified.
+    """
+    names = None
+    if state is not None:
+        pending = state.pending(filepath)
+        if not pending:
+            return False
+        names = _selected_transforms(state, pending)
+
+    data = _read_file(filepath)
+    modified_data, incomplete = _process(process_data, data, names)
+    modified = modified_data != data
+    if state is not None:
+        state.record(filepath, modified_data, modified, names, incomplete)
+
+    if modified:
+        write_file_atomically(filepath, modified_data)
+        if state is not None:
+            state.written(filepath)
+    return modified
+
+
+def process_note_file(
+    filepath: str,
+    transforms: Sequence[NoteTransform],
+    state: Optional[RunState] = None,
+) -> bool:
+    """Applies transforms to a note, reading it once and writing it at most once.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the Markdown file.
+    transforms : Sequence[NoteTransform]
+        The transforms to apply, in order.
+    state : Optional[RunState]
+        Records the processed notes. Notes which it already recorded are
+        skipped.
+
+    Returns
+    -------
+    bool
+        Whether the note was modified.
+    """
+    return process_file(filepath, NoteTransformer(transforms), state)
+
+
+class NoteTransformer:
+    """Applies transforms to the bytes of notes, see `transform_note_data`.
+
+    It can be sent to worker processes if the transforms can be pickled.
+
+    Parameters
+    ----------
+    transforms : Sequence[NoteTransform]
+        The transforms to apply, in order.
+    """
+
+    def __init__(self, transforms: Sequence[NoteTransform]) -> None:
+        self.transforms = transforms
+        #: The names of the transforms which degraded code blocks of the last
+        #: note, see `NoteTransform.degraded`
+        self.incomplete: Tuple[str, ...] = ()
+
+    def __call__(self, data: bytes, names: Optional[Sequence[str]] = None) -> bytes:
+        """Applies the transforms, or only the ones named in `names`."""
+        transforms = self.transforms
+        if names is not None:
+            transforms = [
+                transform for transform in transforms if transform.name in names
+            ]
+
+        degraded = [transform.degraded() for transform in transforms]
+        modified_data = transform_note_data(data, transforms)
+        self.incomplete = tuple(
+            transform.name
+            for transform, count in zip(transforms, degraded)
+            if transform.degraded() > count
+        )
+        return modified_data
+
+
+def _read_file(filepath: str) -> bytes:
+    with open(filepath, "rb") as file:
+        return file.read()
+
+
+def _selected_transforms(
+    state: RunState, pending: List[str]
+) -> Optional[Tuple[str, ...]]:
+    # Transforms are only selected when some of them were already applied, so
+    # functions processing the files with every transform at once keep working
+    return None if len(pending) == len(state.versions) else tuple(pending)
+
+
+def _process(
+    process_data: Callable[..., bytes],
+    data: bytes,
+    names: Optional[Tuple[str, ...]],
+) -> Tuple[bytes, Tuple[str, ...]]:
+    processed_data = process_data(data) if names is None else process_data(data, names)
+    # The transforms which degraded code blocks are reported by NoteTransformer
+    return processed_data, getattr(process_data, "incomplete", ())
+
+
+# The function processing files in each worker process
+_worker_process_data: Optional[Callable[..., bytes]] = None
+
+
+def _init_worker(process_data: Callable[..., bytes]) -> None:
+    global _worker_process_data
+    _worker_process_data = process_data
+
+
+def _modified_data(
+    process_data: Callable[..., bytes],
+    data: bytes,
+    names: Optional[Tuple[str, ...]],
+) -> ProcessedData:
+    # Unmodified files are not sent back from worker processes
+    modified_data, incomplete = _process(process_data, data, names)
+    return modified_data if modified_data != data else None, incomplete
+
+
+def _modified_data_task(data: bytes, names: Optional[Tuple[str, ...]]) -> ProcessedData:
+    return _modified_data(_worker_process_data, data, names)
+
+
+def _in_order(
+    items: Iterable[T], submit: Callable[[T], Future], size: int
+) -> Iterator[Tuple[T, Any]]:
+    """Submits work for every item, with at most `size` items in flight, and
+    yields the items with the results of their work in order."""
+    pending: Deque[Tuple[T, Future]] = deque()
+    for item in items:
+        pending.append((item, submit(item)))
+        if len(pending) >= size:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def process_files(
+    filepaths: Iterable[str],
+    process_data: Callable[..., bytes],
+    state: Optional[RunState] = None,
+    jobs: int = 1,
+    io_threads: int = DEFAULT_IO_THREADS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+) -> Iterator[Tuple[str, bool]]:
+    """Processes files while reading and writing other files concurrently.
+
+    Files are read by a pool of I/O threads, processed in this process or by
+    worker processes, and written back by the I/O threads if they are modified.
+    Every stage is fed by a bounded queue, so waiting for slow storage such as
+    a network share overlaps with processing while at most a few times
+    `queue_size` files are held in memory, however many files there are.
+
+    Parameters
+    ----------
+    filepaths : Iterable[str]
+        Paths to the files, which are consumed as the files are processed.
+    process_data : Callable[..., bytes]
+        Returns the processed contents of a file. When `state` recorded some of
+        its transforms as applied to the file already, it is also given the
+        names of the other transforms, which are the only ones to apply, see
+        `NoteTransformer`. With more than one job, it is pickled once for each
+        worker process.
+    state : Optional[RunState]
+        Records the processed files. Files to which it already recorded every
+        transform being applied are skipped.
+    jobs : int
+        The number of worker processes to use. 1 processes the files in the
+        current process and 0 uses one worker per CPU.
+    io_threads : int
+        The number of threads reading and writing files.
+    queue_size : int
+        The maximum number of files waiting in each stage.
+
+    Yields
+    ------
+    Tuple[str, bool]
+        The path of every processed file and whether it was modified, in the
+        order of `filepaths`.
+    """
+    pending_files: Iterable[PendingFile]
+    if state is None:
+        pending_files = ((filepath, None) for filepath in filepaths)
+    else:
+        pending_files = _pending_files(filepaths, state)
+
+    with ExitStack() as stack:
+        io = stack.enter_context(ThreadPoolExecutor(io_threads))
+        reads = _in_order(
+            pending_files, lambda item: io.submit(_read_file, item[0]), queue_size
+        )
+
+        if jobs == 1:
+            processed: Iterator[Tuple[Tuple[PendingFile, bytes], ProcessedData]] = (
+                ((item, data), _modified_data(process_data, data, item[1]))
+                for item, data in reads
+            )
+        else:
+            workers = stack.enter_context(
+                ProcessPoolExecutor(
+                    jobs or None, initializer=_init_worker, initargs=(process_data,)
+                )
+            )
+            processed = _in_order(
+                reads,
+                lambda read: workers.submit(_modified_data_task, read[1], read[0][1]),
+                queue_size,
+            )
+
+        def write(item: Tuple[Tuple[PendingFile, bytes], ProcessedData]) -> Future:
+            ((filepath, names), data), (modified_data, incomplete) = item
+            modified = modified_data is not None
+            if state is not None:
+                # Recorded before the write is queued, see `RunState.record`
+                state.record(
+                    filepath,
+                    modified_data if modified else data,
+                    modified,
+                    names,
+                    incomplete,
+                )
+
+            if not modified:
+                future: Future = Future()
+                future.set_result(None)
+                return future
+
+            return io.submit(write_file_atomically, filepath, modified_data)
+
+        for (((filepath, _), _), (modified_data, _)), _ in _in_order(
+            processed, write, queue_size
+        ):
+            modified = modified_data is not None
+            if modified and state is not None:
+                state.written(filepath)
+            yield filepath, modified
+
+
+def _pending_files(filepaths: Iterable[str], state: RunState) -> Iterator[PendingFile]:
+    for filepath in filepaths:
+        pending = state.pending(filepath)
+        if pending:
+            yield filepath, _selected_transforms(state, pending)
+
+
+def process_notes(
+    directory: str,
+    transforms: Sequence[NoteTransform],
+    state: Optional[RunState] = None,
+    jobs: int = 1,
+    io_threads: int = DEFAULT_IO_THREADS,
+    include: Optional[Sequence[str]] = None,
+    exclude: Sequence[str] = (),
+) -> None:
+    """Applies transforms to every note in a single pass over the directory.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory containing Markdown files.
+    transforms : Sequence[NoteTransform]
+        The transforms to apply, in order. With more than one job, they must
+        be picklable.
+    state : Optional[RunState]
+        Records the processed notes so that later runs skip them, or only apply
+        the transforms which were not applied to them yet.
+    jobs : int
+        The number of worker processes to use, see `process_files`.
+    io_threads : int
+        The number of threads reading and writing notes.
+    include : Optional[Sequence[str]]
+        Glob patterns of the notes to process, see `find_notes`.
+    exclude : Sequence[str]
+        Glob patterns of the files and directories to skip, see `find_notes`.
+    """
+    for filepath, modified in process_files(
+        find_notes(directory, include, exclude),
+        NoteTransformer(transforms),
+        state,
+        jobs,
+        io_threads,
+    ):
+        if modified:
+            print(f"Processed: {filepath}")
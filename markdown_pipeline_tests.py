@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""Unit tests to exercise applying several post-processing steps to notes at
+once."""
+import contextlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import add_code_block_language
+import fix_code_block_backslashes
+from add_code_block_language import AddLanguageTransform
+from fix_code_block_backslashes import FixBackslashesTransform
+from markdown_pipeline import (
+    NoteCodeBlock,
+    NoteTransform,
+    NoteTransformer,
+    RunState,
+    find_notes,
+    process_files,
+    process_note_file,
+    process_notes,
+    transform_note,
+    write_file_atomically,
+)
+
+NOTE = """# Page
+\\<text\\>
+```
+\\<html\\>
+```
+~~~python
+print("\\<")
+~~~
+```
+\\<unclosed\\>
+"""
+
+
+def detect_language(code_block_text: str) -> str:
+    return "html" if "<html>" in code_block_text else "text"
+
+
+class RecordingTransform(NoteTransform):
+    name = "record"
+
+    def __init__(self, tag="1"):
+        self.tag = tag
+        self.calls = []
+
+    def version(self):
+        return f"{self.name} {self.tag}"
+
+    def apply(self, code_blocks):
+        self.calls.append(
+            [(cb.opening, cb.content, cb.closed, cb.info) for cb in code_blocks]
+        )
+
+
+class TestTransformNote(unittest.TestCase):
+    def test_transforms_in_order(self):
+        transforms = [
+            FixBackslashesTransform(),
+            AddLanguageTransform(detect_language),
+        ]
+
+        self.assertEqual(
+            transform_note(NOTE, transforms),
+            add_code_block_language.process_note(
+                fix_code_block_backslashes.process_note(NOTE), detect_language
+            ),
+        )
+
+    def test_code_blocks(self):
+        transform = RecordingTransform()
+
+        self.assertEqual(transform_note(NOTE, [transform]), NOTE)
+        self.assertEqual(
+            transform.calls,
+            [
+                [
+                    ("\n", "\\<html\\>\n", True, ""),
+                    ("python\n", 'print("\\<")\n', True, "python"),
+                    ("\n", "\\<unclosed\\>\n", False, ""),
+                ]
+            ],
+        )
+
+    def test_no_code_blocks(self):
+        transform = RecordingTransform()
+
+        self.assertEqual(transform_note("\\<text\\>\n", [transform]), "\\<text\\>\n")
+        self.assertEqual(transform.calls, [])
+
+    def test_note_code_block_info(self):
+        self.assertEqual(NoteCodeBlock(" python \r\n", "", True).info, "python")
+
+
+class TestProcessNoteFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filepath = os.path.join(self.tmp.name, "page.md")
+
+    def test_bytes_outside_code_blocks_preserved(self):
+        with open(self.filepath, "wb") as file:
+            file.write(b"\xff\\<\r\n```\r\n\\<\xe9\r\n```\r\n")
+
+        self.assertTrue(process_note_file(self.filepath, [FixBackslashesTransform()]))
+        with open(self.filepath, "rb") as file:
+            self.assertEqual(file.read(), b"\xff\\<\r\n```\r\n<\xe9\r\n```\r\n")
+
+    def test_unmodified_note_not_written(self):
+        with open(self.filepath, "w") as file:
+            file.write("```python\nx = 5\n```\n")
+        os.utime(self.filepath, ns=(0, 0))
+
+        self.assertFalse(process_note_file(self.filepath, [FixBackslashesTransform()]))
+        self.assertEqual(os.stat(self.filepath).st_mtime_ns, 0)
+
+
+class TestWriteFileAtomically(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filepath = os.path.join(self.tmp.name, "page.md")
+        with open(self.filepath, "wb") as file:
+            file.write(b"old")
+        os.chmod(self.filepath, 0o644)
+
+    def test_replaces_file(self):
+        write_file_atomically(self.filepath, b"new")
+
+        with open(self.filepath, "rb") as file:
+            self.assertEqual(file.read(), b"new")
+        self.assertEqual(os.stat(self.filepath).st_mode & 0o777, 0o644)
+        self.assertEqual(os.listdir(self.tmp.name), ["page.md"])
+
+    def test_interrupted_write(self):
+        with mock.patch("os.replace", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                write_file_atomically(self.filepath, b"new")
+
+        with open(self.filepath, "rb") as file:
+            self.assertEqual(file.read(), b"old")
+        self.assertEqual(os.listdir(self.tmp.name), ["page.md"])
+
+    def test_new_file(self):
+        filepath = os.path.join(self.tmp.name, "new.md")
+
+        write_file_atomically(filepath, b"new")
+
+        with open(filepath, "rb") as file:
+            self.assertEqual(file.read(), b"new")
+
+
+class TestRunState(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.state_filename = os.path.join(self.tmp.name, "state.sqlite")
+        self.filepath = os.path.join(self.tmp.name, "page.md")
+        # Removing backslashes twice would leave a single one
+        self.write("```\n\\\\\\<html\\>\n```\n")
+
+    def write(self, text):
+        with open(self.filepath, "w") as file:
+            file.write(text)
+
+    def read(self):
+        with open(self.filepath) as file:
+            return file.read()
+
+    def process(self, *transforms):
+        state = RunState(self.state_filename, transforms)
+        process_note_file(self.filepath, transforms, state)
+        state.save()
+        state.close()
+        return state
+
+    def test_skips_processed_note(self):
+        transform = RecordingTransform()
+        self.process(FixBackslashesTransform(), transform)
+
+        self.assertEqual(len(transform.calls), 1)
+        state = self.process(FixBackslashesTransform(), transform)
+        self.assertEqual(len(transform.calls), 1)
+        self.assertEqual(state.skipped, 1)
+        self.assertEqual(self.read(), "```\n\\\\<html>\n```\n")
+
+    def test_processes_modified_note(self):
+        self.process(FixBackslashesTransform())
+        self.write("```\n\\<body\\>\n```\n")
+
+        self.process(FixBackslashesTransform())
+
+        self.assertEqual(self.read(), "```\n<body>\n```\n")
+
+    def test_skips_touched_note_with_same_contents(self):
+        transform = RecordingTransform()
+        self.process(transform)
+        os.utime(self.filepath, ns=(0, 0))
+
+        self.process(transform)
+
+        self.assertEqual(len(transform.calls), 1)
+
+    def test_applies_changed_transforms_only(self):
+        self.process(FixBackslashesTransform(), RecordingTransform("1"))
+        transform = RecordingTransform("2")
+
+        self.process(FixBackslashesTransform(), transform)
+
+        self.assertEqual(transform.calls, [[("\n", "\\\\<html>\n", True, "")]])
+        self.assertEqual(self.read(), "```\n\\\\<html>\n```\n")
+
+    def test_applies_new_transforms_only(self):
+        self.process(FixBackslashesTransform())
+        transform = RecordingTransform()
+
+        self.process(FixBackslashesTransform(), transform)
+        # Every transform of these runs was already applied
+        self.process(transform)
+        state = self.process(FixBackslashesTransform())
+
+        self.assertEqual(len(transform.calls), 1)
+        self.assertEqual(state.skipped, 1)
+        self.assertEqual(self.read(), "```\n\\\\<html>\n```\n")
+
+    def test_modified_notes_committed_right_away(self):
+        transforms = [FixBackslashesTransform()]
+        state = RunState(self.state_filename, transforms)
+        other_filepath = os.path.join(self.tmp.name, "other.md")
+        with open(other_filepath, "w") as file:
+            file.write("```python\nx = 5\n```\n")
+
+        process_note_file(self.filepath, transforms, state)
+        process_note_file(other_filepath, transforms, state)
+        # Closing the state without saving it discards what was not committed
+        state.close()
+
+        # A run which crashed now resumes with the modified note only
+        resumed_state = RunState(self.state_filename, transforms)
+        self.addCleanup(resumed_state.close)
+        self.assertEqual(resumed_state.pending(self.filepath), [])
+        self.assertEqual(resumed_state.pending(other_filepath), ["fix-backslashes"])
+        self.assertEqual(resumed_state.skipped, 1)
+
+
+class TestProcessNotes(unittest.TestCase):
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "section"))
+            for name in ["page.md", "section/page.md", "page.txt"]:
+                with open(os.path.join(tmp, name), "w") as file:
+                    file.write(NOTE)
+
+            process_notes(
+                tmp, [FixBackslashesTransform(), AddLanguageTransform(detect_language)]
+            )
+
+            expected = transform_note(
+                NOTE, [FixBackslashesTransform(), AddLanguageTransform(detect_language)]
+            )
+            for name, text in [
+                ("page.md", expected),
+                ("section/page.md", expected),
+                ("page.txt", NOTE),
+            ]:
+                with open(os.path.join(tmp, name)) as file:
+                    self.assertEqual(file.read(), text)
+
+
+def upper_case(data: bytes) -> bytes:
+    return data.upper()
+
+
+class UpperCaseTransform(NoteTransform):
+    name = "upper-case"
+
+
+class TestFindNotes(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for directory in ["b", "a", "a/drafts", "archive"]:
+            os.mkdir(os.path.join(self.tmp.name, directory))
+        for name in [
+            "z.md",
+            "c.txt",
+            "a/x.md",
+            "a/drafts/y.md",
+            "b/y.md",
+            "archive/old.md",
+        ]:
+            open(os.path.join(self.tmp.name, name), "w").close()
+
+    def find(self, include=None, exclude=()):
+        return [
+            os.path.relpath(filepath, self.tmp.name).replace(os.sep, "/")
+            for filepath in find_notes(self.tmp.name, include, exclude)
+        ]
+
+    def test_sorted_order(self):
+        self.assertEqual(
+            self.find(), ["z.md", "a/x.md", "a/drafts/y.md", "archive/old.md", "b/y.md"]
+        )
+
+    def test_include(self):
+        self.assertEqual(
+            self.find(include=["*.txt", "a/*"]), ["c.txt", "a/x.md", "a/drafts/y.md"]
+        )
+
+    def test_exclude(self):
+        self.assertEqual(
+            self.find(exclude=["drafts", "archive/*", "z.md"]), ["a/x.md", "b/y.md"]
+        )
+
+
+class TestProcessFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filepaths = []
+        for i in range(20):
+            filepath = os.path.join(self.tmp.name, f"{i}.md")
+            with open(filepath, "wb") as file:
+                file.write(b"NOTE" if i % 3 == 0 else f"note {i}".encode())
+            self.filepaths.append(filepath)
+
+    def check(self, results):
+        self.assertEqual(
+            results,
+            [(filepath, i % 3 != 0) for i, filepath in enumerate(self.filepaths)],
+        )
+        for i, filepath in enumerate(self.filepaths):
+            with open(filepath, "rb") as file:
+                self.assertEqual(
+                    file.read(), b"NOTE" if i % 3 == 0 else f"NOTE {i}".encode()
+                )
+
+    def test_sequential(self):
+        self.check(
+            list(process_files(self.filepaths, upper_case, io_threads=4, queue_size=3))
+        )
+
+    def test_parallel(self):
+        self.check(
+            list(process_files(self.filepaths, upper_case, jobs=2, queue_size=3))
+        )
+
+    def test_state(self):
+        state = RunState(
+            os.path.join(self.tmp.name, "state.sqlite"), [UpperCaseTransform()]
+        )
+        self.addCleanup(state.close)
+        list(process_files(self.filepaths[:10], upper_case, state))
+
+        results = list(process_files(self.filepaths, upper_case, state))
+
+        self.assertEqual([filepath for filepath, _ in results], self.filepaths[10:])
+        self.assertEqual(state.skipped, 10)
+
+    def test_interrupted_with_state(self):
+        for filepath in self.filepaths:
+            with open(filepath, "w") as file:
+                file.write("```\n\\\\\\<html\\>\n```\n")
+        state_filename = os.path.join(self.tmp.name, "state.sqlite")
+        transforms = [FixBackslashesTransform()]
+        with contextlib.closing(RunState(state_filename, transforms)) as state:
+            results = process_files(
+                self.filepaths, NoteTransformer(transforms), state, queue_size=8
+            )
+            next(results)
+            # Writes queued after the first result still complete
+            results.close()
+
+        with contextlib.closing(RunState(state_filename, transforms)) as state:
+            list(process_files(self.filepaths, NoteTransformer(transforms), state))
+
+        # The backslashes of every note were only removed once
+        for filepath in self.filepaths:
+            with open(filepath) as file:
+                self.assertEqual(file.read(), "```\n\\\\<html>\n```\n")
+
+    def test_state_with_new_transforms(self):
+        filepath = self.filepaths[0]
+        with open(filepath, "w") as file:
+            file.write("```\n\\\\\\<html\\>\n```\n")
+        state_filename = os.path.join(self.tmp.name, "state.sqlite")
+        transforms = [FixBackslashesTransform()]
+        with contextlib.closing(RunState(state_filename, transforms)) as state:
+            list(process_files([filepath], NoteTransformer(transforms), state))
+
+        # The backslashes are not removed again, in the worker processes either
+        transforms.append(AddLanguageTransform(detect_language))
+        with contextlib.closing(RunState(state_filename, transforms)) as state:
+            results = list(
+                process_files([filepath], NoteTransformer(transforms), state, jobs=2)
+            )
+
+        self.assertEqual(results, [(filepath, True)])
+        with open(filepath) as file:
+            self.assertEqual(file.read(), "```html\n\\\\<html>\n```\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
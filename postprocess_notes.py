@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Recursively processes Markdown files in a directory with several
+post-processing steps at once, reading and writing every file only once."""
+import argparse
+from typing import List
+
+from add_code_block_language import (
+    AddLanguageTransform,
+    add_detector_arguments,
+    create_detector,
+)
+from fix_code_block_backslashes import FixBackslashesTransform
+from markdown_pipeline import (
+    DEFAULT_IO_THREADS,
+    RunState,
+    add_scan_arguments,
+    process_notes,
+)
+
+TRANSFORMS = [FixBackslashesTransform.name, AddLanguageTransform.name]
+
+
+def parse_transforms(value: str) -> List[str]:
+    """Parses a comma-separated list of distinct names in `TRANSFORMS`."""
+    names = value.split(",")
+    for i, name in enumerate(names):
+        if name not in TRANSFORMS:
+            raise argparse.ArgumentTypeError(
+                f"invalid transform: {name!r} (choose from {', '.join(TRANSFORMS)})"
+            )
+        # Transforms such as removing backslashes must not be applied twice
+        if name in names[:i]:
+            raise argparse.ArgumentTypeError(f"repeated transform: {name!r}")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "directory", help="Path to the directory containing Markdown files"
+    )
+    parser.add_argument(
+        "--transforms",
+        type=parse_transforms,
+        default=[FixBackslashesTransform.name],
+        metavar="TRANSFORM[,TRANSFORM]",
+        help="Comma-separated post-processing steps applied to every note, in "
+        f"order: {FixBackslashesTransform.name} removes erroneous backslashes in "
+        f"code blocks and {AddLanguageTransform.name} adds the language to code "
+        f"blocks without one (default: {FixBackslashesTransform.name})",
+    )
+    parser.add_argument(
+        "--state",
+        metavar="FILE",
+        help="SQLite file recording the processed notes and the transforms "
+        "applied to them, so that later runs only apply the transforms which are "
+        "new or changed to the notes processed before, and every transform to "
+        "new or modified notes",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used to process notes in parallel, 0 "
+        "uses one per CPU (default: 1). Cannot be used with "
+        f"{AddLanguageTransform.name}, see add_code_block_language.py --jobs",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=DEFAULT_IO_THREADS,
+        help="Number of threads reading and writing notes while others are "
+        "processed (default: %(default)s)",
+    )
+    add_scan_arguments(parser)
+    add_detector_arguments(parser)
+    args = parser.parse_args()
+
+    if args.jobs < 0:
+        parser.error("--jobs must not be negative")
+    if args.io_threads < 1:
+        parser.error("--io-threads must be at least 1")
+    if args.jobs != 1 and AddLanguageTransform.name in args.transforms:
+        parser.error(f"--jobs cannot be combined with {AddLanguageTransform.name}")
+
+    transforms = []
+    detector = None
+    cache = None
+    for name in args.transforms:
+        if name == FixBackslashesTransform.name:
+            transforms.append(FixBackslashesTransform())
+        elif name == AddLanguageTransform.name:
+            detector = create_detector(parser, args)
+            cache = detector.cache
+            transforms.append(AddLanguageTransform(detector))
+
+    state = None
+    if args.state is not None:
+        state = RunState(args.state, transforms)
+
+    try:
+        process_notes(
+            args.directory,
+            transforms,
+            state,
+            args.jobs,
+            args.io_threads,
+            args.include,
+            args.exclude,
+        )
+    finally:
+        if cache is not None:
+            cache.save()
+            cache.close()
+        if state is not None:
+            state.save()
+            state.close()
+
+    if state is not None:
+        print(f"Skipped {state.skipped} notes which were already processed")
+    if detector is not None:
+        print(f"Detected languages: {detector.summary()}")
+    print("Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Unit tests to exercise the command line applying several post-processing
+steps to notes at once."""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import add_code_block_language
+from postprocess_notes import main
+
+NOTE = """```
+\\<html\\>
+```
+```
+#!/bin/sh
+ls
+```
+"""
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filepath = os.path.join(self.tmp.name, "page.md")
+        with open(self.filepath, "w") as file:
+            file.write(NOTE)
+
+        # The command line sets whether to use the daemon for the whole module
+        patcher = mock.patch.object(
+            add_code_block_language, "use_daemon", add_code_block_language.use_daemon
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_main(self, *args):
+        with mock.patch.object(sys, "argv", ["postprocess_notes.py", *args]):
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                main()
+        return stdout.getvalue()
+
+    def read(self):
+        with open(self.filepath) as file:
+            return file.read()
+
+    def test_transforms_before_directory(self):
+        self.run_main(
+            "--transforms",
+            "fix-backslashes,add-language",
+            "--backend",
+            "heuristic",
+            "--no-daemon",
+            self.tmp.name,
+        )
+
+        self.assertEqual(
+            self.read(), "```html\n<html>\n```\n```shell\n#!/bin/sh\nls\n```\n"
+        )
+
+    def test_default_transforms(self):
+        output = self.run_main(self.tmp.name)
+
+        self.assertIn(f"Processed: {self.filepath}", output)
+        self.assertEqual(self.read(), NOTE.replace("\\", ""))
+
+    def test_invalid_transform(self):
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                self.run_main("--transforms", "fix-backslashes,unknown", self.tmp.name)
+
+        self.assertIn("invalid transform: 'unknown'", stderr.getvalue())
+        self.assertEqual(self.read(), NOTE)
+
+    def test_repeated_transform(self):
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                self.run_main(
+                    "--transforms", "fix-backslashes,fix-backslashes", self.tmp.name
+                )
+
+        self.assertIn("repeated transform: 'fix-backslashes'", stderr.getvalue())
+        self.assertEqual(self.read(), NOTE)
+
+    def test_detector_arguments(self):
+        output = self.run_main(
+            "--transforms",
+            "add-language",
+            "--backend",
+            "heuristic",
+            "--no-heuristics",
+            "--time-budget",
+            "0",
+            "--fallback",
+            "none",
+            "--no-daemon",
+            self.tmp.name,
+        )
+
+        self.assertIn("2 degraded to none", output)
+        self.assertEqual(self.read(), NOTE)
+
+    def test_state(self):
+        state_filename = os.path.join(self.tmp.name, "state.sqlite")
+        self.run_main("--state", state_filename, self.tmp.name)
+
+        output = self.run_main("--state", state_filename, self.tmp.name)
+
+        self.assertIn("Skipped 1 notes which were already processed", output)
+
+
+if __name__ == "__main__":
+    unittest.main()
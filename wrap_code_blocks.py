@@ -1,10 +1,71 @@
 """Wraps paragraphs formatted with the OneNote code style font in a Markdown code block"""
-import docx
 import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Union,
+)
+
+import docx
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsmap, qn
+from lxml import etree
+
+from docx_package import document_partname, read_part, replace_part, styles_partname
 
 CODE_STYLE_FONT_NAME: str = "Consolas"
 SPACE_UNICODE_CODE: int = 0x20
 NON_BREAKING_SPACE_UNICODE_CODE: int = 0xA0
+NON_BREAKING_SPACE: str = chr(NON_BREAKING_SPACE_UNICODE_CODE)
+
+LEADING_WHITESPACE_REGEX = re.compile(f"[ {NON_BREAKING_SPACE}]*")
+LEADING_SPACE_REGEX = re.compile(f"(?<!{NON_BREAKING_SPACE}) ")
+
+# The stream engine only rewrites the main document part of the package while
+# the docx engine loads and saves the whole package through python-docx
+STREAM_ENGINE: str = "stream"
+DOCX_ENGINE: str = "docx"
+ENGINES = (STREAM_ENGINE, DOCX_ENGINE)
+
+# Matches the style and font elements which determine the font of the first run
+# of every body paragraph, in document order
+PARAGRAPH_FONT_XPATH = etree.XPath(
+    "w:p/w:pPr/w:pStyle | w:p/w:r[1]/w:rPr/w:rStyle | w:p/w:r[1]/w:rPr/w:rFonts",
+    namespaces=nsmap,
+)
+
+# Matches the elements making up the text of a paragraph, in document order.
+# Their string values are the text equivalents used by python-docx.
+RUN_CONTENT_TAGS = ("w:br", "w:cr", "w:noBreakHyphen", "w:ptab", "w:t", "w:tab")
+PARAGRAPH_TEXT_XPATH = etree.XPath(
+    " | ".join(
+        f"{parent}/{tag}"
+        for parent in ("w:r", "w:hyperlink/w:r")
+        for tag in RUN_CONTENT_TAGS
+    ),
+    namespaces=nsmap,
+)
+RUN_SPECIAL_CHARACTERS_REGEX = re.compile(r"([\t\r\n])")
+
+CACHE_VERSION: int = 2
+HASH_BUFFER_SIZE: int = 1024 * 1024
 
 
 def replace_leading_spaces(text: str) -> str:
@@ -23,109 +84,986 @@ def replace_leading_spaces(text: str) -> str:
     str
         The updated text.
     """
-    if len(text) == 0:
+    leading = LEADING_WHITESPACE_REGEX.match(text).end()
+    if leading == 0:
+        return text
+
+    # Substitute every leading space not already preceded by a non-breaking
+    # space with a non-breaking space plus a normal space
+    return (
+        LEADING_SPACE_REGEX.sub(NON_BREAKING_SPACE + " ", text[:leading])
+        + text[leading:]
+    )
+
+
+def close_code_block(lines: List[str]) -> None:
+    """Appends triple backticks to the last non-empty line of a code block.
+
+    Parameters
+    ----------
+    lines : List[str]
+        The lines of the code block, each ending with a newline.
+    """
+    index = len(lines) - 1
+    # Trailing empty lines stay after the end of the block
+    while index > 0 and len(lines[index].strip()) == 0:
+        index -= 1
+
+    # The line already ends with a line break so a newline does not need to be
+    # added
+    lines[index] += "```"
+
+
+def create_code_block_paragraph(lines: List[str]):
+    """Creates a paragraph holding the lines of a code block.
+
+    Every line is added as its own run and the newline ending each line becomes
+    a line break. We must use line breaks instead of paragraph breaks otherwise
+    pandoc will output incorrect newlines into the code block.
+
+    Parameters
+    ----------
+    lines : List[str]
+        The lines of the code block, including the backticks.
+
+    Returns
+    -------
+    CT_P
+        The new w:p element.
+    """
+    paragraph = OxmlElement("w:p")
+    run_tag, text_tag = qn("w:r"), qn("w:t")
+    tab_tag, break_tag = qn("w:tab"), qn("w:br")
+    space_attribute = qn("xml:space")
+
+    for line in lines:
+        run = etree.SubElement(paragraph, run_tag)
+        # Map tabs and newlines to w:tab and w:br elements the same way setting
+        # the text of a python-docx run does
+        for part in RUN_SPECIAL_CHARACTERS_REGEX.split(line):
+            if part == "\t":
+                etree.SubElement(run, tab_tag)
+            elif part in ("\r", "\n"):
+                etree.SubElement(run, break_tag)
+            elif len(part) > 0:
+                text = etree.SubElement(run, text_tag)
+                text.text = part
+                if len(part.strip()) < len(part):
+                    text.set(space_attribute, "preserve")
+
+    return paragraph
+
+
+def paragraph_text(paragraph) -> str:
+    """Returns the text of a paragraph as python-docx does.
+
+    Tabs and line breaks are mapped to ``\\t`` and ``\\n`` characters.
+
+    Parameters
+    ----------
+    paragraph
+        The w:p element.
+
+    Returns
+    -------
+    str
+        The text of the paragraph.
+    """
+    return "".join([str(e) for e in PARAGRAPH_TEXT_XPATH(paragraph)])
+
+
+def rfonts_name(rfonts) -> Optional[str]:
+    """Returns the font name set by a w:rFonts element.
+
+    Parameters
+    ----------
+    rfonts
+        The w:rFonts element, or None.
+
+    Returns
+    -------
+    Optional[str]
+        The font name, an empty string for theme fonts, or None if the element
+        does not set a font.
+    """
+    if rfonts is None:
+        return None
+
+    font = rfonts.get(qn("w:ascii"))
+    if font is None and rfonts.get(qn("w:asciiTheme")) is not None:
         return ""
+    return font
+
+
+class StyleFonts:
+    """Resolves the fonts set by the styles of a document.
+
+    The fonts are computed once per document, following the ``w:basedOn``
+    inheritance of every style, so that looking up the font of a style is a
+    single dictionary access.
+
+    Parameters
+    ----------
+    styles
+        The w:styles element of the document, or None if it has no styles.
+    """
+
+    def __init__(self, styles=None) -> None:
+        self.default_font: Optional[str] = None
+        self.default_paragraph_style: Optional[str] = None
+        self.fonts: Dict[str, Optional[str]] = {}
+
+        if styles is None:
+            return
+
+        self.default_font = rfonts_name(
+            styles.find(
+                f"{qn('w:docDefaults')}/{qn('w:rPrDefault')}/{qn('w:rPr')}/{qn('w:rFonts')}"
+            )
+        )
+
+        direct_fonts = {}
+        based_on = {}
+        for style in styles.iterchildren(qn("w:style")):
+            style_id = style.get(qn("w:styleId"))
+            direct_fonts[style_id] = rfonts_name(
+                style.find(f"{qn('w:rPr')}/{qn('w:rFonts')}")
+            )
+            parent = style.find(qn("w:basedOn"))
+            if parent is not None:
+                based_on[style_id] = parent.get(qn("w:val"))
+            if style.get(qn("w:type")) == "paragraph" and style.get(
+                qn("w:default")
+            ) in ("1", "true", "on"):
+                self.default_paragraph_style = style_id
+
+        for style_id in direct_fonts:
+            font = None
+            visited = set()
+            current = style_id
+            while current is not None and current not in visited:
+                visited.add(current)
+                font = direct_fonts.get(current)
+                if font is not None:
+                    break
+                current = based_on.get(current)
+            self.fonts[style_id] = font
+
+    def style_font(self, style_id: Optional[str]) -> Optional[str]:
+        """Returns the font set by a style or the styles it is based on.
+
+        Parameters
+        ----------
+        style_id : Optional[str]
+            The id of the style.
+
+        Returns
+        -------
+        Optional[str]
+            The font name, or None if the style does not set a font.
+        """
+        return self.fonts.get(style_id)
+
+    def code_style_ids(self) -> Set[str]:
+        """Returns the ids of the styles which set the code style font."""
+        return {
+            style_id
+            for style_id, font in self.fonts.items()
+            if font == CODE_STYLE_FONT_NAME
+        }
+
+    def default_is_code(self) -> bool:
+        """Returns whether unstyled text uses the code style font."""
+        font = self.style_font(self.default_paragraph_style)
+        if font is None:
+            font = self.default_font
+        return font == CODE_STYLE_FONT_NAME
+
+
+def may_contain_code(document_xml: bytes, style_fonts: StyleFonts) -> bool:
+    """Checks whether a document part could contain code style paragraphs.
+
+    This is a cheap scan of the raw XML which allows documents without any code
+    style text to be skipped without parsing them. Text can only be in the code
+    style font if the document sets the font directly, or references a style
+    which sets it.
+
+    Parameters
+    ----------
+    document_xml : bytes
+        The raw XML of the main document part.
+    style_fonts : StyleFonts
+        The fonts set by the styles of the document.
+
+    Returns
+    -------
+    bool
+        False if the document cannot contain a code block.
+    """
+    if CODE_STYLE_FONT_NAME.encode("utf-8") in document_xml:
+        return True
+
+    if style_fonts.default_is_code():
+        return True
+
+    for style_id in style_fonts.code_style_ids():
+        pattern = rb"""val=["']""" + re.escape(style_id.encode("utf-8")) + rb"""["']"""
+        if re.search(pattern, document_xml):
+            return True
+
+    return False
+
+
+def find_code_paragraphs(body, style_fonts: StyleFonts) -> List[bool]:
+    """Finds the body paragraphs formatted with the code style font.
+
+    A paragraph is formatted with the code style font if its first run is, either
+    directly or through its character style, its paragraph style, or the
+    document defaults. The elements which determine the font of every paragraph
+    are gathered with a single XPath query.
+
+    Parameters
+    ----------
+    body
+        The w:body element of the document.
+    style_fonts : StyleFonts
+        The fonts set by the styles of the document.
+
+    Returns
+    -------
+    List[bool]
+        Whether each w:p child of the body is a code style paragraph, in
+        document order.
+    """
+    paragraph_style_tag = qn("w:pStyle")
+    run_style_tag = qn("w:rStyle")
+
+    direct_fonts = {}
+    run_styles = {}
+    paragraph_styles = {}
+    for element in PARAGRAPH_FONT_XPATH(body):
+        if element.tag == paragraph_style_tag:
+            # w:p/w:pPr/w:pStyle
+            paragraph_styles[element.getparent().getparent()] = element.get(qn("w:val"))
+            continue
+
+        # w:p/w:r/w:rPr/w:rStyle or w:p/w:r/w:rPr/w:rFonts
+        paragraph = element.getparent().getparent().getparent()
+        if element.tag == run_style_tag:
+            run_styles[paragraph] = element.get(qn("w:val"))
+        else:
+            direct_fonts[paragraph] = rfonts_name(element)
+
+    default_font = style_fonts.default_font
+    default_paragraph_style = style_fonts.default_paragraph_style
+
+    code_paragraphs = []
+    for p in body.iterchildren(qn("w:p")):
+        font = direct_fonts.get(p)
+        if font is None:
+            font = style_fonts.style_font(run_styles.get(p))
+        if font is None:
+            font = style_fonts.style_font(
+                paragraph_styles.get(p, default_paragraph_style)
+            )
+        if font is None:
+            font = default_font
+        code_paragraphs.append(font == CODE_STYLE_FONT_NAME)
+
+    return code_paragraphs
+
+
+def add_language_to_wrapped_code_block(
+    paragraph, detect_language: Callable[[str], str]
+) -> bool:
+    """Adds the language to a code block wrapped without one by an earlier run.
+
+    Wrapped code blocks are no longer formatted with the code style font, so
+    they are recognized by the backticks around their text instead.
+
+    Parameters
+    ----------
+    paragraph
+        A w:p element which is not a code style paragraph.
+    detect_language : Callable[[str], str]
+        Returns the language of the text of a code block, see `wrap_paragraphs`.
+
+    Returns
+    -------
+    bool
+        True if the language was added.
+    """
+    first_text = paragraph.find(f"{qn('w:r')}/{qn('w:t')}")
+    if first_text is None or first_text.text != "```":
+        return False
+
+    text = paragraph_text(paragraph).rstrip()
+    if not text.startswith("```\n") or not text.endswith("\n```"):
+        return False
+
+    # Undo the replacement of the leading spaces of every line
+    code_block_text = text[len("```\n") : -len("\n```")].replace(
+        NON_BREAKING_SPACE + " ", " "
+    )
+    language = detect_language(code_block_text)
+    if len(language) == 0:
+        return False
+
+    first_text.text += language
+    return True
+
+
+def wrap_paragraphs(
+    body,
+    code_paragraphs: Sequence[bool],
+    detect_language: Optional[Callable[[str], str]] = None,
+) -> bool:
+    """Wraps consecutive code style paragraphs in Markdown code blocks.
+
+    The paragraphs of each code block are collected first and then replaced by a
+    single paragraph holding the whole block, so the document is only modified
+    once per code block.
+
+    Parameters
+    ----------
+    body
+        The w:body element of the document.
+    code_paragraphs : Sequence[bool]
+        Whether each w:p child of the body is a code style paragraph, see
+        `find_code_paragraphs`.
+    detect_language : Optional[Callable[[str], str]]
+        Returns the language of the text of a code block, or an empty string if
+        it is unknown. The language is added after the opening backticks, also
+        to the code blocks wrapped without a language by an earlier run.
+
+    Returns
+    -------
+    bool
+        True if any code blocks were wrapped, or any languages added.
+    """
+    paragraph_tag = qn("w:p")
+    run_tag = qn("w:r")
+    code_flags = iter(code_paragraphs)
+
+    # Each code block is a list of (index in body, paragraph, text) tuples
+    code_blocks = []
+    code_block = None
+    tagged = False
+
+    for idx, element in enumerate(body):
+        if element.tag != paragraph_tag:
+            continue
+
+        is_code = next(code_flags)
+        if element.find(run_tag) is None:
+            continue
+
+        if is_code:
+            text = paragraph_text(element)
+            if code_block is None and len(text.strip()) > 0:
+                code_block = []
+                code_blocks.append(code_block)
+            if code_block is not None:
+                code_block.append((idx, element, text))
+        else:
+            code_block = None
+            if detect_language is not None:
+                tagged |= add_language_to_wrapped_code_block(element, detect_language)
+
+    # Replace the blocks from the end of the document so the collected indexes
+    # of the earlier blocks remain valid
+    for code_block in reversed(code_blocks):
+        fence = "```"
+        if detect_language is not None:
+            fence += detect_language(
+                "\n".join(text.rstrip() for _, _, text in code_block)
+            )
+
+        # Prepend three backticks to the first line to signal the start of the
+        # block. Leading spaces of the first line are therefore kept as is.
+        lines = [
+            replace_leading_spaces(((fence + "\n" if i == 0 else "") + text).rstrip())
+            + "\n"
+            for i, (_, _, text) in enumerate(code_block)
+        ]
+        close_code_block(lines)
+        paragraph = create_code_block_paragraph(lines)
+
+        # The old paragraphs cannot be reused because they contain a paragraph
+        # break at the end which will cause pandoc to output empty newlines
+        start, end = code_block[0][0], code_block[-1][0] + 1
+        if end - start == len(code_block):
+            body[start:end] = [paragraph]
+        else:
+            # Paragraphs without runs and tables do not end a code block, but
+            # stay where they are
+            code_block[0][1].addprevious(paragraph)
+            for _, element, _ in code_block:
+                body.remove(element)
+
+    return len(code_blocks) > 0 or tagged
+
+
+def wrap_code_blocks(
+    filename: str,
+    engine: str = STREAM_ENGINE,
+    detect_language: Optional[Callable[[str], str]] = None,
+) -> bool:
+    """Wraps the code style paragraphs of a docx file in Markdown code blocks.
+
+    The file is updated in place. Files without any code blocks are left
+    untouched, and files without any code style text are not even parsed.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the docx file to update.
+    engine : str
+        Either `STREAM_ENGINE` to only rewrite the main document part and copy
+        every other part of the package as is, or `DOCX_ENGINE` to load and
+        save the whole package with python-docx.
+    detect_language : Optional[Callable[[str], str]]
+        Detects the language added to every code block, see `wrap_paragraphs`.
+
+    Returns
+    -------
+    bool
+        True if the file was modified.
+    """
+    partname = document_partname(filename)
+    document_xml = read_part(filename, partname)
+
+    # The styles only need to be parsed if one of them can set the code font
+    style_fonts = StyleFonts()
+    styles_part = styles_partname(filename, partname)
+    if styles_part is not None:
+        styles_xml = read_part(filename, styles_part)
+        if CODE_STYLE_FONT_NAME.encode("utf-8") in styles_xml:
+            style_fonts = StyleFonts(parse_xml(styles_xml))
+
+    # Code blocks wrapped by an earlier run no longer use the code font
+    if not may_contain_code(document_xml, style_fonts) and (
+        detect_language is None or b"```" not in document_xml
+    ):
+        return False
+
+    if engine == DOCX_ENGINE:
+        doc = docx.Document(filename)
+        body = doc.element.body
+        code_paragraphs = find_code_paragraphs(body, style_fonts)
+        if not wrap_paragraphs(body, code_paragraphs, detect_language):
+            return False
+
+        doc.save(filename)
+        return True
+
+    document = parse_xml(document_xml)
+    body = document.body
+    code_paragraphs = find_code_paragraphs(body, style_fonts)
+    if not wrap_paragraphs(body, code_paragraphs, detect_language):
+        return False
+
+    replace_part(filename, partname, serialize_part_xml(document))
+    return True
+
+
+class InvalidManifestEntry(NamedTuple):
+    """A line of a manifest which does not name a docx file.
+
+    It is reported as a failed file so that the other entries are still
+    processed.
+    """
+
+    #: The line of the manifest, without surrounding whitespace
+    line: str
+    #: Why the line is invalid
+    error: str
+
+
+def read_manifest(stream: TextIO) -> Iterator[Union[str, InvalidManifestEntry]]:
+    """Reads docx paths from a manifest.
+
+    Each line of the manifest is either a plain path or a JSON object with a
+    ``path`` key. Blank lines are ignored.
+
+    Parameters
+    ----------
+    stream : TextIO
+        The manifest to read, e.g. stdin.
+
+    Yields
+    ------
+    Union[str, InvalidManifestEntry]
+        The paths listed in the manifest, or the JSON lines which are malformed
+        or have no ``path``.
+    """
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        if not line.startswith("{"):
+            yield line
+            continue
+
+        try:
+            entry = json.loads(line)
+        except ValueError as e:
+            yield InvalidManifestEntry(
+                line, f"Invalid manifest line {line_number}: {type(e).__name__}: {e}"
+            )
+            continue
+
+        if not isinstance(entry, dict) or not isinstance(entry.get("path"), str):
+            yield InvalidManifestEntry(
+                line, f"Invalid manifest line {line_number}: no path"
+            )
+        else:
+            yield entry["path"]
+
+
+def collect_paths(paths: Iterable[str]) -> Iterator[Union[str, InvalidManifestEntry]]:
+    """Expands the given paths into the docx files to process.
+
+    Directories are searched recursively for docx files, ``-`` reads a manifest
+    from stdin and any other path is passed through as is.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        Paths to docx files or directories, or ``-`` for stdin.
+
+    Yields
+    ------
+    Union[str, InvalidManifestEntry]
+        Paths to docx files, or the invalid entries of the manifest, see
+        `read_manifest`.
+    """
+    for path in paths:
+        if path == "-":
+            yield from read_manifest(sys.stdin)
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    # Skip the lock files Word creates next to open documents
+                    if filename.endswith(".docx") and not filename.startswith("~$"):
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def _sha256(filename: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_BUFFER_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
-    new_text = ""
-    prev_char = text[0]
-    leading = True
 
-    for c in text:
-        # If we encounter a non-whitespace character, then we have reached the
-        # beginning of the text and no longer need to replace spaces
-        if ord(c) != SPACE_UNICODE_CODE and ord(c) != NON_BREAKING_SPACE_UNICODE_CODE:
-            leading = False
+def fingerprint(filename: str) -> Dict[str, Any]:
+    """Returns the size, modification time and content hash of a file.
 
+    Parameters
+    ----------
+    filename : str
+        Path to the file.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The ``size``, ``mtime_ns`` and ``sha256`` of the file.
+    """
+    stat = os.stat(filename)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": _sha256(filename),
+    }
+
+
+def matches_fingerprint(filename: str, expected: Dict[str, Any]) -> bool:
+    """Checks whether a file is unchanged since it was fingerprinted.
+
+    The content hash is only computed when the size matches but the modification
+    time does not, so unchanged files are usually matched with a single stat.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file.
+    expected : Dict[str, Any]
+        A fingerprint previously returned by `fingerprint`.
+
+    Returns
+    -------
+    bool
+        True if the file has the same contents as when it was fingerprinted.
+    """
+    stat = os.stat(filename)
+    if stat.st_size != expected["size"]:
+        return False
+    if stat.st_mtime_ns == expected["mtime_ns"]:
+        return True
+    return _sha256(filename) == expected["sha256"]
+
+
+class WrapCache:
+    """An SQLite database recording the docx files which have already been processed.
+
+    Reused docx files (``usedocx = 2``) are recorded after being processed so
+    later runs can skip them instead of parsing them again. Files are looked up
+    and recorded one at a time, so processing a file does not read or write the
+    entries of the others.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SQLite database. It is created if it does not exist.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            """)
+
+        row = self.connection.execute(
+            "SELECT value FROM metadata WHERE name = 'version'"
+        ).fetchone()
+        if row is None or row[0] != str(CACHE_VERSION):
+            # The columns of the files table depend on the version
+            self.connection.execute("DROP TABLE IF EXISTS files")
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES ('version', ?)",
+                (str(CACHE_VERSION),),
+            )
+
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                options TEXT NOT NULL
+            )
+            """)
+        self.connection.commit()
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.normcase(os.path.abspath(path))
+
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        """Returns the fingerprint recorded for a file, if any."""
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, sha256, options FROM files WHERE path = ?",
+            (self._key(path),),
+        ).fetchone()
+        if row is None:
+            return None
+
+        size, mtime_ns, sha256, options = row
+        return {
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "sha256": sha256,
+            "options": options,
+        }
+
+    def set(self, path: str, value: Dict[str, Any]) -> None:
+        """Records the fingerprint of a processed file."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            (
+                self._key(path),
+                value["size"],
+                value["mtime_ns"],
+                value["sha256"],
+                value["options"],
+            ),
+        )
+
+    def prune(self) -> int:
+        """Removes the entries of the files which no longer exist.
+
+        Every entry is checked, so this is meant to be run once after a
+        conversion rather than along with every file.
+
+        Returns
+        -------
+        int
+            The number of entries removed.
+        """
+        missing = [
+            (path,)
+            for (path,) in self.connection.execute("SELECT path FROM files")
+            if not os.path.exists(path)
+        ]
+        self.connection.executemany("DELETE FROM files WHERE path = ?", missing)
+        return len(missing)
+
+    def save(self) -> None:
+        """Commits the recorded files to the database."""
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def processing_options(
+    engine: str, detect_language: Optional[Callable[[str], str]]
+) -> str:
+    """Returns a tag identifying the options a file is processed with.
+
+    It is recorded in the cache, so that files are processed again with other
+    options, e.g. to add the languages to the code blocks of files wrapped
+    without them.
+    """
+    return engine if detect_language is None else f"{engine} detect-language"
+
+
+def process_file(
+    filename: str,
+    engine: str = STREAM_ENGINE,
+    cached: Optional[Dict[str, Any]] = None,
+    record: bool = False,
+    detect_language: Optional[Callable[[str], str]] = None,
+) -> Dict[str, Any]:
+    """Wraps the code blocks of a single docx file and reports the outcome.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the docx file to update.
+    engine : str
+        The engine used to update the file, see `wrap_code_blocks`.
+    cached : Optional[Dict[str, Any]]
+        The fingerprint recorded when the file was last processed. The file is
+        skipped if it still matches and was processed with the same options,
+        see `processing_options`.
+    record : bool
+        Whether to include the ``fingerprint`` of the processed file, with the
+        ``options`` it was processed with, in the result so it can be cached.
+    detect_language : Optional[Callable[[str], str]]
+        Detects the language added to every code block, see `wrap_paragraphs`.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The result of processing the file. ``status`` is either ``ok`` or
+        ``error``. Successes include whether the file was ``modified`` or
+        skipped because it was ``cached``, and failures include an ``error``
+        message.
+    """
+    options = processing_options(engine, detect_language)
+    try:
         if (
-            leading
-            and ord(c) == SPACE_UNICODE_CODE
-            and ord(prev_char) != NON_BREAKING_SPACE_UNICODE_CODE
+            cached is not None
+            and cached["options"] == options
+            and matches_fingerprint(filename, cached)
         ):
-            # Substitute a space with a non-breaking space plus a normal space
-            new_text += chr(NON_BREAKING_SPACE_UNICODE_CODE) + chr(SPACE_UNICODE_CODE)
+            result = {
+                "path": filename,
+                "status": "ok",
+                "modified": False,
+                "cached": True,
+            }
         else:
-            # Otherwise, just append the character as normal
-            new_text += c
+            modified = wrap_code_blocks(filename, engine, detect_language)
+            result = {
+                "path": filename,
+                "status": "ok",
+                "modified": modified,
+                "cached": False,
+            }
+
+        if record:
+            result["fingerprint"] = {**fingerprint(filename), "options": options}
+    except Exception as e:
+        return {
+            "path": filename,
+            "status": "error",
+            "error": f"{type(e).__name__}: {e}",
+        }
+
+    return result
+
 
-        prev_char = c
+def _process_task(task: Dict[str, Any]) -> Dict[str, Any]:
+    filename = task["filename"]
+    if isinstance(filename, InvalidManifestEntry):
+        return {"path": filename.line, "status": "error", "error": filename.error}
+    return process_file(**task)
 
-    return new_text
 
+def process_files(
+    filenames: Iterable[Union[str, InvalidManifestEntry]],
+    jobs: int = 1,
+    engine: str = STREAM_ENGINE,
+    cache: Optional[WrapCache] = None,
+    detect_language: Optional[Callable[[str], str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Wraps the code blocks of many docx files.
 
-def close_code_block(paragraph: docx.text.paragraph.Paragraph) -> None:
-    """Appends triple backticks to the end of a paragraph.
+    Results are yielded in the same order as the files regardless of the number
+    of jobs, and a failure in one file does not affect the others.
 
     Parameters
     ----------
-    paragraph : docx.text.paragraph.Paragraph
-        The docx paragraph to update.
+    filenames : Iterable[Union[str, InvalidManifestEntry]]
+        Paths to the docx files to update. Invalid manifest entries are reported
+        as failures.
+    jobs : int
+        The number of worker processes to use. 1 processes the files in the
+        current process and 0 uses one worker per CPU.
+    engine : str
+        The engine used to update the files, see `wrap_code_blocks`.
+    cache : Optional[WrapCache]
+        Files recorded in the cache are skipped if they are unchanged, and
+        every successfully processed file is recorded. The cache is not saved.
+    detect_language : Optional[Callable[[str], str]]
+        Detects the language added to every code block, see `wrap_paragraphs`.
+        It must be picklable when using more than one job.
+
+    Yields
+    ------
+    Dict[str, Any]
+        The result of processing each file, see `process_file`.
     """
-    index = 1
-    # Get the last non-empty run inserted into the paragraph and insert three
-    # backticks to signal the end of the block
-    last_run = paragraph.runs[len(paragraph.runs) - index]
-    while len(last_run.text.strip()) == 0 and index <= (len(paragraph.runs) - 1):
-        index += 1
-        last_run = paragraph.runs[len(paragraph.runs) - index]
+    tasks = (
+        {
+            "filename": filename,
+            "engine": engine,
+            "cached": (
+                cache.get(filename)
+                if cache is not None and isinstance(filename, str)
+                else None
+            ),
+            "record": cache is not None,
+            "detect_language": detect_language,
+        }
+        for filename in filenames
+    )
+
+    if jobs == 1:
+        results = map(_process_task, tasks)
+        pool = None
+    else:
+        if cache is not None:
+            # The pool consumes the tasks in another thread, which cannot use
+            # the SQLite connection of the cache
+            tasks = list(tasks)
+        pool = multiprocessing.Pool(jobs or None)
+        results = pool.imap(_process_task, tasks)
 
-    # The run text already contains a line break so a newline does not
-    # need to be added
-    last_run.text = last_run.text + "```"
+    try:
+        for result in results:
+            if "fingerprint" in result:
+                cache.set(result["path"], result.pop("fingerprint"))
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 
 def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("filename")
+    parser = argparse.ArgumentParser(
+        description="Wraps code style text of docx files in Markdown code blocks. "
+        "A JSON result line is printed to stdout for every file processed, "
+        "unless --quiet is given."
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        metavar="path",
+        help="Path to a docx file, a directory containing docx files, or - to "
+        "read a newline delimited or JSON lines manifest of paths from stdin",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used to process files in parallel, 0 "
+        "uses one per CPU (default: 1)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=STREAM_ENGINE,
+        help="stream only rewrites the document text and copies images and "
+        "other attachments as is, docx loads and saves the whole package with "
+        "python-docx (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="SQLite file recording the docx files already processed, so that "
+        "unchanged files are skipped when they are reused by a later run",
+    )
+    parser.add_argument(
+        "--prune-cache",
+        action="store_true",
+        help="Remove the docx files which no longer exist from the cache. Paths "
+        "are optional, so this can be run once after a conversion",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Do not print the JSON result lines. Failures are still printed to "
+        "stderr",
+    )
+    parser.add_argument(
+        "--detect-language",
+        action="store_true",
+        help="Detect the language of every code block and add it after the "
+        "opening backticks, instead of running add_code_block_language.py on "
+        "the Markdown files afterwards. Requires guesslang",
+    )
     args = parser.parse_args()
 
-    doc = docx.Document(args.filename)
+    if args.jobs < 0:
+        parser.error("--jobs must not be negative")
+    if args.prune_cache and args.cache is None:
+        parser.error("--prune-cache requires --cache")
+    if len(args.paths) == 0 and not args.prune_cache:
+        parser.error("the following arguments are required: path")
 
-    in_code_block = False
-    inserted_paragraph = None
-
-    for p in doc.paragraphs:
-        if len(p.runs) == 0:
-            continue
+    detect_language = None
+    if args.detect_language:
+        # Only load the language detection model when it is needed
+        from add_code_block_language import detect_language
 
-        font = p.runs[0].font.name
+    cache = WrapCache(args.cache) if args.cache else None
+    failed = 0
 
-        if (
-            font == CODE_STYLE_FONT_NAME
-            and len(p.text.strip()) > 0
-            and not in_code_block
+    try:
+        for result in process_files(
+            collect_paths(args.paths), args.jobs, args.engine, cache, detect_language
         ):
-            # Generate a new paragraph before the beginning of the code block
-            inserted_paragraph = p.insert_paragraph_before()
-            # Append three backticks to the current paragraph text to signal the
-            # start of the block
-            p.text = "```\n" + p.text
-            in_code_block = True
-
-        if font == CODE_STYLE_FONT_NAME and in_code_block:
-            run = inserted_paragraph.add_run(replace_leading_spaces(p.text.rstrip()))
-            # We must use line breaks instead of paragraph breaks otherwise
-            # pandoc will output incorrect newlines into the code block
-            run.add_break()
-
-            # Remove the old paragraph. The standard paragraph cannot be used
-            # because it contains a paragraph break at the end which will cause
-            # pandoc to output empty newlines
-            try:
-                xml = p._element
-                xml.getparent().remove(xml)
-                xml._p = xml._element = None
-            except AttributeError:
-                continue
-
-        if font != CODE_STYLE_FONT_NAME and in_code_block:
-            close_code_block(inserted_paragraph)
-            in_code_block = False
-
-    # If a code block is at the end of document, close it now
-    if in_code_block:
-        close_code_block(inserted_paragraph)
-
-    doc.save(args.filename)
+            if result["status"] != "ok":
+                failed += 1
+                print(f"{result['path']}: {result['error']}", file=sys.stderr)
+
+            if not args.quiet:
+                print(json.dumps(result), flush=True)
+    finally:
+        # Save the progress made so far even if the run is interrupted
+        if cache is not None:
+            if args.prune_cache:
+                cache.prune()
+            cache.save()
+            cache.close()
+
+    if failed > 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Benchmarks wrapping a page containing a large code block, such as a pasted
+log, with each engine."""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import docx
+
+from wrap_code_blocks import CODE_STYLE_FONT_NAME, ENGINES, wrap_code_blocks
+
+
+def create_page(filename: str, lines: int) -> None:
+    """Saves a docx file with a single code block of the given number of lines."""
+    doc = docx.Document()
+    doc.add_paragraph("text before the code block")
+    for i in range(lines):
+        run = doc.add_paragraph().add_run(f"    {i:08d} INFO some logged output")
+        run.font.name = CODE_STYLE_FONT_NAME
+    doc.add_paragraph("text after the code block")
+    doc.save(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--lines", type=int, default=10000, help="Number of code lines on the page"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of timed runs per engine"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        template = os.path.join(tmp, "template.docx")
+        create_page(template, args.lines)
+
+        for engine in ENGINES:
+            timings = []
+            for _ in range(args.repeat):
+                filename = os.path.join(tmp, f"{engine}.docx")
+                shutil.copyfile(template, filename)
+
+                start = time.perf_counter()
+                wrap_code_blocks(filename, engine)
+                timings.append(time.perf_counter() - start)
+
+            print(
+                f"{engine}: {args.lines} code lines wrapped in "
+                f"{min(timings):.3f}s (best of {args.repeat})"
+            )
+
+
+if __name__ == "__main__":
+    main()
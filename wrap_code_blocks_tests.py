@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+"""Unit tests to exercise wrapping code style paragraphs in code blocks."""
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import docx
+from docx.enum.style import WD_STYLE_TYPE
+
+import docx_package
+from wrap_code_blocks import (
+    CODE_STYLE_FONT_NAME,
+    DOCX_ENGINE,
+    STREAM_ENGINE,
+    InvalidManifestEntry,
+    WrapCache,
+    collect_paths,
+    main,
+    process_file,
+    process_files,
+    read_manifest,
+    replace_leading_spaces,
+)
+
+
+def create_document(filename: str, paragraphs) -> None:
+    """Saves a docx file made of (text, is_code) paragraphs."""
+    doc = docx.Document()
+    for text, is_code in paragraphs:
+        run = doc.add_paragraph().add_run(text)
+        if is_code:
+            run.font.name = CODE_STYLE_FONT_NAME
+    doc.save(filename)
+
+
+def detect_language(code_block_text: str) -> str:
+    return "python" if code_block_text.startswith("def ") else ""
+
+
+def paragraph_texts(filename: str):
+    return [p.text for p in docx.Document(filename).paragraphs]
+
+
+class TestReplaceLeadingSpaces(unittest.TestCase):
+    def test_leading_spaces(self):
+        self.assertEqual(replace_leading_spaces("  x = 5"), "\xa0 \xa0 x = 5")
+
+    def test_spaces_after_non_breaking_spaces(self):
+        self.assertEqual(replace_leading_spaces("\xa0 \xa0 x"), "\xa0 \xa0 x")
+
+    def test_inner_spaces(self):
+        self.assertEqual(replace_leading_spaces("x = 5"), "x = 5")
+
+    def test_empty(self):
+        self.assertEqual(replace_leading_spaces(""), "")
+
+
+class TestProcessFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_code_block(self):
+        filename = os.path.join(self.tmp.name, "page.docx")
+        create_document(
+            filename,
+            [
+                ("text before", False),
+                ("def main():", True),
+                ("  pass", True),
+                ("text after", False),
+            ],
+        )
+
+        result = process_file(filename)
+
+        self.assertEqual(
+            result,
+            {"path": filename, "status": "ok", "modified": True, "cached": False},
+        )
+        self.assertEqual(
+            paragraph_texts(filename),
+            [
+                "text before",
+                "```\ndef main():\n\xa0 \xa0 pass\n```",
+                "text after",
+            ],
+        )
+
+    def test_detect_language(self):
+        filename = os.path.join(self.tmp.name, "page.docx")
+        create_document(
+            filename,
+            [
+                ("def main():", True),
+                ("  pass", True),
+                ("text", False),
+                ("x = 5", True),
+            ],
+        )
+
+        result = process_file(filename, detect_language=detect_language)
+
+        self.assertEqual(result["status"], "ok")
+        self.assertEqual(
+            paragraph_texts(filename),
+            [
+                "```python\ndef main():\n\xa0 \xa0 pass\n```",
+                "text",
+                "```\nx = 5\n```",
+            ],
+        )
+
+    def test_detect_language_of_wrapped_code_blocks(self):
+        filename = os.path.join(self.tmp.name, "page.docx")
+        create_document(
+            filename,
+            [("def main():", True), ("  pass", True), ("text", False), ("x", True)],
+        )
+        process_file(filename)
+        detected = []
+
+        def detect(code_block_text):
+            detected.append(code_block_text)
+            return detect_language(code_block_text)
+
+        for engine in [STREAM_ENGINE, DOCX_ENGINE]:
+            result = process_file(filename, engine, detect_language=detect)
+
+            self.assertEqual(result["modified"], engine == STREAM_ENGINE)
+        self.assertEqual(
+            paragraph_texts(filename),
+            ["```python\ndef main():\n\xa0 \xa0 pass\n```", "text", "```\nx\n```"],
+        )
+        self.assertEqual(detected, ["def main():\n  pass", "x", "x"])
+
+    def test_code_block_at_end(self):
+        filename = os.path.join(self.tmp.name, "page.docx")
+        create_document(filename, [("text before", False), ("x = 5", True)])
+
+        process_file(filename)
+
+        self.assertEqual(paragraph_texts(filename), ["text before", "```\nx = 5\n```"])
+
+    def test_no_code_style_text(self):
+        filename = os.path.join(self.tmp.name, "page.docx")
+        create_document(filename, [("text", False), ("more text", False)])
+        os.utime(filename, ns=(0, 0))
+
+        result = process_file(filename)
+
+        self.assertEqual(
+            result,
+            {"path": filename, "status": "ok", "modified": False, "cached": False},
+        )
+        self.assertEqual(os.stat(filename).st_mtime_ns, 0)
+
+    def test_only_blank_code_style_text(self):
+        filename = os.path.join(self.tmp.name, "page.docx")
+        create_document(filename, [("text", False), ("  ", True)])
+        os.utime(filename, ns=(0, 0))
+
+        self.assertFalse(process_file(filename)["modified"])
+        self.assertEqual(os.stat(filename).st_mtime_ns, 0)
+
+    def test_code_style_inherited_from_styles(self):
+        filename = os.path.join(self.tmp.name, "page.docx")
+        doc = docx.Document()
+        code_style = doc.styles.add_style("Code", WD_STYLE_TYPE.PARAGRAPH)
+        code_style.font.name = CODE_STYLE_FONT_NAME
+        nested_style = doc.styles.add_style("Nested Code", WD_STYLE_TYPE.PARAGRAPH)
+        nested_style.base_style = code_style
+        char_style = doc.styles.add_style("Code Char", WD_STYLE_TYPE.CHARACTER)
+        char_style.font.name = CODE_STYLE_FONT_NAME
+        doc.add_paragraph("text")
+        doc.add_paragraph("x = 5", style=code_style)
+        doc.add_paragraph("y = 6", style=nested_style)
+        doc.add_paragraph().add_run("z = 7", style=char_style)
+        doc.add_paragraph("not code", style=code_style).runs[0].font.name = "Arial"
+        doc.save(filename)
+
+        self.assertTrue(process_file(filename)["modified"])
+        self.assertEqual(
+            paragraph_texts(filename),
+            ["text", "```\nx = 5\ny = 6\nz = 7\n```", "not code"],
+        )
+
+    def test_unused_code_style(self):
+        filename = os.path.join(self.tmp.name, "page.docx")
+        doc = docx.Document()
+        code_style = doc.styles.add_style("Code", WD_STYLE_TYPE.PARAGRAPH)
+        code_style.font.name = CODE_STYLE_FONT_NAME
+        doc.add_paragraph("text")
+        doc.save(filename)
+        os.utime(filename, ns=(0, 0))
+
+        self.assertFalse(process_file(filename)["modified"])
+        self.assertEqual(os.stat(filename).st_mtime_ns, 0)
+
+    def test_engines_match(self):
+        paragraphs = [("text", False), ("x = 5", True), ("", True), ("  y = 6", True)]
+        documents = {}
+        for engine in [STREAM_ENGINE, DOCX_ENGINE]:
+            filename = os.path.join(self.tmp.name, f"{engine}.docx")
+            create_document(filename, paragraphs)
+
+            self.assertEqual(process_file(filename, engine)["status"], "ok")
+            documents[engine] = docx_package.read_part(filename, "word/document.xml")
+
+        self.assertEqual(documents[STREAM_ENGINE], documents[DOCX_ENGINE])
+
+    def test_invalid_file(self):
+        filename = os.path.join(self.tmp.name, "missing.docx")
+
+        result = process_file(filename)
+
+        self.assertEqual(result["path"], filename)
+        self.assertEqual(result["status"], "error")
+        self.assertIn("error", result)
+
+
+class TestProcessFiles(unittest.TestCase):
+    def test_parallel_matches_sequential(self):
+        paragraphs = [("text", False), ("x = 5", True), ("  y = 6", True)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filenames = {}
+            for mode in ["sequential", "parallel"]:
+                os.mkdir(os.path.join(tmp, mode))
+                filenames[mode] = [
+                    os.path.join(tmp, mode, name) for name in ["a.docx", "b.docx"]
+                ]
+                for filename in filenames[mode]:
+                    create_document(filename, paragraphs)
+                filenames[mode].append(os.path.join(tmp, mode, "missing.docx"))
+
+            sequential = list(process_files(filenames["sequential"]))
+            parallel = list(process_files(filenames["parallel"], jobs=2))
+
+            self.assertEqual([r["status"] for r in sequential], ["ok", "ok", "error"])
+            self.assertEqual(
+                [r["status"] for r in parallel], [r["status"] for r in sequential]
+            )
+            for sequential_file, parallel_file in zip(*filenames.values()):
+                if os.path.exists(sequential_file):
+                    self.assertEqual(
+                        paragraph_texts(parallel_file), paragraph_texts(sequential_file)
+                    )
+
+    def test_invalid_manifest_entry(self):
+        entry = InvalidManifestEntry("{", "Invalid manifest line 1: no path")
+
+        for jobs in [1, 2]:
+            with self.subTest(jobs=jobs):
+                self.assertEqual(
+                    list(process_files([entry], jobs, cache=mock.Mock())),
+                    [{"path": "{", "status": "error", "error": entry.error}],
+                )
+
+
+class TestWrapCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache_filename = os.path.join(self.tmp.name, "cache.sqlite")
+        self.filename = os.path.join(self.tmp.name, "page.docx")
+        create_document(self.filename, [("text", False), ("x = 5", True)])
+
+    def process(self, jobs=1, detect_language=None):
+        cache = WrapCache(self.cache_filename)
+        try:
+            results = list(
+                process_files(
+                    [self.filename], jobs, cache=cache, detect_language=detect_language
+                )
+            )
+            cache.save()
+        finally:
+            cache.close()
+        return results[0]
+
+    def test_skips_processed_file(self):
+        first = self.process()
+        wrapped_texts = paragraph_texts(self.filename)
+        mtime = os.stat(self.filename).st_mtime_ns
+
+        second = self.process()
+
+        self.assertEqual((first["modified"], first["cached"]), (True, False))
+        self.assertEqual((second["modified"], second["cached"]), (False, True))
+        self.assertNotIn("fingerprint", second)
+        self.assertEqual(os.stat(self.filename).st_mtime_ns, mtime)
+        self.assertEqual(paragraph_texts(self.filename), wrapped_texts)
+
+    def test_skips_touched_file_with_same_contents(self):
+        self.process()
+        os.utime(self.filename, ns=(0, 0))
+
+        self.assertTrue(self.process()["cached"])
+
+    def test_processes_replaced_file(self):
+        self.process()
+        create_document(self.filename, [("text", False), ("y = 6", True)])
+
+        result = self.process()
+
+        self.assertEqual((result["modified"], result["cached"]), (True, False))
+        self.assertEqual(paragraph_texts(self.filename)[1], "```\ny = 6\n```")
+
+    def test_processes_file_with_other_options(self):
+        self.process()
+
+        result = self.process(detect_language=lambda text: "python")
+
+        self.assertEqual((result["modified"], result["cached"]), (True, False))
+        self.assertEqual(paragraph_texts(self.filename)[1], "```python\nx = 5\n```")
+        self.assertTrue(self.process(detect_language=detect_language)["cached"])
+
+    def test_previous_version(self):
+        connection = sqlite3.connect(self.cache_filename)
+        connection.executescript("""
+            CREATE TABLE metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+            INSERT INTO metadata VALUES ('version', '1');
+            CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL);
+            """)
+        connection.close()
+
+        self.assertFalse(self.process()["cached"])
+        self.assertTrue(self.process()["cached"])
+
+    def test_parallel(self):
+        self.process(jobs=2)
+
+        self.assertTrue(self.process(jobs=2)["cached"])
+
+    def test_prunes_missing_files(self):
+        self.process()
+        other_filename = os.path.join(self.tmp.name, "other.docx")
+        create_document(other_filename, [("z = 7", True)])
+        cache = WrapCache(self.cache_filename)
+        list(process_files([other_filename], cache=cache))
+        os.remove(self.filename)
+
+        self.assertEqual(cache.prune(), 1)
+        self.assertIsNone(cache.get(self.filename))
+        self.assertIsNotNone(cache.get(other_filename))
+        cache.close()
+
+
+class TestCollectPaths(unittest.TestCase):
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "section"))
+            for name in ["b.docx", "a.docx", "~$a.docx", "notes.md", "section/c.docx"]:
+                open(os.path.join(tmp, name), "w").close()
+
+            self.assertEqual(
+                list(collect_paths([tmp])),
+                [
+                    os.path.join(tmp, "a.docx"),
+                    os.path.join(tmp, "b.docx"),
+                    os.path.join(tmp, "section", "c.docx"),
+                ],
+            )
+
+    def test_files(self):
+        self.assertEqual(
+            list(collect_paths(["a.docx", "b.docx"])), ["a.docx", "b.docx"]
+        )
+
+    def test_manifest(self):
+        manifest = io.StringIO('a.docx\n\n{"path": "b c.docx"}\n')
+
+        self.assertEqual(list(read_manifest(manifest)), ["a.docx", "b c.docx"])
+
+    def test_invalid_manifest_lines(self):
+        manifest = io.StringIO('{"path": \na.docx\n{"name": "b.docx"}\n["c.docx"]\n')
+
+        entries = list(read_manifest(manifest))
+
+        self.assertEqual(entries[1], "a.docx")
+        for entry, line, line_number in zip(
+            entries[::2], ['{"path":', '{"name": "b.docx"}'], [1, 3]
+        ):
+            self.assertIsInstance(entry, InvalidManifestEntry)
+            self.assertEqual(entry.line, line)
+            self.assertIn(f"Invalid manifest line {line_number}", entry.error)
+        self.assertEqual(entries[3], '["c.docx"]')
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filename = os.path.join(self.tmp.name, "page.docx")
+        create_document(self.filename, [("text", False), ("x = 5", True)])
+
+    def run_main(self, *args, stdin=""):
+        with mock.patch.object(sys, "argv", ["wrap_code_blocks.py", *args]):
+            with mock.patch.object(sys, "stdin", io.StringIO(stdin)):
+                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                    with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                        try:
+                            main()
+                        except SystemExit as e:
+                            exit_code = e.code
+                        else:
+                            exit_code = 0
+        return exit_code, stdout.getvalue(), stderr.getvalue()
+
+    def test_invalid_manifest_line(self):
+        manifest = f'{{"file": "a.docx"}}\n{json.dumps({"path": self.filename})}\n'
+
+        exit_code, stdout, stderr = self.run_main("-", stdin=manifest)
+
+        results = [json.loads(line) for line in stdout.splitlines()]
+        self.assertEqual(exit_code, 1)
+        self.assertEqual([r["status"] for r in results], ["error", "ok"])
+        self.assertEqual(results[0]["path"], '{"file": "a.docx"}')
+        self.assertIn("Invalid manifest line 1: no path", stderr)
+        self.assertEqual(paragraph_texts(self.filename)[1], "```\nx = 5\n```")
+
+    def test_quiet(self):
+        missing_filename = os.path.join(self.tmp.name, "missing.docx")
+
+        exit_code, stdout, stderr = self.run_main(
+            "--quiet", self.filename, missing_filename
+        )
+
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(stdout, "")
+        self.assertIn(missing_filename, stderr)
+        self.assertEqual(paragraph_texts(self.filename)[1], "```\nx = 5\n```")
+
+
+if __name__ == "__main__":
+    unittest.main()